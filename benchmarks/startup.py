@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+# Startup time of every lfp-* command: time to start the interpreter and
+# import the shell of the tool, as paid by every call from a batch script.
+# Heavy dependencies loaded at startup are listed, with lazy imports they
+# should only be loaded when the tool runs
+#
+# >> python benchmarks/startup.py [repeats]
+
+import sys
+import time
+import json
+import subprocess
+import numpy as np
+from lfptools.run import STAGES
+
+HEAVY = ['numpy', 'pandas', 'scipy', 'osgeo', 'gdalutils', 'geopandas', 'xarray',
+         'statsmodels', 'sklearn', 'pyproj', 'shapely']
+
+CODE = '''
+import sys, json, time
+t0 = time.time()
+from lfptools.%s import %s
+t1 = time.time()
+print(json.dumps([t1 - t0, [m for m in %r if m in sys.modules]]))
+'''
+
+
+def main(repeats=5):
+
+    # Interpreter start alone
+    base = []
+    for i in range(repeats):
+        base.append(timed([sys.executable, '-c', 'pass']))
+    print("%-16s %8.3f s" % ('python', np.median(base)))
+
+    tools = sorted(STAGES.items()) + [('batch', ('batch', 'batch_shell', []))]
+    for name, (module, shell, outputs) in tools:
+        total = []
+        imports = []
+        for i in range(repeats):
+            t = timed([sys.executable, '-c', CODE % (module, shell, HEAVY)], imports)
+            total.append(t)
+        if None in imports:
+            print("%-16s failed to import" % name)
+            continue
+        t_import = np.median([i[0] for i in imports])
+        print("%-16s %8.3f s  import %6.3f s  loaded: %s" %
+              (name, np.median(total), t_import, ', '.join(imports[-1][1]) or '-'))
+
+
+def timed(cmd, out=None):
+    t0 = time.time()
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    t = time.time() - t0
+    if out is not None:
+        if res.returncode != 0:
+            print(res.stderr.decode().strip().split('\n')[-1])
+            out.append(None)
+        else:
+            out.append(json.loads(res.stdout.decode().strip().split('\n')[-1]))
+    return t
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -5,38 +5,51 @@
 # mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
 
 import os
+import pandas as pd
 import lfptools as lfp
-from glob import glob
-from shutil import copyfile
-from subprocess import call
 
 dem = './062/062_dem_lidar.tif'
+proj = '+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs'
+
+# Stages are chained in memory: every stage returns a DataFrame indexed by
+# `rec` index (lon, lat and attribute) which is passed to the next one,
+# output=None means nothing is written. Set output to a file path to keep
+# the shapefile and GeoTIFF of a stage
+rec = pd.read_csv('./062/062_rec.csv')
+
+# Creating folders to save LFPtools and LISFLOOD-FP files
+for folder in ['./062/lfptools/', './062/lisfloodfp/']:
+    try:
+        os.makedirs(folder)
+    except FileExistsError:
+        pass
 
 # Calling lfp-getwidths
-lfp.getwidths(thresh=0.02,
-              output='./062/lfptools/062_wdt',
-              recf='./062/062_rec.csv',
-              netf='./062/062_net.tif',
-              proj='+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs',
-              fwidth='./062/062_wth_grwl.tif')
+wdt = lfp.getwidths(thresh=0.02,
+                    output=None,
+                    recf=rec,
+                    netf='./062/062_net.tif',
+                    proj=proj,
+                    fwidth='./062/062_wth_grwl.tif')
 
 # Calling bankelevs
-lfp.getbankelevs(outlier='yes',
-                 method='near',
-                 hrnodata=-9999,
-                 thresh=0.00416,
-                 output='./062/lfptools/062_bnk',
-                 netf='./062/062_net.tif',
-                 hrdemf=dem,
-                 proj='+proj=longlat + ellps=WGS84 + datum=WGS84 + no_defs')
+bnk = lfp.getbankelevs(outlier='yes',
+                       method='near',
+                       hrnodata=-9999,
+                       thresh=0.00416,
+                       output=None,
+                       recf=rec,
+                       netf='./062/062_net.tif',
+                       hrdemf=dem,
+                       proj=proj)
 
 # Calling fixelevs
-lfp.fixelevs(method='yamazaki',
-             source='./062/lfptools/062_bnk.shp',
-             output='./062/lfptools/062_bnkfix',
-             netf='./062/062_net.tif',
-             recf='./062/062_rec.csv',
-             proj='+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs')
+bnkfix = lfp.fixelevs(method='yamazaki',
+                      source=bnk,
+                      output=None,
+                      netf='./062/062_net.tif',
+                      recf=rec,
+                      proj=proj)
 
 # Calling rasterreample
 lfp.rasterresample(nproc=4,
@@ -49,28 +62,22 @@ lfp.rasterresample(nproc=4,
                    output='./062/lfptools/062_dem30.tif')
 
 # Calling getdepths
-lfp.getdepths(proj='+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs',
-              netf='./062/062_net.tif',
-              method='depth_geometry',
-              output='./062/lfptools/062_dpt',
-              wdtf='./062/lfptools/062_wdt.shp',
-              r=0.12,
-              p=0.78)
+dpt = lfp.getdepths(proj=proj,
+                    netf='./062/062_net.tif',
+                    method='depth_geometry',
+                    output=None,
+                    wdtf=wdt,
+                    r=0.12,
+                    p=0.78)
 
 # Calling bedelevs
-lfp.getbedelevs(bnkf='./062/lfptools/062_bnkfix.shp',
-                dptf='./062/lfptools/062_dpt.shp',
-                netf='./062/062_net.tif',
-                output='./062/lfptools/062_bed',
-                proj='+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs')
-
-# Creating a folder to save LISFLOOD-FP files
-try:
-    os.makedirs('./062/lisfloodfp/')
-except FileExistsError:
-    pass
+bed = lfp.getbedelevs(bnkf=bnkfix,
+                      dptf=dpt,
+                      netf='./062/062_net.tif',
+                      output=None,
+                      proj=proj)
 
-# Calling buildmodel
+# Calling buildmodel, stages are burnt in the DEM grid next to the .par file
 lfp.buildmodel(parlfp='./062/lisfloodfp/062.par',
                bcilfp='./062/lisfloodfp/062.bci',
                bdylfp='./062/lisfloodfp/062.bdy',
@@ -79,13 +86,12 @@ lfp.buildmodel(parlfp='./062/lisfloodfp/062.par',
                stagelfp='./062/lisfloodfp/062.stage',
                dembnktif='./062/lisfloodfp/062_dembnk.tif',
                dembnktif_1D='./062/lisfloodfp/062_dembnk_1D.tif',
-               bedtif='./062/lfptools/062_bed.tif',
-               wdttif='./062/lfptools/062_wdt.tif',
+               bedtif=bed,
+               wdttif=wdt,
                runcsv='./062/062_dis.csv',
                demtif='./062/lfptools/062_dem30.tif',
-               fixbnktif='./062/lfptools/062_bnkfix.tif',
+               fixbnktif=bnkfix,
                dirtif='./062/062_dir.tif',
                reccsv='./062/062_rec.csv',
                date1='1998-03-01',
                date2='1998-05-01')
-[copyfile(i, './062/lisfloodfp/'+os.path.basename(i)) for i in glob('./062/lfptools/*.asc')]
@@ -1,30 +1,44 @@
-from lfptools import fixelevs
-from lfptools import getbankelevs
-from lfptools import getbedelevs
-from lfptools import getslopes
-from lfptools import getwidths
-from lfptools import rasterresample
-from lfptools import getdepths
-from lfptools import split
-from lfptools import shapefile
-from lfptools import misc_utils
-from lfptools import prepdata_utils # doesn't import properly for some reason?
-from lfptools import utils
-from lfptools import getinflows
-from lfptools import getdischarge
-from lfptools import getrunoff
-from lfptools import buildmodel
-from lfptools import getbankfullq
-
-fixelevs = fixelevs.fixelevs
-getbankelevs = getbankelevs.getbankelevs
-getbedelevs = getbedelevs.getbedelevs
-getslopes = getslopes.getslopes
-getwidths = getwidths.getwidths
-rasterresample = rasterresample.rasterresample
-getdepths = getdepths.getdepths
-getinflows = getinflows.getinflows
-getdischarge = getdischarge.getdischarge
-getrunoff = getrunoff.getrunoff
-buildmodel = buildmodel.buildmodel
-getbankfullq  = getbankfullq.getbankfullq
+import sys
+import types
+import importlib
+
+# Modules are imported on first use (PEP 562), `import lfptools` and the
+# lfp-* commands only load what the tool being run needs
+
+MODULES = ['fixelevs', 'getbankelevs', 'getbedelevs', 'getslopes', 'getwidths',
+           'rasterresample', 'getdepths', 'split', 'shapefile', 'misc_utils',
+           'prepdata_utils', 'utils', 'getinflows', 'getdischarge', 'getrunoff',
+           'buildmodel', 'getbankfullq', 'sampling', 'samplepoints', 'buildindex',
+           'stageio', 'buildcache', 'run', 'batch', 'lazyimport', 'session',
+           'cli']
+
+# Tools exposed as functions with the name of their module
+TOOLS = ['fixelevs', 'getbankelevs', 'getbedelevs', 'getslopes', 'getwidths',
+         'rasterresample', 'getdepths', 'getinflows', 'getdischarge', 'getrunoff',
+         'buildmodel', 'getbankfullq', 'samplepoints', 'buildindex', 'run', 'batch']
+
+
+class _Package(types.ModuleType):
+
+    def __setattr__(self, name, value):
+        # The import system sets every submodule imported as an attribute,
+        # tool modules are replaced by their function
+        if name in TOOLS and isinstance(value, types.ModuleType):
+            value = getattr(value, name)
+        types.ModuleType.__setattr__(self, name, value)
+
+
+sys.modules[__name__].__class__ = _Package
+
+
+def __getattr__(name):
+
+    if name in MODULES:
+        importlib.import_module(__name__ + '.' + name)
+        return globals()[name]
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+
+def __dir__():
+
+    return sorted(set(globals()) | set(MODULES))
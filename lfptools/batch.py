@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import os
+import sys
+import glob
+import time
+import signal
+import getopt
+import threading
+import subprocess
+import configparser
+import numpy as np
+import pandas as pd
+from multiprocessing.pool import ThreadPool
+from lfptools import buildcache
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
+
+# Journal statuses, a basin is finished when its last entry is one of them
+DONE = 'done'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+
+def batch_shell(argv):
+
+    myhelp = '''
+LFPtools v0.1
+
+Name
+----
+batch
+
+Description
+-----------
+Run the tool chain for many basins, e.g. every folder written by
+lfp-split. A config file is written in every basin folder from a template
+where {basin} is replaced by the basin folder and {name} by its name
+(e.g. 062), and lfp-run is called on it. Basins are run in parallel, every
+basin in its own process with an optional timeout.
+
+Every finished basin is appended to a journal as done, failed or timeout.
+Running the same command again resumes the batch: basins already done are
+skipped, failed and timed out basins are run again only with retry = yes.
+A throughput summary is printed and written next to the journal.
+
+Sources listed in a [prefetch] section are clipped to every basin (extent
+of {basin}/{name}_rec.csv plus a buffer) in a background thread, ahead of
+the basins running, and written in {basin}/{name}_<source name>.tif. The
+template refers to them as {<source name>}, e.g. hrdemf = {hrdem}. Reading
+global sources then overlaps with the basins being computed.
+
+Usage
+-----
+>> lfp-batch -i config.txt
+
+Content in config.txt
+---------------------
+[batch]
+basins   = Glob or comma separated list of basin folders e.g. ./split/*
+template = Config template file path, lfp-run config with {basin} and {name}
+journal  = (Optional) Journal file path, default batch_journal.txt
+nproc    = (Optional) Number of basins run at the same time, default 1
+timeout  = (Optional) Maximum time per basin in seconds, default no limit
+retry    = (Optional) Run again failed and timed out basins [yes|no], default no
+depth    = (Optional) Basins clipped ahead of the running ones, default 1
+memory   = (Optional) Maximum size in MB of windows clipped ahead, default 1024
+buffer   = (Optional) Buffer around basin extent in degrees, at least the
+           largest searching threshold of the stages (thresh and
+           lfp-samplepoints thresholds in the template), default that
+           threshold or 0.1 if there is none
+
+[prefetch]
+# (Optional) One line per source, name = file path
+hrdem = /data/hrdem.vrt
+width = /data/width.vrt
+
+Content in template
+-------------------
+[run]
+ncpu = 1
+
+[getwidths]
+output = {basin}/lfptools/{name}_wdt
+recf   = {basin}/{name}_rec.csv
+...
+
+[getbankelevs]
+hrdemf = {hrdem}
+...
+'''
+
+    try:
+        opts, args = getopt.getopt(argv, "i:")
+        for o, a in opts:
+            if o == "-i":
+                inifile = a
+    except:
+        print(myhelp)
+        sys.exit(0)
+
+    config = configparser.SafeConfigParser({'journal': 'batch_journal.txt',
+                                            'nproc': '1', 'timeout': '0',
+                                            'retry': 'no', 'depth': '1',
+                                            'memory': '1024', 'buffer': 'auto'})
+    config.read(inifile)
+
+    basins = str(config.get('batch', 'basins'))
+    template = str(config.get('batch', 'template'))
+    journal = str(config.get('batch', 'journal'))
+    nproc = int(config.get('batch', 'nproc'))
+    timeout = np.float64(config.get('batch', 'timeout'))
+    retry = str(config.get('batch', 'retry')) == 'yes'
+    depth = int(config.get('batch', 'depth'))
+    memory = np.float64(config.get('batch', 'memory'))
+    buffer = str(config.get('batch', 'buffer'))
+    buffer = None if buffer == 'auto' else np.float64(buffer)
+
+    sources = {}
+    if config.has_section('prefetch'):
+        sources = {key: value.strip() for key, value in config.items('prefetch')
+                   if key not in config.defaults()}
+
+    batch(basins, template, journal, nproc, timeout, retry, sources, depth,
+          memory, buffer)
+
+
+def batch(basins, template, journal='batch_journal.txt', nproc=1, timeout=0, retry=False,
+          sources={}, depth=1, memory=1024, buffer=None):
+
+    print("    running batch.py...")
+
+    folders = find_basins(basins)
+    if len(folders) == 0:
+        sys.exit('ERROR no basin folders found: ' + str(basins))
+    with open(template) as f:
+        text = f.read()
+
+    # Resume from the journal, last entry of every basin counts
+    last = read_journal(journal)
+    skip = [DONE] if retry else [DONE, FAILED, TIMEOUT]
+    todo = [folder for folder in folders if last.get(folder) not in skip]
+    print("    " + str(len(folders)) + " basins, " + str(len(folders)-len(todo)) +
+          " finished in journal, " + str(len(todo)) + " to run")
+
+    lock = threading.Lock()
+    interrupted = threading.Event()
+    results = []
+    running = set()
+    t0 = time.time()
+
+    prefetch = None
+    if sources:
+        # Clips should hold the windows of the points at the basin edges
+        thresh, variable = template_thresh(text)
+        if buffer is None:
+            buffer = 0.1 if thresh is None else thresh
+        elif thresh is not None and buffer < thresh:
+            sys.exit('ERROR buffer ' + str(buffer) + ' is smaller than the largest ' +
+                     'threshold in ' + template + ': ' + str(thresh))
+        for section in variable:
+            print("WARNING " + section + " thresholds depend on the data, buffer " +
+                  str(buffer) + " should be larger than all of them")
+        cache = buildcache.BuildCache(os.path.dirname(journal) or '.',
+                                      name=os.path.splitext(os.path.basename(journal))[0])
+        prefetch = Prefetcher(todo, sources, buffer, depth, memory*2**20, cache)
+        prefetch.start()
+
+    def work(folder):
+        t1 = time.time()
+        error = prefetch.wait(folder) if prefetch else None
+        if error is None:
+            status, seconds = run_basin(folder, text, timeout, running, sources)
+            seconds = time.time() - t1
+        else:
+            with open(os.path.join(folder, 'lfp-batch.log'), 'w') as log:
+                log.write('ERROR prefetch failed: ' + error + '\n')
+            status, seconds = FAILED, time.time() - t1
+        if prefetch:
+            prefetch.release(folder)
+        # Basins killed by an interruption are not finished
+        if interrupted.is_set():
+            return
+        with lock:
+            write_journal(journal, folder, status, seconds)
+            results.append((folder, status, seconds))
+            print("    [" + str(len(results)) + "/" + str(len(todo)) + "] " +
+                  os.path.basename(folder) + " " + status + " in " + "%.1f" % seconds + " s")
+
+    # Threads only wait on the basin processes
+    pool = ThreadPool(max(nproc, 1))
+    try:
+        pool.map(work, todo, chunksize=1)
+        pool.close()
+    except KeyboardInterrupt:
+        # Basins in progress are not in the journal, they run again next time
+        interrupted.set()
+        pool.terminate()
+        for proc in list(running):
+            kill(proc)
+        sys.exit('ERROR batch interrupted, run it again to resume')
+    finally:
+        if prefetch:
+            prefetch.stop()
+        pool.join()
+
+    summary(journal, folders, results, time.time() - t0, nproc,
+            prefetch.wait_time if prefetch else None)
+
+    if any(status != DONE for folder, status, seconds in results):
+        sys.exit('ERROR some basins did not finish, see ' + journal)
+
+
+def find_basins(basins):
+    """
+    Basin folders from a glob or a comma separated list, sorted
+    """
+
+    folders = []
+    for item in basins.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        matches = glob.glob(item) if glob.has_magic(item) else [item]
+        folders += [os.path.normpath(i) for i in matches if os.path.isdir(i)]
+    return sorted(set(folders))
+
+
+def basin_config(folder, text, sources={}):
+    """
+    Write the config of a basin from the template text, returns its path
+    """
+
+    name = os.path.basename(folder)
+    text = text.replace('{basin}', folder).replace('{name}', name)
+    for key in sources:
+        text = text.replace('{' + key + '}', prefetch_file(folder, key))
+    fname = os.path.join(folder, 'lfp-batch.ini')
+    with open(fname, 'w') as f:
+        f.write(text)
+    return fname
+
+
+def template_thresh(text):
+    """
+    Largest searching threshold of the stages in a template: thresh of
+    every section and thresholds of lfp-samplepoints attributes, None if
+    there is none. Also returns the sections with variable thresholds
+    (lfp-getwidths var_thresh)
+    """
+
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_string(text)
+
+    values = []
+    variable = []
+    for section in config.sections():
+        if config.has_option(section, 'thresh'):
+            values.append(config.get(section, 'thresh'))
+        if section == 'samplepoints' and config.has_option(section, 'fields'):
+            for name in config.get(section, 'fields').split(','):
+                if config.has_option(section, name.strip()):
+                    spec = config.get(section, name.strip()).split(',')
+                    values += spec[2:3]
+        if (config.has_option(section, 'method') and
+                config.get(section, 'method').strip() == 'var_thresh'):
+            variable.append(section)
+
+    thresh = None
+    for value in values:
+        try:
+            thresh = max(float(value), thresh or 0.)
+        except ValueError:
+            pass
+    return thresh, variable
+
+
+def prefetch_file(folder, key):
+    """
+    Local file of source key clipped to the basin in folder
+    """
+
+    return os.path.join(folder, os.path.basename(folder) + '_' + key + '.tif')
+
+
+def run_basin(folder, text, timeout=0, running=None, sources={}):
+    """
+    Run lfp-run for a basin in its own process group, output written in
+    folder/lfp-batch.log. Returns status and time in seconds. The process
+    is kept in running while it runs
+    """
+
+    if running is None:
+        running = set()
+
+    inifile = basin_config(folder, text, sources)
+    code = "import sys; from lfptools.run import run_shell; run_shell(sys.argv[1:])"
+    t0 = time.time()
+    with open(os.path.join(folder, 'lfp-batch.log'), 'w') as log:
+        proc = subprocess.Popen([sys.executable, '-c', code, '-i', inifile],
+                                stdout=log, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        running.add(proc)
+        try:
+            proc.wait(timeout=timeout if timeout > 0 else None)
+            status = DONE if proc.returncode == 0 else FAILED
+        except subprocess.TimeoutExpired:
+            kill(proc)
+            status = TIMEOUT
+        finally:
+            running.discard(proc)
+    return status, time.time() - t0
+
+
+def kill(proc):
+    """
+    Kill a basin process and the stages it started, all in its process
+    group
+    """
+
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+class Prefetcher(threading.Thread):
+    """
+    Clip sources to basins, in order, at most depth basins ahead of the
+    basins started and while windows clipped for basins not finished take
+    less than memory bytes
+    """
+
+    def __init__(self, folders, sources, buffer, depth, memory, cache):
+
+        threading.Thread.__init__(self, daemon=True)
+        self.folders = folders
+        self.sources = sources
+        self.buffer = buffer
+        self.depth = depth
+        self.memory = memory
+        self.cache = cache
+        self.cond = threading.Condition()
+        self.started = 0
+        self.held = 0
+        self.sizes = {}
+        self.errors = {}
+        self.stopped = False
+        self.wait_time = 0
+
+    def run(self):
+
+        for i, folder in enumerate(self.folders):
+            with self.cond:
+                while not self.stopped and (i >= self.started + self.depth or
+                                            (self.held >= self.memory and self.held > 0)):
+                    self.cond.wait()
+                if self.stopped:
+                    return
+            try:
+                size = fetch_basin(folder, self.sources, self.buffer, self.cache)
+                error = None
+            except Exception as e:
+                size = 0
+                error = repr(e)
+            with self.cond:
+                self.sizes[folder] = size
+                self.errors[folder] = error
+                self.held += size
+                self.cond.notify_all()
+
+    def wait(self, folder):
+        """
+        Wait until the sources of a basin are clipped, returns the error
+        message if clipping failed
+        """
+
+        t0 = time.time()
+        with self.cond:
+            self.started += 1
+            self.cond.notify_all()
+            while folder not in self.errors and not self.stopped:
+                self.cond.wait()
+            self.wait_time += time.time() - t0
+            return self.errors.get(folder, 'batch stopped')
+
+    def release(self, folder):
+        """
+        Basin finished, its windows no longer count in memory
+        """
+
+        with self.cond:
+            self.held -= self.sizes.pop(folder, 0)
+            self.cond.notify_all()
+
+    def stop(self):
+
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+def fetch_basin(folder, sources, buffer, cache):
+    """
+    Clip every source to the extent of the basin rec file plus buffer,
+    sources already clipped with the same extent are kept. Returns the
+    size in bytes of the windows read
+    """
+
+    name = os.path.basename(folder)
+    rec = pd.read_csv(os.path.join(folder, name + '_rec.csv'), usecols=['lon', 'lat'])
+    xmin = rec['lon'].min() - buffer
+    ymin = rec['lat'].min() - buffer
+    xmax = rec['lon'].max() + buffer
+    ymax = rec['lat'].max() + buffer
+
+    size = 0
+    for key, source in sorted(sources.items()):
+        fname = prefetch_file(folder, key)
+        step = folder + ':' + key
+        if not cache.stale(step, [source], [fname], [xmin, ymin, xmax, ymax]):
+            continue
+        dat, geo = gdalutils.clip_raster(source, xmin, ymin, xmax, ymax)
+        gdalutils.write_raster(dat, fname, geo, gdal_type(dat.dtype), geo[11])
+        size += dat.nbytes
+        del dat
+        cache.done(step)
+    return size
+
+
+def gdal_type(dtype):
+    """
+    GDAL data type name of a numpy dtype
+    """
+
+    types = {'uint8': 'Byte', 'int16': 'Int16', 'uint16': 'UInt16',
+             'int32': 'Int32', 'uint32': 'UInt32', 'float32': 'Float32',
+             'float64': 'Float64'}
+    return types.get(np.dtype(dtype).name, 'Float64')
+
+
+def read_journal(journal):
+    """
+    Last status of every basin in the journal
+    """
+
+    last = {}
+    if not os.path.exists(journal):
+        return last
+    with open(journal) as f:
+        for line in f:
+            vals = line.rstrip('\n').split('\t')
+            if len(vals) == 4:
+                last[vals[1]] = vals[2]
+    return last
+
+
+def write_journal(journal, folder, status, seconds):
+    """
+    Append a basin to the journal: date, folder, status, seconds
+    """
+
+    with open(journal, 'a') as f:
+        f.write(time.strftime('%Y-%m-%dT%H:%M:%S') + '\t' + folder + '\t' +
+                status + '\t' + "%.1f" % seconds + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def summary(journal, folders, results, wall, nproc, wait=None):
+    """
+    Print and write the throughput summary in journal_summary.txt
+    """
+
+    counts = {status: 0 for status in (DONE, FAILED, TIMEOUT)}
+    for folder, status, seconds in results:
+        counts[status] += 1
+    times = np.array([seconds for folder, status, seconds in results
+                      if status == DONE])
+    last = read_journal(journal)
+
+    lines = ['basins            ' + str(len(folders)),
+             'run               ' + str(len(results)),
+             'done              ' + str(counts[DONE]),
+             'failed            ' + str(counts[FAILED]),
+             'timeout           ' + str(counts[TIMEOUT]),
+             'done in journal   ' + str(sum(last.get(i) == DONE for i in folders)),
+             'nproc             ' + str(nproc),
+             'wall time (s)     ' + "%.1f" % wall,
+             'basins per hour   ' + "%.1f" % (len(results)/wall*3600 if wall > 0 else 0)]
+    if times.size:
+        lines += ['basin time mean   ' + "%.1f" % times.mean(),
+                  'basin time median ' + "%.1f" % np.median(times),
+                  'basin time max    ' + "%.1f" % times.max()]
+    if wait is not None:
+        lines += ['prefetch wait (s) ' + "%.1f" % wait]
+    for folder, status, seconds in results:
+        if status != DONE:
+            lines.append(status + ' ' + folder)
+
+    for line in lines:
+        print("    " + line)
+    with open(os.path.splitext(journal)[0] + '_summary.txt', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    batch_shell(sys.argv[1:])
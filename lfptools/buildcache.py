@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import os
+import re
+import glob
+import json
+import shutil
+import hashlib
+
+# Build cache to rerun only the steps whose inputs changed. Every step has a
+# fingerprint made of the digests of its input files, its parameters, the
+# digest of the code running it and the version of external tools (TauDEM,
+# GDAL utilities). A step is rerun when its fingerprint changed or when any
+# of its outputs is missing or was modified after the step ran.
+#
+# Digests are SHA-1 of the file content, kept in the cache next to the size
+# and modification time of the file so a file is hashed again only when it
+# changes. Folders are hashed by their content. Files referenced by a .vrt
+# are not followed, touch the .vrt when its tiles change.
+
+CACHE = '.lfpcache.json'
+BLOCK = 1 << 20
+
+
+class BuildCache(object):
+    """
+    Cache of the steps run to build the files in folder, saved in
+    folder/.lfpcache.json (or folder/<name>.lfpcache.json). With
+    enabled=False it falls back to checking the outputs exist,
+    overwrite=True reruns every step
+    """
+
+    def __init__(self, folder, enabled=True, overwrite=False, code=(), name=''):
+
+        self.fname = os.path.join(folder, name + CACHE)
+        self.enabled = enabled
+        self.overwrite = overwrite
+        self.code = list(code)
+        self.pending = {}
+        self.files = {}
+        self.steps = {}
+        if enabled and os.path.exists(self.fname):
+            try:
+                with open(self.fname) as f:
+                    data = json.load(f)
+                self.files = data['files']
+                self.steps = data['steps']
+            except (ValueError, KeyError):
+                print("WARNING build cache not readable, rebuilding: " + self.fname)
+
+    def digest(self, path):
+        """
+        Digest of a file or folder content, None if it does not exist
+        """
+
+        if os.path.isdir(path):
+            h = hashlib.sha1()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    fname = os.path.join(root, name)
+                    if name.endswith(CACHE) or name.endswith(CACHE + '.tmp'):
+                        continue
+                    h.update(os.path.relpath(fname, path).encode())
+                    h.update(str(self.digest(fname)).encode())
+            return h.hexdigest()
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = os.path.abspath(path)
+        stat = [st.st_size, st.st_mtime_ns]
+        if key in self.files and self.files[key][:2] == stat:
+            return self.files[key][2]
+
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK), b''):
+                h.update(block)
+        self.files[key] = stat + [h.hexdigest()]
+        return self.files[key][2]
+
+    def fingerprint(self, inputs, outputs, params=(), code=(), tools=()):
+
+        data = {'inputs': [[i, self.digest(i)] for i in inputs],
+                'outputs': list(outputs),
+                'params': [str(i) for i in params],
+                'code': [[os.path.basename(i), self.digest(i)]
+                         for i in self.code + list(code)],
+                'tools': [tool_version(i) for i in tools]}
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def stale(self, step, inputs, outputs, params=(), code=(), tools=()):
+        """
+        True if step has to run: its fingerprint changed or its outputs
+        are missing or modified. Call done(step) once it ran
+        """
+
+        if not self.enabled:
+            return self.overwrite or not all(output_exists(i) for i in outputs)
+
+        fp = self.fingerprint(inputs, outputs, params, code, tools)
+        rec = self.steps.get(step)
+        if (self.overwrite or rec is None or rec['fingerprint'] != fp or
+                any(not output_exists(i) for i in outputs
+                    if i not in rec.get('absent', [])) or
+                any(self.digest(i) != d for i, d in rec['outputs'].items())):
+            self.pending[step] = (fp, outputs)
+            return True
+        return False
+
+    def done(self, step, outputs=None):
+        """
+        Record step as run, outputs defaults to the outputs given to stale.
+        With an explicit list, outputs given to stale and not written by the
+        step (e.g. basins too small to be split) are not expected later
+        """
+
+        if not self.enabled:
+            return
+        fp, expected = self.pending.pop(step)
+        absent = []
+        if outputs is None:
+            outputs = expected
+        else:
+            absent = [i for i in expected if not output_exists(i)]
+        self.steps[step] = {'fingerprint': fp, 'absent': absent,
+                            'outputs': {i: self.digest(i) for i in outputs}}
+        self.save()
+
+    def save(self):
+
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'files': self.files, 'steps': self.steps}, f)
+        os.replace(tmp, self.fname)
+
+
+def tool_version(name):
+    """
+    Identify an external tool by its path, size and modification time
+    """
+
+    path = shutil.which(name)
+    if path is None:
+        return [name, None]
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+def code_files(module):
+    """
+    Source files of an lfptools module and of the lfptools modules it
+    imports, compiled extensions included
+    """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    found = []
+    todo = [module]
+    while todo:
+        name = todo.pop()
+        files = (glob.glob(os.path.join(folder, name + '.py')) or
+                 glob.glob(os.path.join(folder, name + '.*.so')) or
+                 glob.glob(os.path.join(folder, name + '.pyx')))
+        for fname in files:
+            if fname in found:
+                continue
+            found.append(fname)
+            if fname.endswith('.so'):
+                continue
+            with open(fname) as f:
+                src = f.read()
+            todo += re.findall(r'^\s*from lfptools\.(\w+) import', src, re.M)
+            todo += re.findall(r'^\s*from lfptools import (\w+)', src, re.M)
+    return sorted(found)
+
+
+def output_patterns(output):
+    """
+    Glob patterns of the files written by a stage with output path or
+    prefix output: the output itself, output.shp, output_name.tif, ... and
+    for an output with an extension (dem.tif) files such as dem_x2.tif
+    """
+
+    root, ext = os.path.splitext(output)
+    prefix = glob.escape(output)
+    patterns = [prefix, prefix + '.*', prefix + '_*']
+    if ext:
+        patterns.append(glob.escape(root) + '_*' + glob.escape(ext))
+    return patterns
+
+
+def stage_files(output):
+    """
+    Files written by a stage with output path or prefix output, or
+    everything in output if it is a folder
+    """
+
+    if os.path.isdir(output):
+        return [output]
+    return sorted(set(f for p in output_patterns(output) for f in glob.glob(p)))
+
+
+def output_exists(output):
+    """
+    True if output exists as a file or folder, or as a prefix of files
+    """
+
+    return os.path.exists(output) or len(stage_files(output)) > 0
+
+
+def input_files(value):
+    """
+    Files read through a config value: the file or folder itself and
+    files sharing its name with another extension (e.g. .dbf of a .shp)
+    """
+
+    if os.path.isdir(value):
+        return [value]
+    if not os.path.isfile(value):
+        return []
+    return sorted(set([value] + glob.glob(glob.escape(os.path.splitext(value)[0]) + '.*')))
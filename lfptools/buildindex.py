@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import os
+import sys
+import getopt
+import configparser
+import numpy as np
+from lfptools import session
+from lfptools.lazyimport import lazy_import
+gdal = lazy_import('osgeo.gdal')
+
+
+def buildindex_shell(argv):
+
+    myhelp = '''
+LFPtools v0.1
+
+Name
+----
+buildindex
+
+Description
+-----------
+Scan a global source (e.g. widths, bankfull discharge or depths) once and
+save an index of its valid pixels in a folder. Pixels are grouped in square
+buckets and stored as memory-mappable arrays, lfp-getwidths, lfp-getbankfullq
+and lfp-getdepths (depth_raster) load only the buckets overlapping a basin
+when `findex` is set in their config file
+
+Usage
+-----
+>> lfp-buildindex -i config.txt
+
+Content in config.txt
+---------------------
+[buildindex]
+source = Source file path GDAL format
+output = Output index folder
+minval = (Optional) Pixels larger than minval are stored, default NODATA value
+bucket = (Optional) Bucket size in pixels, default 1024
+'''
+
+    try:
+        opts, args = getopt.getopt(argv, "i:")
+        for o, a in opts:
+            if o == "-i":
+                inifile = a
+    except:
+        print(myhelp)
+        sys.exit(0)
+
+    config = configparser.SafeConfigParser({'minval': '', 'bucket': '1024'})
+    config.read(inifile)
+
+    source = str(config.get('buildindex', 'source'))
+    output = str(config.get('buildindex', 'output'))
+    minval = str(config.get('buildindex', 'minval'))
+    bucket = int(config.get('buildindex', 'bucket'))
+
+    if minval == '':
+        minval = None
+    else:
+        minval = np.float64(minval)
+
+    buildindex(source, output, minval, bucket)
+
+
+def buildindex(source, output, minval=None, bucket=1024):
+
+    print("    running buildindex.py...")
+
+    ds = gdal.Open(source)
+    band = ds.GetRasterBand(1)
+    gt = ds.GetGeoTransform()
+    nx = ds.RasterXSize
+    ny = ds.RasterYSize
+    nodata = band.GetNoDataValue()
+
+    if minval is None:
+        if nodata is None:
+            sys.exit('ERROR source has no NODATA value, minval is required')
+        minval = nodata
+
+    nbx = int(np.ceil(nx/float(bucket)))
+    nby = int(np.ceil(ny/float(bucket)))
+    counts = np.zeros(nbx*nby, dtype=np.int64)
+
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    fcol = open(os.path.join(output, 'col.bin'), 'wb')
+    frow = open(os.path.join(output, 'row.bin'), 'wb')
+    fval = open(os.path.join(output, 'val.bin'), 'wb')
+
+    # Buckets are scanned in key order so pixels are stored already sorted
+    # by bucket, and by row and column inside every bucket
+    dtype = None
+    for by in range(nby):
+        print("buildindex.py - " + str(nby-by))
+        r0 = by*bucket
+        h = min(bucket, ny - r0)
+        for bx in range(nbx):
+            c0 = bx*bucket
+            w = min(bucket, nx - c0)
+            dat = band.ReadAsArray(c0, r0, w, h)
+            if dtype is None:
+                dtype = dat.dtype
+            valid = dat > minval
+            if nodata is not None:
+                valid &= dat != nodata
+            iy, ix = np.where(valid)
+            (ix + c0).astype(np.int32).tofile(fcol)
+            (iy + r0).astype(np.int32).tofile(frow)
+            dat[iy, ix].astype(dtype).tofile(fval)
+            counts[by*nbx + bx] = iy.size
+
+    fcol.close()
+    frow.close()
+    fval.close()
+
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    np.savez(os.path.join(output, 'meta.npz'), geotransform=np.array(gt),
+             shape=np.array([ny, nx]), bucket=np.array([bucket, nbx, nby]),
+             minval=np.array(minval), dtype=np.array(np.dtype(dtype).str),
+             offsets=offsets)
+
+    print("    index with " + str(offsets[-1]) + " pixels written in " + output)
+
+
+def load_index(path, xmin, ymin, xmax, ymax, minval=None):
+    """
+    Returns x, y and value of the indexed pixels with centre inside the
+    window, as selected by gdalutils.clip_raster. Pixels are returned in
+    row and column order as np.where on the clipped raster. If minval is
+    given only values larger than minval are returned
+    """
+
+    meta, col, row, val = session.cached(('index', os.path.abspath(path)),
+                                         lambda: open_index(path),
+                                         os.path.join(path, 'meta.npz'))
+    gt = meta['geotransform']
+    ny, nx = meta['shape']
+    bucket, nbx, nby = meta['bucket']
+    offsets = meta['offsets']
+    n = int(offsets[-1])
+
+    if minval is not None and minval < meta['minval']:
+        print("WARNING index " + path + " only stores values larger than " +
+              str(meta['minval']))
+
+    # First and last pixel with centre inside the window
+    c = (np.array([xmin, xmax]) - gt[0])/gt[1] - 0.5
+    r = (np.array([ymax, ymin]) - gt[3])/gt[5] - 0.5
+    c0 = max(int(np.ceil(c[0])), 0)
+    c1 = min(int(np.floor(c[1])), nx-1)
+    r0 = max(int(np.ceil(r[0])), 0)
+    r1 = min(int(np.floor(r[1])), ny-1)
+
+    dtype = np.dtype(str(meta['dtype']))
+    if c0 > c1 or r0 > r1 or n == 0:
+        empty = np.array([], dtype=np.float64)
+        return empty, empty, np.array([], dtype=dtype)
+
+    # Buckets of a row of buckets are contiguous on disk
+    bx0 = c0//bucket
+    bx1 = c1//bucket
+    cols = []
+    rows = []
+    vals = []
+    for by in range(r0//bucket, r1//bucket + 1):
+        a = offsets[by*nbx + bx0]
+        b = offsets[by*nbx + bx1 + 1]
+        cols.append(np.array(col[a:b]))
+        rows.append(np.array(row[a:b]))
+        vals.append(np.array(val[a:b]))
+    cols = np.concatenate(cols)
+    rows = np.concatenate(rows)
+    vals = np.concatenate(vals)
+
+    keep = (cols >= c0) & (cols <= c1) & (rows >= r0) & (rows <= r1)
+    if minval is not None:
+        keep &= vals > minval
+    cols = cols[keep]
+    rows = rows[keep]
+    vals = vals[keep]
+
+    order = np.lexsort((cols, rows))
+    cols = cols[order]
+    rows = rows[order]
+
+    x = gt[0] + gt[1]*(cols + 0.5)
+    y = gt[3] + gt[5]*(rows + 0.5)
+    return x, y, vals[order]
+
+
+def open_index(path):
+    """
+    Metadata and memory-mapped col, row and value arrays of an index
+    """
+
+    with np.load(os.path.join(path, 'meta.npz')) as data:
+        meta = {key: data[key] for key in data.files}
+    n = int(meta['offsets'][-1])
+    if n == 0:
+        return meta, None, None, None
+    dtype = np.dtype(str(meta['dtype']))
+    col = np.memmap(os.path.join(path, 'col.bin'), dtype=np.int32, mode='r', shape=(n,))
+    row = np.memmap(os.path.join(path, 'row.bin'), dtype=np.int32, mode='r', shape=(n,))
+    val = np.memmap(os.path.join(path, 'val.bin'), dtype=dtype, mode='r', shape=(n,))
+    return meta, col, row, val
+
+
+if __name__ == '__main__':
+    buildindex_shell(sys.argv[1:])
@@ -11,7 +11,9 @@ import subprocess
 import configparser
 import numpy as np
 import pandas as pd
-import gdalutils
+from lfptools import stageio
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
 
 
 def buildmodel_shell(argv):
@@ -51,7 +53,7 @@ def buildmodel_shell(argv):
 
     buildmodel(parlfp, bcilfp, bdylfp, runcsv, evaplfp, gaugelfp, stagelfp,
                demtif, dembnktif, dembnktif_1D, fixbnktif, wdttif,
-               bedtif, dirtif, reccsv, date1, date2, d8dir=d8dirn,prescribeDirn=prescribeDirn,chantif=chantif)
+               bedtif, dirtif, reccsv, date1, date2, d8dirn=d8dirn,prescribeDirn=prescribeDirn,chantif=chantif)
 
 
 def buildmodel(parlfp, bcilfp, bdylfp, runcsv, evaplfp, gaugelfp, stagelfp,
@@ -63,6 +65,15 @@ def buildmodel(parlfp, bcilfp, bdylfp, runcsv, evaplfp, gaugelfp, stagelfp,
     t = (pd.to_datetime(date2, format='%Y-%m-%d') - pd.to_datetime(date1,
                                                                    format='%Y-%m-%d')).days + 1  # +1 to take into account the first date
 
+    # Stage files and frames (e.g. from lfp-fixelevs, lfp-getwidths,
+    # lfp-getbedelevs) are burnt in the DEM grid and written as GeoTIFF
+    # next to the .par file
+    geo = gdalutils.get_geo(demtif)
+    root = os.path.splitext(parlfp)[0]
+    fixbnktif = stage_tif(fixbnktif, geo, root + '_bnkfix.tif')
+    wdttif = stage_tif(wdttif, geo, root + '_wdt.tif')
+    bedtif = stage_tif(bedtif, geo, root + '_bed.tif')
+
     write_bci(bcilfp, runcsv)
     write_bdy(bdylfp, runcsv, t)
     write_evap(evaplfp, t)
@@ -76,6 +87,23 @@ def buildmodel(parlfp, bcilfp, bdylfp, runcsv, evaplfp, gaugelfp, stagelfp,
               stagelfp, dembnktif, wdttif, bedtif, t,chantif,d8dirn,prescribeDirn)
 
 
+def stage_tif(fname, geo, fout):
+    """
+    Returns fname if it is a raster, otherwise burns the stage file or
+    frame in the grid geo, writes it in fout and returns fout
+    """
+
+    if not stageio.is_stage(fname):
+        return fname
+
+    print("     burning stage in " + fout + "...")
+
+    nodata = -9999
+    dat = stageio.stage_raster(fname, geo, nodata=nodata)
+    gdalutils.write_raster(dat, fout, geo, "Float32", nodata)
+    return fout
+
+
 def write_gauge_stage_all_cells(reccsv, dirtif, wdttif, gaugelfp, stagelfp):
 
     print("     writing gauge and stage files...")
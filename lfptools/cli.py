@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import os
+import sys
+import json
+import time
+import getopt
+import uuid
+import fcntl
+import importlib
+import traceback
+from lfptools import session
+from lfptools.run import STAGES
+
+# Commands of lfp: every tool, module and shell function
+COMMANDS = {name: (module, shell) for name, (module, shell, outputs) in STAGES.items()}
+COMMANDS['run'] = ('run', 'run_shell')
+COMMANDS['batch'] = ('batch', 'batch_shell')
+
+myhelp = '''
+LFPtools v0.1
+
+Name
+----
+lfp
+
+Description
+-----------
+Single entry point to all tools, `lfp <tool> -i config.txt` is the same
+as `lfp-<tool> -i config.txt`.
+
+A worker runs the jobs submitted to a spool folder in a single process,
+imports and global datasets opened by the tools (rasters sampled by
+lfp-getwidths, lfp-getbankelevs, ..., indexes of lfp-buildindex and
+netCDF files of lfp-getdischarge) are kept between jobs. Datasets are
+opened again when their file changes, restart workers to pick up code
+changes. Several workers can share a spool folder.
+
+Usage
+-----
+>> lfp <tool> -i config.txt
+>> lfp worker -d spool [-n jobs]
+>> lfp submit -d spool [-w] <tool> -i config.txt
+
+worker -d : Spool folder to take jobs from
+       -n : (Optional) Exit after running n jobs, default run until stopped
+submit -d : Spool folder of the workers
+       -w : (Optional) Wait for the job, print its output and exit with its
+            status
+
+Jobs run in the folder lfp submit was called from, the output of a job is
+written in spool/<job>.log and its status in spool/<job>.done or
+spool/<job>.failed. A job being run is renamed to spool/<job>.run and
+locked by its worker, jobs of workers that died are put back in the queue
+by the other workers (spool should be on a local file system for locks)
+
+Tools
+-----
+''' + '\n'.join(sorted(COMMANDS)) + '\n'
+
+
+def main(argv):
+
+    if len(argv) == 0 or argv[0] in ('-h', '--help'):
+        print(myhelp)
+        sys.exit(0)
+
+    name = argv[0]
+    if name == 'worker':
+        worker_shell(argv[1:])
+    elif name == 'submit':
+        submit_shell(argv[1:])
+    elif name in COMMANDS:
+        shell_function(name)(argv[1:])
+    else:
+        sys.exit('ERROR tool not recognised: ' + name)
+
+
+def shell_function(name):
+    """
+    Shell function of a tool, its module is imported on first use
+    """
+
+    module, shell = COMMANDS[name]
+    return getattr(importlib.import_module('lfptools.' + module), shell)
+
+
+def worker_shell(argv):
+
+    spool = None
+    njobs = 0
+    try:
+        opts, args = getopt.getopt(argv, "d:n:")
+        for o, a in opts:
+            if o == "-d":
+                spool = a
+            if o == "-n":
+                njobs = int(a)
+    except:
+        print(myhelp)
+        sys.exit(0)
+    if spool is None:
+        sys.exit('ERROR spool folder required: lfp worker -d spool')
+
+    worker(spool, njobs)
+
+
+def worker(spool, njobs=0, poll=0.2):
+    """
+    Run jobs from spool in this process until stopped, or until njobs
+    jobs ran if njobs > 0. Jobs left by workers that died are requeued
+    when there is nothing else to run
+    """
+
+    print("    running worker in " + spool + "...")
+
+    if not os.path.exists(spool):
+        os.makedirs(spool)
+    session.start()
+
+    count = 0
+    while njobs <= 0 or count < njobs:
+        claimed = claim_job(spool)
+        if claimed is None:
+            for job in requeue_jobs(spool):
+                print("    " + job + " requeued")
+            time.sleep(poll)
+            continue
+        job, lock = claimed
+        count += 1
+        try:
+            status = run_job(spool, job)
+        except Exception:
+            # A bad job (e.g. unreadable spec) fails alone
+            traceback.print_exc()
+            status = finish_job(spool, job, 1, 0)
+        finally:
+            lock.close()
+        print("    " + job + " " + status['status'] + " in " +
+              "%.1f" % status['seconds'] + " s")
+
+
+def claim_job(spool):
+    """
+    Take the oldest job in spool, jobs are locked and renamed from
+    <job>.job to <job>.run so every job is taken by one worker only.
+    Returns the job and its locked file, to be closed once the job ran
+    """
+
+    jobs = sorted(i for i in os.listdir(spool) if i.endswith('.job'))
+    for fname in jobs:
+        job = fname[:-4]
+        lock = lock_file(os.path.join(spool, fname))
+        if lock is None:
+            continue
+        try:
+            os.rename(os.path.join(spool, fname), os.path.join(spool, job + '.run'))
+        except OSError:
+            lock.close()
+            continue
+        return job, lock
+    return None
+
+
+def requeue_jobs(spool):
+    """
+    Rename spool/<job>.run back to spool/<job>.job for jobs not locked by
+    a worker, their worker died. Returns the jobs requeued
+    """
+
+    jobs = []
+    for fname in sorted(os.listdir(spool)):
+        if not fname.endswith('.run'):
+            continue
+        job = fname[:-4]
+        lock = lock_file(os.path.join(spool, fname))
+        if lock is None:
+            continue
+        try:
+            os.rename(os.path.join(spool, fname), os.path.join(spool, job + '.job'))
+            jobs.append(job)
+        except OSError:
+            pass
+        finally:
+            lock.close()
+    return jobs
+
+
+def lock_file(fname):
+    """
+    Open fname with an exclusive lock, None if it is gone or locked by
+    another process. The lock is released when the file is closed
+    """
+
+    try:
+        f = open(fname)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def run_job(spool, job):
+    """
+    Run a claimed job in this process with its output (file descriptors
+    1 and 2, so external tools too) written to spool/<job>.log
+    """
+
+    base = os.path.join(os.path.abspath(spool), job)
+    with open(base + '.run') as f:
+        spec = json.load(f)
+
+    # Datasets modified by previous jobs are opened again
+    session.refresh()
+
+    cwd = os.getcwd()
+    log = open(base + '.log', 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    t0 = time.time()
+    code = 0
+    try:
+        os.chdir(spec['cwd'])
+        argv = spec['argv']
+        if argv[0] not in COMMANDS:
+            raise SystemExit('ERROR tool not recognised: ' + argv[0])
+        shell_function(argv[0])(argv[1:])
+    except SystemExit as e:
+        if isinstance(e.code, str):
+            print(e.code, file=sys.stderr)
+            code = 1
+        else:
+            code = e.code or 0
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        log.close()
+        os.chdir(cwd)
+
+    return finish_job(spool, job, code, time.time() - t0)
+
+
+def finish_job(spool, job, code, seconds):
+    """
+    Write the status of a job in spool/<job>.done or spool/<job>.failed
+    and remove spool/<job>.run. Returns the status
+    """
+
+    base = os.path.join(os.path.abspath(spool), job)
+    status = {'status': 'done' if code == 0 else 'failed', 'exit': code,
+              'seconds': seconds}
+    ext = '.done' if code == 0 else '.failed'
+    with open(base + ext + '.tmp', 'w') as f:
+        json.dump(status, f)
+    os.replace(base + ext + '.tmp', base + ext)
+    try:
+        os.remove(base + '.run')
+    except FileNotFoundError:
+        pass
+    return status
+
+
+def submit_shell(argv):
+
+    spool = None
+    wait = False
+    try:
+        opts, args = getopt.getopt(argv, "d:w")
+        for o, a in opts:
+            if o == "-d":
+                spool = a
+            if o == "-w":
+                wait = True
+    except:
+        print(myhelp)
+        sys.exit(0)
+    if spool is None or len(args) == 0:
+        sys.exit('ERROR usage: lfp submit -d spool [-w] <tool> -i config.txt')
+    if args[0] not in COMMANDS:
+        sys.exit('ERROR tool not recognised: ' + args[0])
+
+    job = submit(spool, args)
+    print(job)
+    if wait:
+        status = wait_job(spool, job)
+        with open(os.path.join(spool, job + '.log')) as f:
+            sys.stdout.write(f.read())
+        sys.exit(status['exit'])
+
+
+def submit(spool, argv, cwd=None):
+    """
+    Add a job to spool, argv is the command line of lfp (tool and
+    options). Returns the job name
+    """
+
+    if not os.path.exists(spool):
+        os.makedirs(spool)
+    job = time.strftime('%Y%m%d%H%M%S') + '_' + uuid.uuid4().hex[:8]
+    base = os.path.join(spool, job)
+    with open(base + '.tmp', 'w') as f:
+        json.dump({'argv': list(argv), 'cwd': os.path.abspath(cwd or os.getcwd())}, f)
+    os.replace(base + '.tmp', base + '.job')
+    return job
+
+
+def wait_job(spool, job, poll=0.2):
+    """
+    Wait for a job to finish, returns its status
+    """
+
+    base = os.path.join(spool, job)
+    while True:
+        for ext in ('.done', '.failed'):
+            if os.path.exists(base + ext):
+                with open(base + ext) as f:
+                    return json.load(f)
+        time.sleep(poll)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
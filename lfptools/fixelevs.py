@@ -4,19 +4,16 @@
 # auth: jeison sosa
 # mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
 
-import os
 import sys
 import getopt
 import subprocess
 import configparser
 import numpy as np
-import pandas as pd
-import geopandas as gpd
-from lfptools import shapefile
-from lfptools import misc_utils
-import statsmodels.api as sm
-import gdalutils
-from osgeo import osr
+from lfptools import stageio
+from lfptools.lazyimport import lazy_import
+gpd = lazy_import('geopandas')
+sm = lazy_import('statsmodels.api')
+gdalutils = lazy_import('gdalutils')
 
 
 def fixelevs_shell(argv):
@@ -46,7 +43,10 @@ recf   = `Rec` file path
 netf   = Target mask file path
 proj   = Output projection in Proj4 format
 method = yamazaki, lowless
-source = Shapefile input file to fix (e.g from lfp-getbankelevs)
+source = Shapefile or stage file to fix (e.g from lfp-getbankelevs)
+stage  = (Optional) Stage file format [npz|parquet|feather], writes
+         output.<format> to be read by downstream stages
+export = (Optional) Comma separated exports [shp,tif|shp|none], default shp,tif
 '''
 
     try:
@@ -58,7 +58,7 @@ source = Shapefile input file to fix (e.g from lfp-getbankelevs)
         print(myhelp)
         sys.exit(0)
 
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'stage': '', 'export': 'shp,tif'})
     config.read(inifile)
 
 
@@ -82,10 +82,12 @@ source = Shapefile input file to fix (e.g from lfp-getbankelevs)
     recf = str(config.get('fixelevs', 'recf'))
     proj = str(config.get('fixelevs', 'proj'))
     method = str(config.get('fixelevs', 'method'))
+    stage = str(config.get('fixelevs', 'stage'))
+    export = stageio.parse_export(config.get('fixelevs', 'export'))
 
-    fixelevs(source,output,netf,recf,proj,method)
+    fixelevs(source,output,netf,recf,proj,method,stage,export)
 
-def fixelevs(source,output,netf,recf,proj,method):
+def fixelevs(source,output,netf,recf,proj,method,stage='',export=stageio.EXPORTS):
 
     print("    running fixelevs.py...")
 
@@ -93,20 +95,19 @@ def fixelevs(source,output,netf,recf,proj,method):
     geo = gdalutils.get_geo(netf)
 
     # Reading XXX_rec.csv file
-    rec = pd.read_csv(recf)
+    rec = stageio.read_rec(recf)
 
-    # Reading XXX_bnk.shp file
-    bnk_gdf = gpd.read_file(source)
+    if stageio.is_stage(source):
+        # Retrieving bank elevations from XXX_bnk stage file, aligned
+        # to rec by index
+        rec['bnk'] = stageio.read_stage(source)['elev'].reindex(rec.index).astype(float)
+    else:
+        # Reading XXX_bnk.shp file
+        bnk_gdf = gpd.read_file(source)
 
-    # Initiate output shapefile
-    w = shapefile.Writer(shapefile.POINT)
-    w.field('x')
-    w.field('y')
-    w.field('elevadj')
-
-    # Retrieving bank elevations from XXX_bnk.shp file
-    # Values are stored in rec['bnk']
-    rec['bnk'] = bnk_gdf['elev'].astype(float)
+        # Retrieving bank elevations from XXX_bnk.shp file
+        # Values are stored in rec['bnk']
+        rec['bnk'] = bnk_gdf['elev'].astype(float)
 
     # Adjusting bank values, resulting values
     # are stored in rec['bnk_adj']
@@ -126,25 +127,19 @@ def fixelevs(source,output,netf,recf,proj,method):
             sys.exit('Method not recognised')
         rec['bnk_adj'][ids] = adjusted_dem
 
-    # Writing .shp resulting file
-    for i in rec.index:
-        w.point(rec['lon'][i], rec['lat'][i])
-        w.record(rec['lon'][i], rec['lat'][i], rec['bnk_adj'][i])
-    w.save("%s.shp" % output)
-
-    # write .prj file
-    prj = open("%s.prj" % output, "w")
-    srs = osr.SpatialReference()
-    srs.ImportFromProj4(proj)
-    prj.write(srs.ExportToWkt())
-    prj.close()
-
-    nodata = -9999
-    fmt = "GTiff"
-    name1 = output+".shp"
-    name2 = output+".tif"
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-co", "COMPRESS=DEFLATE", "-tr",
-                     str(geo[6]), str(geo[7]), "-a", "elevadj", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
+    # Writing stage file and .shp resulting file
+    frame = stageio.write_outputs(output, proj, rec.index, rec['lon'], rec['lat'],
+                                  [('elevadj', rec['bnk_adj'])], stage, export)
+
+    if output is not None and 'tif' in export:
+        nodata = -9999
+        fmt = "GTiff"
+        name1 = output+".shp"
+        name2 = output+".tif"
+        subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-co", "COMPRESS=DEFLATE", "-tr",
+                         str(geo[6]), str(geo[7]), "-a", "elevadj", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
+
+    return frame
 
 
 def bank4flood(dem):
@@ -9,13 +9,12 @@ import getopt
 import subprocess
 import configparser
 import numpy as np
-import pandas as pd
-from lfptools import shapefile
-import gdalutils
-import gdalutils.extras.haversine as haversine
-from osgeo import osr
-from scipy.ndimage import distance_transform_edt
-from scipy.spatial.distance import cdist
+from lfptools import sampling
+from lfptools import stageio
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
+ndimage = lazy_import('scipy.ndimage')
+distance = lazy_import('scipy.spatial.distance')
 
 
 def getbankelevs_shell(argv):
@@ -49,6 +48,10 @@ method   = Reductions available near, mean, min, meanmin
 hrnodata = NODATA value for high resolution DEM
 thresh   = Saerching threshold in degrees
 hrdemf   = High resolution DEM
+nproc    = Number of cores to use (Optional, default 1)
+stage    = (Optional) Stage file format [npz|parquet|feather], writes
+           output.<format> to be read by downstream stages
+export   = (Optional) Comma separated exports [shp,tif|shp|none], default shp,tif
 '''
 
     try:
@@ -60,7 +63,8 @@ hrdemf   = High resolution DEM
         print(myhelp)
         sys.exit(0)
 
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'outlier': 'no', 'nproc': '1',
+                                            'stage': '', 'export': 'shp,tif'})
     config.read(inifile)
 
     output = str(config.get('getbankelevs', 'output'))
@@ -68,89 +72,68 @@ hrdemf   = High resolution DEM
     netf = str(config.get('getbankelevs', 'netf'))
     hrdemf = str(config.get('getbankelevs', 'hrdemf'))
 
-    try:
-        outlier = str(config.get('getbankelevs', 'outlier'))
-    except:
-        pass
+    outlier = str(config.get('getbankelevs', 'outlier'))
 
     proj = str(config.get('getbankelevs', 'proj'))
     method = str(config.get('getbankelevs', 'method'))
     hrnodata = np.float64(config.get('getbankelevs', 'hrnodata'))
     thresh = np.float64(config.get('getbankelevs', 'thresh'))
+    nproc = int(config.get('getbankelevs', 'nproc'))
+    stage = str(config.get('getbankelevs', 'stage'))
+    export = stageio.parse_export(config.get('getbankelevs', 'export'))
 
-    getbankelevs(output,recf,netf,hrdemf,proj,method,hrnodata,thresh,outlier)
+    getbankelevs(output,recf,netf,hrdemf,proj,method,hrnodata,thresh,outlier,nproc,stage,export)
 
-def getbankelevs(output,recf,netf,hrdemf,proj,method,hrnodata,thresh,outlier):
+def getbankelevs(output,recf,netf,hrdemf,proj,method,hrnodata,thresh,outlier='no',nproc=1,
+                 stage='',export=stageio.EXPORTS):
 
     print("    running getbankelevs.py...")
 
     fname = output
 
-    w = shapefile.Writer(shapefile.POINT)
-    w.field('x')
-    w.field('y')
-    w.field('elev')
-
     # Coordinates for bank elevations are based on the Rec file
-    rec = pd.read_csv(recf)
-
-    for x, y in zip(rec['lon'], rec['lat']):
-
-        xmin = x - thresh
-        ymin = y - thresh
-        xmax = x + thresh
-        ymax = y + thresh
+    rec = stageio.read_rec(recf)
 
-        dem, dem_geo = gdalutils.clip_raster(hrdemf, xmin, ymin, xmax, ymax)
-        ddem = np.ma.masked_where(dem == hrnodata, dem)
+    if method not in ['near', 'mean', 'min', 'meanmin']:
+        sys.exit('ERROR method not recognised: ' + method)
 
-        if method == 'near':
-            nodata = dem_geo[11]
-            dfdem = gdalutils.array_to_pandas(dem, dem_geo, nodata, 'gt')
-            arr = haversine.haversine_array(np.array(dfdem['y'].values, dtype='float32'), np.float32(
-                dfdem['x'].values), np.float32(y), np.float32(x))
-            dfdem['dis'] = np.array(arr)
-            dfdem.sort_values(by='dis', inplace=True)
-            elev = dfdem.iloc[0, 2]
+    elevs = sampling.run_points(bank_elevs, (rec['lon'].values, rec['lat'].values),
+                                nproc=nproc, groups=rec['link'].values,
+                                args=(hrdemf, method, hrnodata, thresh, outlier))
 
-        elif method == 'meanmin':
-            if outlier == "yes":
-                ddem = check_outlier(dem, ddem, hrnodata, 3.5)
-            elev = np.mean([ddem.mean(), ddem.min()])
+    # Write stage file and final file in a shapefile, only points with
+    # an elevation are written
+    valid = np.isfinite(elevs)
+    frame = stageio.write_outputs(fname, proj, rec.index[valid], rec['lon'].values[valid],
+                                  rec['lat'].values[valid], [('elev', elevs[valid])],
+                                  stage, export)
 
-        elif method == 'mean':
-            if outlier == "yes":
-                ddem = check_outlier(dem, ddem, hrnodata, 3.5)
-            elev = ddem.mean()
+    if output is not None and 'tif' in export:
+        geo = gdalutils.get_geo(netf)
 
-        elif method == 'min':
-            if outlier == "yes":
-                ddem = check_outlier(dem, ddem, hrnodata, 3.5)
-            elev = ddem.min()
+        fmt = "GTiff"
+        nodata = -9999
+        bnkname1 = output+".shp"
+        bnkname2 = output+".tif"
+        subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-co", "COMPRESS=DEFLATE", "-tr", str(geo[6]), str(geo[7]), "-a",
+                         "elev", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), bnkname1, bnkname2])
 
-        # Write final file in a shapefile
+    return frame
 
-        if np.isfinite(elev):
-            w.point(x, y)
-            w.record(x, y, elev)
 
-    w.save("%s.shp" % fname)
-
-    # Write .prj file
-    prj = open("%s.prj" % fname, "w")
-    srs = osr.SpatialReference()
-    srs.ImportFromProj4(proj)
-    prj.write(srs.ExportToWkt())
-    prj.close()
-
-    geo = gdalutils.get_geo(netf)
+def bank_elevs(reader, xx, yy, hrdemf, method, hrnodata, thresh, outlier):
+    """
+    Reduce the high resolution DEM in a window of size thresh around
+    every point, NaN where the window has no valid pixels
+    """
 
-    fmt = "GTiff"
-    nodata = -9999
-    bnkname1 = output+".shp"
-    bnkname2 = output+".tif"
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-co", "COMPRESS=DEFLATE", "-tr", str(geo[6]), str(geo[7]), "-a",
-                     "elev", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), bnkname1, bnkname2])
+    elevs = np.ones(len(xx))*np.nan
+    reducer = sampling.REDUCERS[method]
+    for i, (x, y) in enumerate(zip(xx, yy)):
+        dem, dem_geo = reader.window(hrdemf, x, y, thresh)
+        elevs[i] = reducer(dem, dem_geo, x, y, hrnodata=hrnodata,
+                           outlier=outlier)
+    return elevs
 
 
 def nearivpixel(ddem, rriv, ddsx, ddsy, XA):
@@ -164,14 +147,14 @@ def nearivpixel(ddem, rriv, ddsx, ddsy, XA):
     # if there are river pixels in the window
     if _ds[0].size > 0:
         XB = np.vstack((ddsy[_ds[0]], ddsx[_ds[1]])).T
-        ind = np.int(cdist(XA, XB, metric='euclidean').argmin())
+        ind = np.int(distance.cdist(XA, XB, metric='euclidean').argmin())
         elev = ddem[_ds[0][ind], _ds[1][ind]]
 
     # otherwise take nearest value from land
     elif np.where(rriv == 0)[0].size > 0:
         _ds = np.where(rriv == 0)
         XB = np.vstack((ddsy[_ds[0]], ddsx[_ds[1]])).T
-        ind = np.int(cdist(XA, XB, metric='euclidean').argmin())
+        ind = np.int(distance.cdist(XA, XB, metric='euclidean').argmin())
         elev = ddem[_ds[0][ind], _ds[1][ind]]
 
     # should be checked
@@ -208,7 +191,7 @@ def avgedgpixel(ddem, rriv):
 
     # if there are river pixels in the window
     if _ds[0].size > 0:
-        euclidis = distance_transform_edt(1-rriv)
+        euclidis = ndimage.distance_transform_edt(1-rriv)
         elev = np.mean([np.ma.masked_where(euclidis == 1, ddem).mean(
         ), np.ma.masked_where(euclidis == 1, ddem).min()])
     # otherwise
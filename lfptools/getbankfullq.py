@@ -10,11 +10,12 @@ import subprocess
 import configparser
 import getopt
 import numpy as np
-import pandas as pd
-import gdalutils
-from lfptools import shapefile
 from lfptools import misc_utils
-from osgeo import osr
+from lfptools import sampling
+from lfptools import stageio
+from lfptools.buildindex import load_index
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
 
 
 def getbankfullq_shell(argv):
@@ -43,6 +44,12 @@ recf   = `Rec` file path
 netf   = Target mask file path
 proj   = Output projection in Proj4 format
 fbankfullq = Source bankfull Q file path GDAL(TIF) format
+nproc  = Number of cores to use (Optional, default 1)
+findex = (Optional) Index of fbankfullq from lfp-buildindex, valid pixels of
+         the basin are loaded from it instead of reading fbankfullq
+stage  = (Optional) Stage file format [npz|parquet|feather], writes
+         output.<format> to be read by downstream stages
+export = (Optional) Comma separated exports [shp,tif|shp|none], default shp,tif
 '''
 
     try:
@@ -54,7 +61,8 @@ fbankfullq = Source bankfull Q file path GDAL(TIF) format
         print(myhelp)
         sys.exit(0)
 
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'nproc': '1', 'findex': '',
+                                            'stage': '', 'export': 'shp,tif'})
     config.read(inifile)
 
     recf = str(config.get('getbankfullq', 'recf'))
@@ -63,85 +71,75 @@ fbankfullq = Source bankfull Q file path GDAL(TIF) format
     fbankfullq = str(config.get('getbankfullq', 'fbankfullq'))
     output = str(config.get('getbankfullq', 'output'))
     thresh = np.float64(config.get('getbankfullq', 'thresh'))
+    nproc = int(config.get('getbankfullq', 'nproc'))
+    findex = str(config.get('getbankfullq', 'findex'))
+    stage = str(config.get('getbankfullq', 'stage'))
+    export = stageio.parse_export(config.get('getbankfullq', 'export'))
 
-    getbankfullq(recf, netf, proj, fbankfullq, output, thresh)
+    getbankfullq(recf, netf, proj, fbankfullq, output, thresh, nproc, findex, stage, export)
 
 
-def getbankfullq(recf, netf, proj, fbankfullq, output, thresh):
+def getbankfullq(recf, netf, proj, fbankfullq, output, thresh, nproc=1, findex='',
+                 stage='', export=stageio.EXPORTS):
 
     print("    running getbankfullq.py...")
 
-    w = shapefile.Writer(shapefile.POINT)
-    w.field('x')
-    w.field('y')
-    w.field('bankfullq')
-
     # Reading XXX_rec.csv file
-    rec = pd.read_csv(recf)
+    rec = stageio.read_rec(recf)
 
     # Get nearest bankfullq from datasource
     # Uses Euclidean distance to find nearest point in source
     # `try` included since it may happen that the bankfullq database doesn't
     # contains data in the basin if that is the case all values are assigned
     # 0 Q
-    bankfullq = []
-    for x, y in zip(rec['lon'], rec['lat']):
-
-        xmin = x - thresh
-        ymin = y - thresh
-        xmax = x + thresh
-        ymax = y + thresh
-
-        dat, geo = gdalutils.clip_raster(fbankfullq, xmin, ymin, xmax, ymax)
-        iy, ix = np.where(dat > 0)
-        xdat = geo[8][ix]
-        ydat = geo[9][iy]
-
-        try:
-            dis, ind = misc_utils.near_euc(xdat, ydat, (x, y))
-            val = dat[iy[ind], ix[ind]]
-            bankfullq.append(val)
-        except ValueError:
-            bankfullq.append(np.nan)
+    if findex:
+        lon = rec['lon'].values
+        lat = rec['lat'].values
+        xdat, ydat, vdat = load_index(findex, lon.min() - thresh, lat.min() - thresh,
+                                      lon.max() + thresh, lat.max() + thresh,
+                                      minval=0)
+        bankfullq = sampling.nearest_radius(xdat, ydat, vdat, lon, lat, thresh)
+    else:
+        bankfullq = sampling.run_points(nearest_bankfullq,
+                                        (rec['lon'].values, rec['lat'].values),
+                                        nproc=nproc, groups=rec['link'].values,
+                                        args=(fbankfullq, thresh))
 
     rec['bankfullq'] = bankfullq
 
     # Group river network per link
-    # If there are more NaN than real values, all values in link are equal to 30
+    # If there are more NaN than real values, all values in link are equal to 0
     # Otherwise, interpolate real values to fill NaNs
-    def check_bankfullq(a):
-        b = a.copy()
-        c = b.isnull()
-        falses = c.sum()
-        trues = c.count() - falses
-        if trues >= falses:
-            return a.interpolate(limit_direction='both')
-        else:
-            b.loc[:] = 0
-            return b
-    rec.loc[:, 'bankfullq'] = rec.groupby('link').bankfullq.apply(check_bankfullq)
-
-   # Writing .shp resulting file
-    for x, y, bankfullq in zip(rec['lon'], rec['lat'], rec['bankfullq']):
-        w.point(x, y)
-        w.record(x, y, bankfullq)
-    w.save("%s.shp" % output)
-
-    # write .prj file
-    prj = open("%s.prj" % output, "w")
-    srs = osr.SpatialReference()
-    srs.ImportFromProj4(proj)
-    prj.write(srs.ExportToWkt())
-    prj.close()
-
-    geo = gdalutils.get_geo(netf)
-
-    fmt = "GTiff"
-    nodata = -9999
-    name1 = output+".shp"
-    name2 = output+".tif"
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-co", "COMPRESS=DEFLATE","-tr", str(geo[6]), str(geo[7]),
-                     "-a", "bankfullq", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
+    rec['bankfullq'] = misc_utils.fill_links(rec['bankfullq'].values, rec['link'].values, 0)
+
+   # Writing stage file and .shp resulting file
+    frame = stageio.write_outputs(output, proj, rec.index, rec['lon'], rec['lat'],
+                                  [('bankfullq', rec['bankfullq'])], stage, export)
+
+    if output is not None and 'tif' in export:
+        geo = gdalutils.get_geo(netf)
+
+        fmt = "GTiff"
+        nodata = -9999
+        name1 = output+".shp"
+        name2 = output+".tif"
+        subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-co", "COMPRESS=DEFLATE","-tr", str(geo[6]), str(geo[7]),
+                         "-a", "bankfullq", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
+
+    return frame
+
+
+def nearest_bankfullq(reader, xx, yy, fbankfullq, thresh):
+    """
+    Nearest positive bankfull discharge in a window of size thresh
+    around every point, NaN where there is none
+    """
+
+    bankfullq = np.ones(len(xx))*np.nan
+    for i, (x, y) in enumerate(zip(xx, yy)):
+        bankfullq[i] = sampling.search_nearest(reader, fbankfullq, x, y, thresh,
+                                               minval=0)
+    return bankfullq
 
 
 if __name__ == '__main__':
@@ -4,17 +4,15 @@
 # auth: jeison sosa
 # mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
 
-import os
 import sys
 import getopt
-import subprocess
 import configparser
 import numpy as np
-from osgeo import osr
-import geopandas as gpd
-import gdalutils
-from shapely.geometry import Point
-from scipy.spatial.distance import cdist
+import pandas as pd
+from lfptools import misc_utils
+from lfptools import stageio
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
 
 
 def getbedelevs_shell(argv):
@@ -40,8 +38,12 @@ Content in config.txt
 output = Shapefile output file path
 netf   = Target mask file path
 proj   = Output projection in Proj4 format
-bnkf   = Shapefile input bank
-dptf   = Shapefile input depth
+bnkf   = Shapefile or stage file input bank
+dptf   = Shapefile or stage file input depth
+stage  = (Optional) Stage file format [npz|parquet|feather], writes
+         output.<format> to be read by downstream stages, bnkf has to
+         be a stage file
+export = (Optional) Comma separated exports [shp,tif|shp|none], default shp,tif
 '''
 
     try:
@@ -53,7 +55,7 @@ dptf   = Shapefile input depth
         print(myhelp)
         sys.exit(0)
 
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'stage': '', 'export': 'shp,tif'})
     config.read(inifile)
 
     bnkf = str(config.get('getbedelevs', 'bnkf'))
@@ -61,40 +63,48 @@ dptf   = Shapefile input depth
     netf = str(config.get('getbedelevs', 'netf'))
     output = str(config.get('getbedelevs', 'output'))
     proj = str(config.get('getbedelevs', 'proj'))
+    stage = str(config.get('getbedelevs', 'stage'))
+    export = stageio.parse_export(config.get('getbedelevs', 'export'))
 
-    getbedelevs(bnkf,dptf,netf,output,proj)
+    getbedelevs(bnkf,dptf,netf,output,proj,stage,export)
 
-def getbedelevs(bnkf,dptf,netf,output,proj):
+def getbedelevs(bnkf,dptf,netf,output,proj,stage='',export=stageio.EXPORTS):
 
     print("    running getbedelevs.py...")
 
-    bnk = gpd.read_file(bnkf)
-    dpt = gpd.read_file(dptf)
+    xb, yb, elevadj, indb = stageio.read_values(bnkf)
+    if stage and output is not None and indb is None:
+        sys.exit('ERROR bnkf has to be a stage file to write a stage file')
+    xd, yd, dpt, indd = stageio.read_values(dptf)
     print('loaded data')
 
     print('calculating bed from banks and depth')
-    bnk['bedelev'] = bnk['elevadj'].astype(np.float32) - dpt['depth'].astype(np.float32)
-    print(bnk.keys())
-#    print(bnk['bedelev'])
+    geo = gdalutils.get_geo(netf)
+    if indb is not None and indd is not None:
+        # Depths are matched to banks by `rec` index
+        ind = pd.Index(indd).get_indexer(indb)
+    else:
+        # Depths are matched to banks by the net cell of their coordinates
+        ind = misc_utils.grid_join(xb, yb, xd, yd, geo, 'banks and depths')
+    depth = dpt.astype(np.float32)[np.maximum(ind, 0)]
+    depth[ind < 0] = np.nan
+    bedelev = elevadj.astype(np.float32) - depth
 
-    bed = bnk[['x', 'y', 'geometry','bedelev']]
-#    bnk.columns = ['x', 'y', 'bedelev']
     print('Writing out data')
-#   Just write bed dataframe to file, rather than creating a new dataframe with the same data
-#   mybed = gpd.GeoDataFrame(bnk, crs={'init': 'epsg:4326'}, geometry=[
-#                             Point(xy) for xy in zip(bed.x.astype(float), bed.y.astype(float))])
-    bed.to_file(output+'.shp')
-
-    nodata = -9999
-    fmt = "GTiff"
-#    name1 = output
-#    name2 = os.path.dirname(output) + '/' + \
-#        os.path.basename(output).split('.')[0] + '.tif'
-    name1 = output + '.shp'
-    name2 = output + '.tif'
-    mygeo = gdalutils.get_geo(netf)
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt,"-ot", "Float32", "-co", "COMPRESS=DEFLATE", "-tr", str(mygeo[6]), str(mygeo[7]), "-a",
-                     "bedelev", "-a_srs", proj, "-te", str(mygeo[0]), str(mygeo[1]), str(mygeo[2]), str(mygeo[3]), name1, name2])
+    frame = stageio.write_outputs(output, proj, indb, xb, yb, [('bedelev', bedelev)],
+                                  stage, export)
+
+    if output is not None and 'tif' in export:
+        # Bed elevations are burnt in the net grid, as gdal_rasterize does
+        # with points the cell containing every point takes its value
+        nodata = -9999
+        keys = misc_utils.grid_keys(xb, yb, geo)
+        valid = (keys >= 0) & np.isfinite(bedelev)
+        dat = np.ones((int(geo[5]), int(geo[4])), dtype=np.float32)*nodata
+        dat.flat[keys[valid]] = bedelev[valid]
+        gdalutils.write_raster(dat, output + '.tif', geo, "Float32", nodata)
+
+    return frame
 
 
 if __name__ == '__main__':
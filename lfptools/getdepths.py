@@ -4,18 +4,18 @@
 # auth: jeison sosa
 # mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
 
-import os
 import sys
 import subprocess
 import configparser
 import getopt
 import numpy as np
-import gdalutils
-from lfptools import shapefile
+import pandas as pd
 from lfptools import misc_utils
-from osgeo import osr
-from scipy.spatial.distance import cdist
-from scipy.optimize import fsolve
+from lfptools import stageio
+from lfptools.buildindex import load_index
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
+distance = lazy_import('scipy.spatial.distance')
 
 
 def getdepths_shell(argv):
@@ -58,6 +58,7 @@ output = Shapefile output file path
 # If depth_raster
 fdepth = Depth raster source file GDAL format projection EPSG:4326
 thresh = Serching threshold in degrees
+findex = (Optional) Index of fdepth from lfp-buildindex
 
 # If depth_geometry
 wdtf   = Shapefile width from lfp-getwidths
@@ -70,6 +71,13 @@ wdtf   = Shapefile width from lfp-getwidths
 slpf   = Shapefile slope from lfp-getslopes
 qbnkf  = Shapefile q bank full
 
+# Shapefiles above can be replaced by stage files, if all are stage files
+# records are matched by `rec` index instead of coordinates
+stage  = (Optional) Stage file format [npz|parquet|feather], writes
+         output.<format> to be read by downstream stages, recf is
+         required unless inputs are stage files
+export = (Optional) Comma separated exports [shp,tif|shp|none], default shp,tif
+
 '''
 
     try:
@@ -81,18 +89,26 @@ qbnkf  = Shapefile q bank full
         print(myhelp)
         sys.exit(0)
 
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'stage': '', 'export': 'shp,tif',
+                                            'recf': ''})
     config.read(inifile)
 
     proj = str(config.get('getdepths', 'proj'))
     netf = str(config.get('getdepths', 'netf'))
     method = str(config.get('getdepths', 'method'))
     output = str(config.get('getdepths', 'output'))
+    recf = str(config.get('getdepths', 'recf'))
+    if recf == '':
+        recf = None
+    stage = str(config.get('getdepths', 'stage'))
+    export = stageio.parse_export(config.get('getdepths', 'export'))
 
     try:
         fdepth = str(config.get('getdepths', 'fdepth'))
         thresh = np.float64(config.get('getdepths', 'thresh'))
         kwargs = {'fdepth':fdepth,'thresh':thresh}
+        if config.has_option('getdepths', 'findex'):
+            kwargs['findex'] = str(config.get('getdepths', 'findex'))
     except:
         pass
 
@@ -113,48 +129,53 @@ qbnkf  = Shapefile q bank full
     except:
         pass
 
-    getdepths(proj,netf,method,output,**kwargs)
+    getdepths(proj,netf,method,output,recf,stage,export,**kwargs)
 
-def getdepths(proj,netf,method,output,**kwargs):
+def getdepths(proj,netf,method,output,recf=None,stage='',export=stageio.EXPORTS,**kwargs):
 
     print("    runnning getdepths.py...")
 
     fname = output
 
-    w = shapefile.Writer(shapefile.POINT)
-    w.field('x')
-    w.field('y')
-    w.field('depth')
-
     if method == "depth_raster":
-        depth_raster(w, netf, **kwargs)
+        x, y, depth, index = depth_raster(netf, **kwargs)
     elif method == "depth_geometry":
-        depth_geometry(w, **kwargs)
+        x, y, depth, index = depth_geometry(**kwargs)
     elif method == "depth_manning":
-        depth_manning(w, **kwargs)
+        x, y, depth, index = depth_manning(netf, **kwargs)
     else:
         sys.exit("ERROR method not recognised")
 
+    # Points without `rec` index are matched to rec by their net cell
+    if index is None and recf is not None:
+        rec = stageio.read_rec(recf)
+        index = misc_utils.grid_join(x, y, rec['lon'].values, rec['lat'].values,
+                                     gdalutils.get_geo(netf), 'depths and rec')
+
+    if stage and output is not None:
+        # Only points with a rec record are written in the stage file
+        if index is None:
+            sys.exit("ERROR recf is required to write a stage file from " + method)
+        keep = index >= 0
+        stageio.write_stage(fname, stage, index[keep], x[keep], y[keep],
+                            [('depth', depth[keep])])
+
     # write final value in a shapefile
-    w.save("%s.shp" % fname)
+    frame = stageio.write_outputs(fname, proj, index, x, y, [('depth', depth)], '', export)
 
-    # write .prj file
-    prj = open("%s.prj" % fname, "w")
-    srs = osr.SpatialReference()
-    srs.ImportFromProj4(proj)
-    prj.write(srs.ExportToWkt())
-    prj.close()
+    if output is not None and 'tif' in export:
+        nodata = -9999
+        fmt = "GTiff"
+        name1 = output+".shp"
+        name2 = output+".tif"
+        mygeo = gdalutils.get_geo(netf)
+        subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-tr", str(mygeo[6]), str(mygeo[7]),
+                         "-a", "depth", "-a_srs", proj, "-te", str(mygeo[0]), str(mygeo[1]), str(mygeo[2]), str(mygeo[3]), name1, name2])
 
-    nodata = -9999
-    fmt = "GTiff"
-    name1 = output+".shp"
-    name2 = output+".tif"
-    mygeo = gdalutils.get_geo(netf)
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-tr", str(mygeo[6]), str(mygeo[7]),
-                     "-a", "depth", "-a_srs", proj, "-te", str(mygeo[0]), str(mygeo[1]), str(mygeo[2]), str(mygeo[3]), name1, name2])
+    return frame
 
 
-def depth_raster(w, netf, fdepth, thresh):
+def depth_raster(netf, fdepth, thresh, findex=''):
     """
     From a raster of depths this subroutine finds nearest depth to every river pixel in grid
     """
@@ -166,104 +187,81 @@ def depth_raster(w, netf, fdepth, thresh):
     xx = geo_net[8][ix]
     yy = geo_net[9][iy]
 
-    # Reading depth source file
-    dat = gdalutils.get_data(fdepth)
-    geo = gdalutils.get_geo(fdepth)
-    iy, ix = np.where(dat > -9999)
-    xdat = geo[8][ix]
-    ydat = geo[9][iy]
-
-    depth = []
-    for x, y in zip(xx, yy):
-        try:
-            dis, ind = misc_utils.near_euc(xdat, ydat, (x, y))
-            if dis <= thresh:
-                val = dat[iy[ind], ix[ind]]
-                depth.append(val)
-            else:
-                depth.append(np.nan)
-        except ValueError:
-            depth.append(np.nan)
-
-    for x,y,mydepth in zip(xx,yy,depth):
-        w.point(x,y)
-        w.record(x,y,mydepth)
-
-    return w
-
-
-def depth_geometry(w, r, p, wdtf):
-    """
-    Uses hydraulic geoemtry equation to estimate requires width, r and p coeffs.
-    """
+    # Reading depth source file, only pixels around the river network
+    # are read, from the prebuilt index if available
+    xmin = xx.min() - thresh
+    ymin = yy.min() - thresh
+    xmax = xx.max() + thresh
+    ymax = yy.max() + thresh
+    if findex:
+        xdat, ydat, vdat = load_index(findex, xmin, ymin, xmax, ymax,
+                                      minval=-9999)
+    else:
+        dat, geo = gdalutils.clip_raster(fdepth, xmin, ymin, xmax, ymax)
+        iy, ix = np.where(dat > -9999)
+        xdat = geo[8][ix]
+        ydat = geo[9][iy]
+        vdat = dat[iy, ix]
+
+    # Nearest depth pixel to every river pixel in one query, pixels further
+    # than thresh are not considered
+    dis, ind = misc_utils.near_euc_bounded(xdat, ydat, xx, yy, thresh)
+    depth = np.ones(xx.size, dtype=np.result_type(vdat.dtype, np.float32))*np.nan
+    depth[ind >= 0] = vdat[ind[ind >= 0]]
 
-    width = np.array(shapefile.Reader(wdtf).records(), dtype='float64')
-    x = width[:, 0]
-    y = width[:, 1]
+    return xx, yy, depth, None
 
-    for i in range(width.shape[0]):
 
-        print("getdepths.py - " + str(width.shape[0]-i))
+def depth_geometry(r, p, wdtf):
+    """
+    Uses hydraulic geoemtry equation to estimate requires width, r and p coeffs.
+    """
 
-        mydepth = r*width[i, 2]**p
+    x, y, width, index = stageio.read_values(wdtf)
 
-        w.point(x[i], y[i])
-        w.record(x[i], y[i], mydepth)
+    mydepth = r*width**p
 
-    return w
+    return x, y, mydepth, index
 
 
-def depth_manning(f, n, qbnkf, slpf, wdtf):
+def depth_manning(netf, n, qbnkf, slpf, wdtf):
     """
     Uses manning's equation to estimate depth requires bankfull flow,
     slope, width and manning coefficient
     """
 
-    # load width shapefile
-    width = np.array(shapefile.Reader(wdtf).records(), dtype='float64')
-    xw = width[:, 0]
-    yw = width[:, 1]
-
-    qbnk = np.array(shapefile.Reader(qbnkf).records(), dtype='float64')
-    xq = qbnk[:, 0]
-    yq = qbnk[:, 1]
-
-    slope = np.array(shapefile.Reader(slpf).records(), dtype='float64')
-    xs = slope[:, 0]
-    ys = slope[:, 1]
+    # load width, bankfull flow and slope shapefiles or stage files
+    xw, yw, w, index = stageio.read_values(wdtf)
+    xq, yq, qbnk, indq = stageio.read_values(qbnkf)
+    xs, ys, slope, inds = stageio.read_values(slpf)
 
-    # iterate over every width x-y pair in the shapefile
-    for i in range(width.shape[0]):
-
-        # get index for Q and S based on W coordinates
-        iiq = near(yq, xq, np.array([[xw[i], yw[i]]]))
-        iis = near(ys, xs, np.array([[xw[i], yw[i]]]))
-
-        if (np.float32(xw[i]) != np.float32(xq[iiq])) | (np.float32(xw[i]) != np.float32(xs[iis])) | (np.float32(yw[i]) != np.float32(yq[iiq])) | (np.float32(yw[i]) != np.float32(ys[iis])):
-
-            print(xw[i], yw[i])
-            print(xq[iiq], yq[iiq])
-            print(xs[iis], ys[iis])
-            sys.exit("Coordinates are not equal")
+    if index is not None and indq is not None and inds is not None:
+        # get index for Q and S based on the `rec` index of W
+        iiq = pd.Index(indq).get_indexer(index)
+        iis = pd.Index(inds).get_indexer(index)
+    else:
+        # get index for Q and S based on the net cell of W coordinates
+        geo = gdalutils.get_geo(netf)
+        iiq = misc_utils.grid_join(xw, yw, xq, yq, geo, 'width and ' + qbnkf)
+        iis = misc_utils.grid_join(xw, yw, xs, ys, geo, 'width and ' + slpf)
 
-        w = width[i, 2]
-        q = qbnk[iiq, 2]
-        s = slope[iis, 2]
+    if (iiq < 0).any() | (iis < 0).any():
+        i = np.flatnonzero((iiq < 0) | (iis < 0))[0]
+        print(xw[i], yw[i])
+        sys.exit("Coordinates are not equal")
 
-        data = (q, w, s, n)
+    q = qbnk[iiq]
+    s = slope[iis]
 
-        # # depth by using a full version of the mannings equation (solve numerically)
-        # mydepth = fsolve(manning_depth,0,args=data)
-        # f.point(xw[i],yw[i])
-        # f.record(xw[i],yw[i],mydepth[0])
+    data = (q, w, s, n)
 
-        # depth by using a simplified version of the mannings equation
-        mydepth = manning_depth_simplified(data)
+    # # depth by using a full version of the mannings equation (solve numerically)
+    # mydepth = fsolve(manning_depth,0,args=data)
 
-        f.point(xw[i], yw[i])
-        f.record(xw[i], yw[i], mydepth)
+    # depth by using a simplified version of the mannings equation
+    mydepth = manning_depth_simplified(data)
 
-    return f
+    return xw, yw, mydepth, index
 
 
 def nearpixel(array, ddsx, ddsy, XA):
@@ -280,7 +278,7 @@ def nearpixel(array, ddsx, ddsy, XA):
     # if there are river pixels in the window
     if _ds[0].size > 0:
         XB = np.vstack((ddsy[_ds[0]], ddsx[_ds[1]])).T
-        ind = np.int(cdist(XA, XB, metric='euclidean').argmin())
+        ind = np.int(distance.cdist(XA, XB, metric='euclidean').argmin())
         res = array[_ds[0][ind], _ds[1][ind]]
     else:
         res = -9999
@@ -304,7 +302,7 @@ def manning_depth_simplified(data):
 def near(ddsx, ddsy, XA):
 
     XB = np.vstack((ddsy, ddsx)).T
-    dis = cdist(XA, XB, metric='euclidean').argmin()
+    dis = distance.cdist(XA, XB, metric='euclidean').argmin()
 
     return dis
 
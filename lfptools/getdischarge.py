@@ -4,16 +4,18 @@
 # auth: jeison sosa
 # mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
 
+import os
 import sys
 import getopt
 import configparser
 import numpy as np
 import pandas as pd
-import xarray as xr
-import gdalutils as gu
-import geopandas as gpd
-from pyproj import Proj
-from pyproj import transform
+from lfptools import session
+from lfptools.lazyimport import lazy_import
+xr = lazy_import('xarray')
+gu = lazy_import('gdalutils')
+gpd = lazy_import('geopandas')
+pyproj = lazy_import('pyproj')
 
 
 def getdischarge_shell(argv):
@@ -119,7 +121,7 @@ def get_data(ncf, ncdatlbl, ncxlabel, ncylabel, x, y, date1='1990-01-01', date2=
     y : latitude same projection as source
     """
 
-    dat = xr.open_dataset(ncf)
+    dat = open_netcdf(ncf)
     mytim = dat.sel(time=slice(date1, date2))
     mydis = mytim.sel({ncxlabel: x, ncylabel: y}, method="nearest")
     df = mydis[ncdatlbl].to_pandas().to_frame()
@@ -138,14 +140,14 @@ def find_nearest(ncf, ncproj, ncxlabel, ncylabel, lon, lat, proj):
     proj : lon and lat projection e.g. epsg:4326
     """
 
-    crs_wgs84 = Proj(init=proj)
-    crs_nc = Proj(init=ncproj)
+    crs_wgs84 = pyproj.Proj(init=proj)
+    crs_nc = pyproj.Proj(init=ncproj)
 
     # Reading netcdf file
-    dat = xr.open_dataset(ncf)
+    dat = open_netcdf(ncf)
 
     # Transforming between projections
-    x, y = transform(crs_wgs84, crs_nc, lon, lat)
+    x, y = pyproj.transform(crs_wgs84, crs_nc, lon, lat)
 
     # Retrieve near x and y
     near = dat.sel({ncxlabel: x, ncylabel: y}, method="nearest")
@@ -155,5 +157,14 @@ def find_nearest(ncf, ncproj, ncxlabel, ncylabel, lon, lat, proj):
     return near_x, near_y
 
 
+def open_netcdf(ncf):
+    """
+    Open a netCDF file, kept open between jobs of an lfp worker
+    """
+
+    return session.cached(('netcdf', os.path.abspath(ncf)),
+                          lambda: xr.open_dataset(ncf), ncf)
+
+
 if __name__ == '__main__':
     getdischarge_shell(sys.argv[1:])
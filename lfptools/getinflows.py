@@ -12,11 +12,11 @@ import subprocess
 import configparser
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-import gdalutils as gu
-from pyproj import Proj
-from pyproj import transform
-from shapely.geometry import Point
+from lfptools.lazyimport import lazy_import
+gpd = lazy_import('geopandas')
+gu = lazy_import('gdalutils')
+pyproj = lazy_import('pyproj')
+geometry = lazy_import('shapely.geometry')
 
 
 def getinflows_shell(argv):
@@ -144,7 +144,7 @@ def getinflows(ncf, ncproj, thresh_dis, recf, proj, output):
 
     # Create geodataframe
     gdf = gpd.GeoDataFrame(df_new, crs={'init': proj}, geometry=[
-                           Point(xy) for xy in zip(df_new.x, df_new.y)])
+                           geometry.Point(xy) for xy in zip(df_new.x, df_new.y)])
 
     # Write geodataframe
     try:
@@ -163,8 +163,8 @@ def find_nearest_mean_mask(ncf, ncproj, lon, lat, proj, thresh_dis, thresh_mean=
 
     # JRC data set projection is EPSG:3035
     # It's required to convert to WGS84 to perform distance calculation
-    crs_wgs84 = Proj(init=proj)
-    crs_nc = Proj(init=ncproj)
+    crs_wgs84 = pyproj.Proj(init=proj)
+    crs_nc = pyproj.Proj(init=ncproj)
 
     # Reading mean mask
     dat = gu.get_data(ncf)
@@ -174,7 +174,7 @@ def find_nearest_mean_mask(ncf, ncproj, lon, lat, proj, thresh_dis, thresh_mean=
     df = gu.array_to_pandas(dat, geo, thresh_mean, 'ge')
 
     # Creating two new columns with projected values
-    coords = transform(crs_nc, crs_wgs84, df['x'].values, df['y'].values)
+    coords = pyproj.transform(crs_nc, crs_wgs84, df['x'].values, df['y'].values)
     df['lon'] = coords[0]
     df['lat'] = coords[1]
 
@@ -9,6 +9,7 @@ import getopt
 import configparser
 import numpy as np
 import pandas as pd
+from lfptools import misc_utils
 
 
 def getrunoff_shell(argv):
@@ -60,22 +61,24 @@ def getrunoff(discsv,output):
     df = pd.read_csv(discsv, index_col=0)
 
     # Use discharge CSV to calculate runoff
-    # Groups per link
-    grouped = df.groupby('link')
-    res = pd.DataFrame()
-    for name, group in grouped:
-        # Select only date columns
-        diffgroups = group[[i for i in df.columns if (i[0] == '1') | (i[0] == '2')]].diff()
-        res = pd.concat([res, diffgroups])
+    # Differences per link, select only date columns
+    dates = [i for i in df.columns if (i[0] == '1') | (i[0] == '2')]
+    order, offsets = misc_utils.segment_offsets(df['link'].values)
+    vals = df[dates].values.astype(np.float64)[order]
+    diff = np.ones(vals.shape)*np.nan
+    diff[1:] = vals[1:] - vals[:-1]
+    diff[offsets[:-1][offsets[:-1] < len(diff)]] = np.nan
+    res = np.empty(vals.shape)
+    res[order] = diff
+    res = pd.DataFrame(res, index=df.index, columns=dates)
     df1 = pd.concat([df[['link', 'x', 'y', 'near_x', 'near_y']], res], axis=1)
 
     # Remove NANs from all rows + change negative values by NANs + filling NANs by interpolation per 'linkno'
     df1.dropna(inplace=True)
     df1[df1[[i for i in df1.columns if i[0] == '1']]
         < 0] = np.nan  # Select only date columns
-    df1 = df1.groupby('link').apply(lambda grp: grp.interpolate(
-        method='linear', limit_direction='both'))
-    df1[df1.isnull()] = 0
+    df1[dates] = misc_utils.fill_links(df1[dates].values, df1['link'].values,
+                                       0, majority=False)
 
     # Writing CSV file
     df1.to_csv(output)
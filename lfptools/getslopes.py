@@ -9,12 +9,11 @@ import getopt
 import subprocess
 import configparser
 import numpy as np
-import pandas as pd
-import gdalutils
-from lfptools import shapefile
 from lfptools import misc_utils
-from osgeo import osr
-from sklearn import linear_model
+from lfptools import stageio
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
+linear_model = lazy_import('sklearn.linear_model')
 
 
 def getslopes_shell(argv):
@@ -40,12 +39,16 @@ Usage
 Content in config.txt
 ---------------------
 [getslopes]
-source = File from which get the slopes e.g. resulting file from lfp-fixelevs
+source = File from which get the slopes e.g. resulting file from lfp-fixelevs,
+         shapefile or stage file
 output = Output file
 netf = Target mask file path
 recf = `Rec` file path
 proj = Output projection is Proj4 format
 step = steps to count, upstream and downstream
+stage = (Optional) Stage file format [npz|parquet|feather], writes
+        output.<format> to be read by downstream stages
+export = (Optional) Comma separated exports [shp,tif|shp|none], default shp,tif
 '''
 
     try:
@@ -57,7 +60,7 @@ step = steps to count, upstream and downstream
         print(myhelp)
         sys.exit(0)
 
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'stage': '', 'export': 'shp,tif'})
     config.read(inifile)
 
     source = str(config.get('getslopes', 'source'))
@@ -66,36 +69,44 @@ step = steps to count, upstream and downstream
     recf = str(config.get('getslopes', 'recf'))
     proj = str(config.get('getslopes', 'proj'))
     step = int(config.get('getslopes', 'step'))
+    stage = str(config.get('getslopes', 'stage'))
+    export = stageio.parse_export(config.get('getslopes', 'export'))
 
-    getslopes(source,output,netf,recf,proj,step)
+    getslopes(source,output,netf,recf,proj,step,stage,export)
 
-def getslopes(source,output,netf,recf,proj,step):
+def getslopes(source,output,netf,recf,proj,step,stage='',export=stageio.EXPORTS):
 
     print("    runnning getslopes.py...")
 
     # Reading XXX_rec.csv file
-    rec = pd.read_csv(recf)
+    rec = stageio.read_rec(recf)
 
     # Reading XXX_net.tif file
     geo = gdalutils.get_geo(netf)
 
-    # Reading bank file (adjusted bank)
-    elev = np.array(shapefile.Reader(source).records(), dtype='float64')
-
-    # Initiate output shapefile
-    w = shapefile.Writer(shapefile.POINT)
-    w.field('x')
-    w.field('y')
-    w.field('slope')
-
-    # Retrieving adjusted bank elevations from XXX_bnkfix.shp file
-    # Values are stored in rec['bnk']
-    bnkadj = []
-    for i in rec.index:
-        dis, ind = misc_utils.near_euc(elev[:, 0], elev[:, 1], (rec['lon'][i],
-                                                                rec['lat'][i]))
-        bnkadj.append(elev[ind, 2])
-    rec['bnkadj'] = bnkadj
+    lon = rec['lon'].values
+    lat = rec['lat'].values
+    if stageio.is_stage(source):
+        # Retrieving adjusted bank elevations from XXX_bnkfix stage file,
+        # aligned to rec by index
+        rec['bnkadj'] = stageio.read_stage(source)['elevadj'].reindex(rec.index).values
+    else:
+        # Reading bank file (adjusted bank)
+        elev = misc_utils.read_points(source)
+        if elev.shape[0] == 0:
+            sys.exit('ERROR no bank elevations found in ' + source)
+
+        # Retrieving adjusted bank elevations from XXX_bnkfix.shp file
+        # Values are stored in rec['bnk']
+        # Records are matched by the net cell of their coordinates, points
+        # without a record in their cell take the nearest one
+        ind = misc_utils.grid_join(lon, lat, elev[:, 0], elev[:, 1], geo,
+                                   'rec and ' + source)
+        miss = ind < 0
+        if miss.any():
+            dis, ind[miss] = misc_utils.near_euc_bounded(elev[:, 0], elev[:, 1],
+                                                         lon[miss], lat[miss], np.inf)
+        rec['bnkadj'] = elev[ind, 2]
 
     # Calculating slopes
     # coordinates are grouped by REACH number
@@ -109,26 +120,20 @@ def getslopes(source,output,netf,recf,proj,step):
             dem, df['lon'].values, df['lat'].values, step)
         rec['slopes'][ids] = slopes_vals
 
-    # Writing .shp resulting file
-    for i in rec.index:
-        w.point(rec['lon'][i], rec['lat'][i])
-        w.record(rec['lon'][i], rec['lat'][i], rec['slopes'][i])
-    w.save("%s.shp" % output)
-
-    # write .prj file
-    prj = open("%s.prj" % output, "w")
-    srs = osr.SpatialReference()
-    srs.ImportFromProj4(proj)
-    prj.write(srs.ExportToWkt())
-    prj.close()
-
-    # Writing .tif file
-    nodata = -9999
-    fmt = "GTiff"
-    name1 = output+".shp"
-    name2 = output+".tif"
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-tr",
-                     str(geo[6]), str(geo[7]), "-a", "slope", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
+    # Writing stage file and .shp resulting file
+    frame = stageio.write_outputs(output, proj, rec.index, lon, lat,
+                                  [('slope', rec['slopes'])], stage, export)
+
+    if output is not None and 'tif' in export:
+        # Writing .tif file
+        nodata = -9999
+        fmt = "GTiff"
+        name1 = output+".shp"
+        name2 = output+".tif"
+        subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-tr",
+                         str(geo[6]), str(geo[7]), "-a", "slope", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
+
+    return frame
 
 
 def calc_slope_step(dem, x, y, step):
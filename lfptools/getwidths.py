@@ -9,12 +9,13 @@ import subprocess
 import configparser
 import getopt
 import numpy as np
-import pandas as pd
-import geopandas as gpd
-import gdalutils
-from lfptools import shapefile
 from lfptools import misc_utils
-from osgeo import osr
+from lfptools import sampling
+from lfptools import stageio
+from lfptools.buildindex import load_index
+from lfptools.lazyimport import lazy_import
+gpd = lazy_import('geopandas')
+gdalutils = lazy_import('gdalutils')
 
 
 def getwidths_shell(argv):
@@ -44,7 +45,16 @@ netf   = Target mask file path
 proj   = Output projection in Proj4 format
 fwidth = Source width file path GDAL format
 method = [const_thresh|var_thresh]
-fbankfullq  = Source bankfullq shapefile (Optional, to determine variable threshold)
+fbankfullq  = Source bankfullq shapefile or stage file (Optional, to determine variable threshold)
+nproc  = Number of cores to use (Optional, default 1) const_thresh only
+search = [window|basin] (Optional, default window) const_thresh only, basin
+         reads the source once for the basin and bounds the search of
+         every point with a distance transform, same widths as window
+findex = (Optional) Index of fwidth from lfp-buildindex, valid pixels of
+         the basin are loaded from it instead of reading fwidth
+stage  = (Optional) Stage file format [npz|parquet|feather], writes
+         output.<format> to be read by downstream stages
+export = (Optional) Comma separated exports [shp,tif|shp|none], default shp,tif
 '''
 
     try:
@@ -56,7 +66,11 @@ fbankfullq  = Source bankfullq shapefile (Optional, to determine variable thresh
         print(myhelp)
         sys.exit(0)
 
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'thresh': '-1',
+                                            'method': 'const_thresh',
+                                            'fbankfullq': '', 'nproc': '1',
+                                            'search': 'window', 'findex': '',
+                                            'stage': '', 'export': 'shp,tif'})
     config.read(inifile)
 
     recf = str(config.get('getwidths', 'recf'))
@@ -64,48 +78,50 @@ fbankfullq  = Source bankfullq shapefile (Optional, to determine variable thresh
     proj = str(config.get('getwidths', 'proj'))
     fwidth = str(config.get('getwidths', 'fwidth'))
     output = str(config.get('getwidths', 'output'))
-    thresh = np.float64(config.get('getwidths', 'thresh',-1))
-    method = str(config.get('getwidths', 'method','const_thresh'))
-    fbankfullq = str(config.get('getwidths', 'fbankfullq',''))
-
-####################################################################    # If there are more NaN than real values, all values in link are equal to 30
-# Otherwise, interpolate real values to fill NaNs
-def check_width(a):
-    b = a.copy()
-    c = b.isnull()
-    falses = c.sum()
-    trues = c.count() - falses
-    if trues >= falses:
-        return a.interpolate(limit_direction='both')
-    else:
-        b.loc[:] = 30
-        return b
+    thresh = np.float64(config.get('getwidths', 'thresh'))
+    method = str(config.get('getwidths', 'method'))
+    fbankfullq = str(config.get('getwidths', 'fbankfullq'))
+    nproc = int(config.get('getwidths', 'nproc'))
+    search = str(config.get('getwidths', 'search'))
+    findex = str(config.get('getwidths', 'findex'))
+    stage = str(config.get('getwidths', 'stage'))
+    export = stageio.parse_export(config.get('getwidths', 'export'))
+
+    getwidths(recf, netf, proj, fwidth, output, thresh, method, fbankfullq, nproc, search, findex,
+              stage, export)
 
 ####################################################################
 #
-def getwidths(recf,netf, proj, fwidth, output,thresh=-1,method = 'const_thresh',fbankfullq=''):
+def getwidths(recf,netf, proj, fwidth, output,thresh=-1,method = 'const_thresh',fbankfullq='',nproc=1,search='window',findex='',
+              stage='', export=stageio.EXPORTS):
     if method == 'const_thresh':
         print("    running getwidths.py... constant threshold version")
-        getwidths_constthresh(recf, netf, proj, fwidth, output, thresh)
+        return getwidths_constthresh(recf, netf, proj, fwidth, output, thresh, nproc, search, findex,
+                                     stage, export)
     elif method == 'var_thresh':
         print("    running getwidths.py... variable threshold version")
         # use variable threshold, based on fbankfullq (bankfull q)
         # E.g. use larger search distance for major rivers
         # Could alternatively use accumulation, or strahler order
-        getwidths_varthresh(recf,netf, proj, fwidth, output,fbankfullq)
+        return getwidths_varthresh(recf,netf, proj, fwidth, output,fbankfullq,findex,stage,export)
 
 ####################################################################
 #
-def getwidths_varthresh(recf,netf, proj, fwidth, output, fbankfullq):
+def getwidths_varthresh(recf,netf, proj, fwidth, output, fbankfullq, findex='',
+                        stage='', export=stageio.EXPORTS):
 
 	# Reading XXX_net.tif file
     geo1 = gdalutils.get_geo(netf)
 
-    bankfullq = gpd.read_file(fbankfullq)
-	# bankfullq has name: 'bankfullq'
-
     # Reading XXX_rec.csv file
-    rec = pd.read_csv(recf)
+    rec = stageio.read_rec(recf)
+
+    if stageio.is_stage(fbankfullq):
+        # Stage file aligned to rec by index, columns lon, lat, bankfullq
+        bankfullq = stageio.read_stage(fbankfullq).reindex(rec.index)
+    else:
+        bankfullq = gpd.read_file(fbankfullq)
+	# bankfullq has name: 'bankfullq'
     print('loaded data')
 
 	# x and y resolution (degrees)
@@ -113,53 +129,33 @@ def getwidths_varthresh(recf,netf, proj, fwidth, output, fbankfullq):
     yres = geo1[7]
     print('data res',xres,yres)
 
-    width = []
-    width = np.ones([len(bankfullq)],dtype=np.float32)*30. # 30 is default value
-    for row in bankfullq.itertuples():
-        #print(row[0],row[1],row[2],row[3],row[4])
-        i = row[0]
-        x = float(row[1])
-        y = float(row[2])
-        bfq = max(float(row[3]),1.)
-        # Choose some threshold based on bankfull q (bfq)
-        thresh = np.log(bfq)/1000. + bfq/1000000. + 2*abs(xres) + 2*abs(yres)
-
-        # come up with minimum width to search for, based on bankfullq
-        # This is designed to prevent assigning
-        #width values from the tributaries to the major river channels
-        minwidth = bfq/100. + 30
-
-
-        # Get nearest width from datasource
-        # Uses Euclidean distance to find nearest point in source
-        # `try` included since it may happen that the width database doesn't
-        # contains data in the basin if that is the case all values are assigned
-        # a 30 m width
-
-
-        xmin = x - thresh
-        ymin = y - thresh
-        xmax = x + thresh
-        ymax = y + thresh
-
-        dat, geo = gdalutils.clip_raster(fwidth, xmin, ymin, xmax, ymax)
-        try:
-            iy, ix = np.where(dat > 30)
-        except:
-            print('Error: point',i,x,y)
-            print('Vals:',bfq,thresh,dat)
-            continue
-        xdat = geo[8][ix]
-        ydat = geo[9][iy]
-
-        try:
-            dis, ind = misc_utils.near_euc(xdat, ydat, (x, y))
-            val = dat[iy[ind], ix[ind]]
-            #width.append(val)
-            width[i] = val
-        except ValueError:
-            #width.append(30.)
-            continue
+    x = bankfullq.iloc[:, 0].values.astype(float)
+    y = bankfullq.iloc[:, 1].values.astype(float)
+    bfq = np.maximum(bankfullq.iloc[:, 2].values.astype(float), 1.)
+
+    # Choose some threshold based on bankfull q (bfq)
+    thresh = np.log(bfq)/1000. + bfq/1000000. + 2*abs(xres) + 2*abs(yres)
+
+    # come up with minimum width to search for, based on bankfullq
+    # This is designed to prevent assigning
+    #width values from the tributaries to the major river channels
+    minwidth = bfq/100. + 30
+
+    # Get nearest width from datasource
+    # Source is read once for the basin, valid pixels are indexed and all
+    # points are searched at once each one with its own threshold.
+    # Points without widths in their window are assigned a 30 m width
+    bbox = ((x - thresh).min(), (y - thresh).min(),
+            (x + thresh).max(), (y + thresh).max())
+    if findex:
+        xdat, ydat, vdat = load_index(findex, *bbox, minval=30)
+    else:
+        dat, geo = gdalutils.clip_raster(fwidth, *bbox)
+        iy, ix = np.where(dat > 30)
+        xdat, ydat, vdat = geo[8][ix], geo[9][iy], dat[iy, ix]
+    width = sampling.nearest_radius(xdat, ydat, vdat, x, y, thresh,
+                                    minval=minwidth)
+    width[np.isnan(width)] = 30. # 30 is default value
 
 	# Add widths to dataframe, then copy to new dataframe
     #bankfullq['width'] = width
@@ -168,38 +164,30 @@ def getwidths_varthresh(recf,netf, proj, fwidth, output, fbankfullq):
     rec['width'] = width
     #################################################################
     # Group river network per link
-    rec.loc[:, 'width'] = rec.groupby('link').width.apply(check_width)
+    # If there are more NaN than real values, all values in link are equal to 30
+    # Otherwise, interpolate real values to fill NaNs
+    rec['width'] = misc_utils.fill_links(rec['width'].values, rec['link'].values, 30)
 
     # Write out files
     print('Writing out data')
-    name1 = output + '.shp'
     #widths.to_file(name1)
 
-    w = shapefile.Writer(shapefile.POINT)
-    w.field('x')
-    w.field('y')
-    w.field('width')
-    # Writing .shp resulting file
-    for x, y, width in zip(rec['lon'], rec['lat'], rec['width']):
-        w.point(x, y)
-        w.record(x, y, width)
-    w.save("%s.shp" % output)
+    # Writing stage file and .shp resulting file
+    frame = stageio.write_outputs(output, proj, rec.index, rec['lon'], rec['lat'],
+                                  [('width', rec['width'])], stage, export)
 
-    # write .prj file
-    prj = open("%s.prj" % output, "w")
-    srs = osr.SpatialReference()
-    srs.ImportFromProj4(proj)
-    prj.write(srs.ExportToWkt())
-    prj.close()
+    if output is not None and 'tif' in export:
+        nodata = -9999
+        fmt = "GTiff"
+        name1 = output + '.shp'
+#        name1 = output
+#        name2 = os.path.dirname(output) + '/' + \
+#            os.path.basename(output).split('.')[0] + '.tif'
+        name2 = output + '.tif'
+        subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt,"-ot", "Float32", "-co", "COMPRESS=DEFLATE", "-tr", str(geo1[6]), str(geo1[7]), "-a",
+                         "width", "-a_srs", proj, "-te", str(geo1[0]), str(geo1[1]), str(geo1[2]), str(geo1[3]), name1, name2])
 
-    nodata = -9999
-    fmt = "GTiff"
-#    name1 = output
-#    name2 = os.path.dirname(output) + '/' + \
-#        os.path.basename(output).split('.')[0] + '.tif'
-    name2 = output + '.tif'
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt,"-ot", "Float32", "-co", "COMPRESS=DEFLATE", "-tr", str(geo1[6]), str(geo1[7]), "-a",
-                     "width", "-a_srs", proj, "-te", str(geo1[0]), str(geo1[1]), str(geo1[2]), str(geo1[3]), name1, name2])
+    return frame
 
 
 
@@ -207,71 +195,79 @@ def getwidths_varthresh(recf,netf, proj, fwidth, output, fbankfullq):
 
 ####################################################################
 #
-def getwidths_constthresh(recf, netf, proj, fwidth, output, thresh):
+def getwidths_constthresh(recf, netf, proj, fwidth, output, thresh, nproc=1, search='window', findex='',
+                          stage='', export=stageio.EXPORTS):
 
     print("    running getwidths.py...")
-    w = shapefile.Writer(shapefile.POINT)
-    w.field('x')
-    w.field('y')
-    w.field('width')
 
     # Reading XXX_rec.csv file
-    rec = pd.read_csv(recf)
+    rec = stageio.read_rec(recf)
 
     # Get nearest width from datasource
     # Uses Euclidean distance to find nearest point in source
     # `try` included since it may happen that the width database doesn't
     # contains data in the basin if that is the case all values are assigned
     # a 30 m width
-    width = []
+    if findex:
+        # Valid pixels of the basin from the prebuilt index, all points are
+        # searched at once in the same windows as the window search
+        lon = rec['lon'].values
+        lat = rec['lat'].values
+        xdat, ydat, vdat = load_index(findex, lon.min() - thresh, lat.min() - thresh,
+                                      lon.max() + thresh, lat.max() + thresh,
+                                      minval=30)
+        width = sampling.nearest_radius(xdat, ydat, vdat, lon, lat, thresh)
+    elif search == 'basin':
+        # Source is read once for the rec extent plus the threshold, every
+        # point searches the distance to the nearest valid pixel of its cell
+        lon = rec['lon'].values
+        lat = rec['lat'].values
+        dat, geo = gdalutils.clip_raster(fwidth, lon.min() - thresh, lat.min() - thresh,
+                                         lon.max() + thresh, lat.max() + thresh)
+        width = sampling.nearest_edt(dat, geo, lon, lat, thresh, minval=30)
+    elif search == 'window':
+        width = sampling.run_points(widths_constthresh,
+                                    (rec['lon'].values, rec['lat'].values),
+                                    nproc=nproc, groups=rec['link'].values,
+                                    args=(fwidth, thresh))
+    else:
+        sys.exit('ERROR search not recognised: ' + search)
 
-    for x, y in zip(rec['lon'], rec['lat']):
+    rec['width'] = width
 
-        xmin = x - thresh
-        ymin = y - thresh
-        xmax = x + thresh
-        ymax = y + thresh
 
-        dat, geo = gdalutils.clip_raster(fwidth, xmin, ymin, xmax, ymax)
-        iy, ix = np.where(dat > 30)
-        xdat = geo[8][ix]
-        ydat = geo[9][iy]
+	#################################################################
+    # Group river network per link
+    # If there are more NaN than real values, all values in link are equal to 30
+    # Otherwise, interpolate real values to fill NaNs
+    rec['width'] = misc_utils.fill_links(rec['width'].values, rec['link'].values, 30)
 
-        try:
-            dis, ind = misc_utils.near_euc(xdat, ydat, (x, y))
-            val = dat[iy[ind], ix[ind]]
-            width.append(val)
-        except ValueError:
-            width.append(np.nan)
+   # Writing stage file and .shp resulting file
+    frame = stageio.write_outputs(output, proj, rec.index, rec['lon'], rec['lat'],
+                                  [('width', rec['width'])], stage, export)
 
-    rec['width'] = width
+    if output is not None and 'tif' in export:
+        geo = gdalutils.get_geo(netf)
 
+        fmt = "GTiff"
+        nodata = -9999
+        name1 = output+".shp"
+        name2 = output+".tif"
+        subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-co", "COMPRESS=DEFLATE","-tr", str(geo[6]), str(geo[7]),
+                         "-a", "width", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
 
-	#################################################################
-    # Group river network per link
-    rec.loc[:, 'width'] = rec.groupby('link').width.apply(check_width)
-
-   # Writing .shp resulting file
-    for x, y, width in zip(rec['lon'], rec['lat'], rec['width']):
-        w.point(x, y)
-        w.record(x, y, width)
-    w.save("%s.shp" % output)
-
-    # write .prj file
-    prj = open("%s.prj" % output, "w")
-    srs = osr.SpatialReference()
-    srs.ImportFromProj4(proj)
-    prj.write(srs.ExportToWkt())
-    prj.close()
-
-    geo = gdalutils.get_geo(netf)
-
-    fmt = "GTiff"
-    nodata = -9999
-    name1 = output+".shp"
-    name2 = output+".tif"
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-co", "COMPRESS=DEFLATE","-tr", str(geo[6]), str(geo[7]),
-                     "-a", "width", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
+    return frame
+
+
+def widths_constthresh(reader, xx, yy, fwidth, thresh):
+    """
+    Nearest width larger than 30 in a window of size thresh around every point
+    """
+
+    width = np.ones(len(xx))*np.nan
+    for i, (x, y) in enumerate(zip(xx, yy)):
+        width[i] = sampling.search_nearest(reader, fwidth, x, y, thresh, minval=30)
+    return width
 
 
 if __name__ == '__main__':
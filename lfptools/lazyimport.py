@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import sys
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module imported on first attribute access
+    """
+
+    def __getattr__(self, attr):
+
+        module = importlib.import_module(self.__name__)
+        # Later accesses find attributes in the proxy itself
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """
+    Module name, imported when one of its attributes is first used. Heavy
+    dependencies (GDAL, scipy, geopandas, ...) are only loaded by the tools
+    using them, e.g. gdal = lazy_import('osgeo.gdal')
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
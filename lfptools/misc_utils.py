@@ -7,7 +7,10 @@
 import os
 import numpy as np
 import pandas as pd
-from scipy.spatial.distance import cdist
+from lfptools import shapefile
+from lfptools.lazyimport import lazy_import
+spatial = lazy_import('scipy.spatial')
+distance = lazy_import('scipy.spatial.distance')
 
 
 def near_geo(ddsx, ddsy, XA):
@@ -34,11 +37,80 @@ def near_euc(ddsx, ddsy, XA):
 
     XA = np.array([[XA[1], XA[0]]])
     XB = np.vstack((ddsy, ddsx)).T
-    dis = cdist(XA, XB, metric='euclidean').min()
-    ind = cdist(XA, XB, metric='euclidean').argmin()
+    dis = distance.cdist(XA, XB, metric='euclidean').min()
+    ind = distance.cdist(XA, XB, metric='euclidean').argmin()
     return dis, ind
 
 
+def near_euc_bounded(ddsx, ddsy, x, y, thresh):
+    """
+    Find nearest point in ddsx and ddsy np.array type arrays to every x, y
+    point in one query, Euclidean distance. Only points at a distance lower
+    or equal than thresh are considered, returns distance and index arrays
+    with inf and -1 where there is no point within thresh
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    dis = np.ones(x.size)*np.inf
+    ind = -np.ones(x.size, dtype=np.int64)
+    if len(ddsx) == 0 or x.size == 0:
+        return dis, ind
+
+    tree = spatial.cKDTree(np.column_stack((ddsx, ddsy)))
+    res = tree.query(np.column_stack((x, y)),
+                     distance_upper_bound=np.nextafter(thresh, np.inf))
+    found = np.isfinite(res[0])
+    dis[found] = res[0][found]
+    ind[found] = res[1][found]
+    return dis, ind
+
+
+def grid_keys(x, y, geo):
+    """
+    Integer key row*nx+col of the cell of geo (gdalutils.get_geo format)
+    where every x, y point falls, -1 for points outside the grid. Stages
+    write points at cell centres so keys are exact
+    """
+
+    col = np.floor((np.asarray(x, dtype=np.float64) - geo[0])/geo[6]).astype(np.int64)
+    row = np.floor((np.asarray(y, dtype=np.float64) - geo[3])/geo[7]).astype(np.int64)
+    nx = int(geo[4])
+    ny = int(geo[5])
+    inside = (col >= 0) & (col < nx) & (row >= 0) & (row < ny)
+    return np.where(inside, row*nx + col, -1)
+
+
+def grid_join(x, y, xr, yr, geo, name='points'):
+    """
+    Align a table with points xr, yr to points x, y by the grid cell of geo
+    they fall in (hash join). Returns for every x, y point the index of the
+    xr, yr point in the same cell, -1 where there is none. Unmatched points,
+    duplicated cells and points outside the grid are reported
+    """
+
+    keys = grid_keys(x, y, geo)
+    rkeys = grid_keys(xr, yr, geo)
+
+    # First point of every cell in the right table
+    idx = pd.Index(rkeys)
+    dup = idx.duplicated() | (rkeys < 0)
+    first = np.flatnonzero(~dup)
+    pos = pd.Index(rkeys[first]).get_indexer(keys)
+    ind = np.where((pos >= 0) & (keys >= 0), first[pos], -1)
+
+    missing = int((ind < 0).sum())
+    outside = int((rkeys < 0).sum())
+    duplicated = int(dup.sum()) - outside
+    unused = first.size - np.unique(ind[ind >= 0]).size
+    if missing + outside + duplicated + unused > 0:
+        print("WARNING join " + name + ": " + str(missing) + " of " +
+              str(keys.size) + " points without match, " + str(unused) +
+              " points not used, " + str(duplicated) + " duplicated cells, " +
+              str(outside) + " points outside the grid")
+
+    return ind
+
+
 def neararray_geo(array, ddsx, ddsy, XA, tol):
     """
     Given an 2D array find nerest point to XA defined as [x,y]
@@ -190,3 +262,112 @@ def get_catchmentdir(filename):
 
 def get_catchmentid(filename):
     return os.path.basename(os.path.dirname(filename))
+
+
+# DBF field type, width and decimals of point outputs, coordinates keep
+# 11 decimals (below 1 mm in degrees) and values 6 decimals. Widths stay
+# within the 20 characters of dBase numeric fields, values not fitting
+# (|v| >= 1e12) are written in exponent notation
+COORD_FIELD = ('F', 19, 11)
+VALUE_FIELD = ('F', 20, 6)
+
+
+def point_fields(names, x='x', y='y'):
+    """
+    Typed DBF fields of a point output: x and y coordinates followed by
+    one numeric field per name, to be used with shapefile.write_points
+    """
+
+    return [(x,) + COORD_FIELD, (y,) + COORD_FIELD] + \
+        [(name,) + VALUE_FIELD for name in names]
+
+
+def read_points(fname):
+    """
+    Read all fields of a point shapefile as a float64 array with one
+    column per field, the .dbf file is decoded column by column
+    """
+
+    recs = shapefile.Reader(fname).numpyRecords()
+    return np.column_stack([recs[name].astype('float64') for name in recs.dtype.names])
+
+
+def segment_offsets(groups):
+    """
+    Stable order sorting groups (e.g. link numbers) and offsets of every
+    segment of equal groups in the sorted array, offsets[-1] is the size
+    """
+
+    groups = np.asarray(groups)
+    order = np.argsort(groups, kind='mergesort')
+    sgroups = groups[order]
+    brk = np.flatnonzero(sgroups[1:] != sgroups[:-1]) + 1
+    offsets = np.concatenate(([0], brk, [groups.size]))
+    return order, offsets
+
+
+def fill_segments(values, offsets, fill, majority=True):
+    """
+    Fill NaNs in every segment values[offsets[i]:offsets[i+1]] of a 1D or
+    2D (points by columns) array. NaNs are linearly interpolated between
+    valid values of the segment and take the first or last valid value at
+    the edges. If majority, segments with more NaN than real values are
+    set to fill completely. Segments without real values are set to fill
+    """
+
+    vals = np.array(values, dtype=np.float64)
+    flat = vals.ndim == 1
+    if flat:
+        vals = vals[:, None]
+    n = vals.shape[0]
+    if n == 0:
+        return vals[:, 0] if flat else vals
+
+    seg = np.repeat(np.arange(offsets.size - 1), np.diff(offsets))
+    start = offsets[:-1][seg][:, None]
+    end = offsets[1:][seg][:, None]
+    pos = np.arange(n)[:, None]
+    valid = ~np.isnan(vals)
+
+    # Previous and next valid position of every element
+    prev = np.maximum.accumulate(np.where(valid, pos, -1), axis=0)
+    nxt = np.minimum.accumulate(np.where(valid, pos, n)[::-1], axis=0)[::-1]
+    hasprev = prev >= start
+    hasnext = nxt < end
+
+    cols = np.arange(vals.shape[1])[None, :]
+    vprev = vals[np.clip(prev, 0, n - 1), cols]
+    vnext = vals[np.clip(nxt, 0, n - 1), cols]
+
+    both = hasprev & hasnext & ~valid
+    slope = (vnext[both] - vprev[both])/(nxt[both] - prev[both])
+    res = vals.copy()
+    res[both] = vprev[both] + slope*(pos.repeat(vals.shape[1], 1)[both] - prev[both])
+    onlyprev = hasprev & ~hasnext & ~valid
+    res[onlyprev] = vprev[onlyprev]
+    onlynext = hasnext & ~hasprev & ~valid
+    res[onlynext] = vnext[onlynext]
+
+    # Segments where real values are not the majority
+    nreal = np.add.reduceat(valid, offsets[:-1], axis=0)
+    size = np.diff(offsets)[:, None]
+    if majority:
+        setfill = nreal < size - nreal
+    else:
+        setfill = nreal == 0
+    res[setfill[seg]] = fill
+
+    return res[:, 0] if flat else res
+
+
+def fill_links(values, links, fill, majority=True):
+    """
+    fill_segments on arrays in any order, segments are made of points with
+    the same link. Results are returned in the input order
+    """
+
+    order, offsets = segment_offsets(links)
+    vals = np.asarray(values)
+    res = np.empty(vals.shape)
+    res[order] = fill_segments(vals[order], offsets, fill, majority)
+    return res
@@ -12,16 +12,19 @@ import subprocess
 import configparser
 import pandas as pd
 import numpy as np
-import gdalutils
-from osgeo import osr
-from osgeo import gdal
 from lfptools import shapefile
+from lfptools import misc_utils
+from lfptools import buildcache
 from lfptools.prepdata_utils import cy_d82d4
 from lfptools.prepdata_utils import cy_rastermask
 from lfptools.prepdata_utils import cy_directions_tau
 from lfptools.prepdata_utils import cy_directions_esri
 from lfptools.prepdata_utils import cy_rasterthreshold
 from lfptools.prepdata_utils import calc_area
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
+osr = lazy_import('osgeo.osr')
+gdal = lazy_import('osgeo.gdal')
 
 
 def prepdata(argv):
@@ -54,6 +57,10 @@ def prepdata(argv):
     dir : Any GDAL format (e.g. .tif, .vrt) containing flow direction info
     thresh : Threshold to mask flow accumulation in KM**2
     streamnet : Calculate tree and coord files <yes/no>
+    overwrite : Run every step again <True/False>, default False
+    cache : Run only the steps whose inputs, parameters, code or tools
+            changed since the last run <yes/no>, default yes. With no, steps
+            whose outputs exist are skipped
 
 
     Outputs (If running at 30s)
@@ -92,7 +99,7 @@ def prepdata(argv):
         if o == "-i":
             inifile = a
 
-    config = configparser.SafeConfigParser({'overwrite':False,'acc_area':False})
+    config = configparser.SafeConfigParser({'overwrite':False,'acc_area':False,'cache':'yes'})
     config.read(inifile)
 
     te = np.float64(config.get('prepdata', 'te').split(','))
@@ -105,6 +112,7 @@ def prepdata(argv):
     streamnet = str(config.get('prepdata', 'streamnet'))
     overwrite = config.get('prepdata', 'overwrite').lower()=='True'.lower()
     acc_area = config.get('prepdata', 'acc_area').lower()=='True'.lower()
+    usecache = config.get('prepdata', 'cache').lower()=='yes'
 
     # Defining extent
     xmin0 = te[0]
@@ -183,6 +191,10 @@ def prepdata(argv):
     out3shpd4 = out+'/out3d4.shp'
     out30shp = out+'/out30.shp'
     out30shpd4 = out+'/out30d4.shp'
+    out3tif = out+'/out3.tif'
+    out3tifd4 = out+'/out3d4.tif'
+    out30tif = out+'/out30.tif'
+    out30tifd4 = out+'/out30d4.tif'
 
     cat3tif = out+'/basins3.tif'
     cat3tifd4 = out+'/basins3d4.tif'
@@ -192,6 +204,11 @@ def prepdata(argv):
     are3tif = out+'/area3.tif'
     are30tif = out+'/area30.tif'
 
+    # Steps are run again only if their fingerprint changed: digests of
+    # inputs, parameters, prepdata code and version of external tools
+    cache = buildcache.BuildCache(out, usecache, overwrite,
+                                  buildcache.code_files('prepdata'))
+
     # Snap extent to match input tif grid cells
     geo = gdalutils.get_geo(_dem)
     # Geo has format [xmin, ymin, xmax, ymax, xn, yn, xres, yres, ....]
@@ -201,10 +218,11 @@ def prepdata(argv):
     ymax = geo[3] + np.floor((ymax0 - geo[3])/geo[7])*geo[7]
 
     # Clipping DEM .vrt files
-    if not os.path.exists(dem3tif) or overwrite:
+    if cache.stale('dem3', [_dem], [dem3tif], [xmin, ymin, xmax, ymax], tools=['gdalwarp']):
         print('clipping dem to region',xmin,ymin,xmax,ymax)
-        subprocess.call(["gdalwarp", "-ot", "Float32", "-te", str(xmin), str(ymin), str(xmax),
+        call_tool(["gdalwarp", "-ot", "Float32", "-te", str(xmin), str(ymin), str(xmax),
                      str(ymax), "-overwrite", "-dstnodata", "-9999", "-co",'COMPRESS=DEFLATE',"-co", "BIGTIFF=YES", _dem, dem3tif])
+        cache.done('dem3')
 
     ########################################################################################
     # 3s resolution case
@@ -220,77 +238,94 @@ def prepdata(argv):
         ymax = geo[3] + np.floor((ymax0 - geo[3])/geo[7])*geo[7]
         print('clipping dir and acc fields to region',xmin,ymin,xmax,ymax)
 
-        if not os.path.exists(dir3tif) or overwrite:
-            subprocess.call(["gdalwarp", "-te", str(xmin), str(ymin), str(xmax),
+        if cache.stale('dir3', [_dir], [dir3tif], [xmin, ymin, xmax, ymax], tools=['gdalwarp']):
+            call_tool(["gdalwarp", "-te", str(xmin), str(ymin), str(xmax),
                          str(ymax), "-overwrite", "-co", "BIGTIFF=YES","-co",'COMPRESS=DEFLATE', _dir, dir3tif])
+            cache.done('dir3')
 
-        if not os.path.exists(_acc3tif) or overwrite:
-            subprocess.call(["gdalwarp", "-te", str(xmin), str(ymin), str(xmax),
+        if cache.stale('acc3', [_acc], [_acc3tif], [xmin, ymin, xmax, ymax], tools=['gdalwarp']):
+            call_tool(["gdalwarp", "-te", str(xmin), str(ymin), str(xmax),
                          str(ymax), "-overwrite", "-co", "BIGTIFF=YES","-co",'COMPRESS=DEFLATE', _acc, _acc3tif])
+            cache.done('acc3')
 
-        if not os.path.exists(dir3tau) or overwrite:
+        if cache.stale('dir3tau', [dir3tif], [dir3tau]):
             print("converting directions into TAUDEM directions...")
             directions_tau(dir3tif, dir3tau)
+            cache.done('dir3tau')
 
-        if not os.path.exists(are3tif) or overwrite:
+        if cache.stale('are3', [dir3tau], [are3tif]):
             print("calculating area in extent...")
             calculate_area(dir3tau, are3tif)
+            cache.done('are3')
 
-        if not acc_area and (not os.path.exists(acc3tiff) or overwrite):
+        if not acc_area and cache.stale('acc3area', [_acc3tif, are3tif], [acc3tif]):
             print("getting flow accumulation in km2...")
             multiply_rasters(_acc3tif, are3tif, acc3tif)
+            cache.done('acc3area')
 
-        if not os.path.exists(net3tif) or overwrite:
+        if cache.stale('net3', [acc3tif], [net3tif], [thresh]):
             print("thresholding accumulation to get river network...")
             rasterthreshold(acc3tif, thresh, 'Int16', net3tif)
+            cache.done('net3')
 
-        if not os.path.exists(dir3tau_mask) or overwrite:
+        if cache.stale('dir3tau_mask', [dir3tau, net3tif], [dir3tau_mask]):
             print("masking directions based on river network...")
             rastermask(dir3tau, net3tif, "Int16", dir3tau_mask)
+            cache.done('dir3tau_mask')
 
-        if not os.path.exists(out3shp) or overwrite:
+        if cache.stale('out3', [dir3tau_mask], [out3shp, out3tif], tools=['gdal_rasterize']):
             print("writing outlets and inland depressions in shapefile...")
             write_outlets(out3shp, dir3tau_mask)
+            cache.done('out3')
 
-        if not os.path.exists(cat3tif) or overwrite:
+        if cache.stale('cat3', [dir3tau, out3shp], [cat3tif], tools=['gagewatershed']):
             print("writing basins file...")
-            subprocess.call(["gagewatershed", "-p", dir3tau,
+            call_tool(["gagewatershed", "-p", dir3tau,
                          "-gw", cat3tif, "-o", out3shp])
+            cache.done('cat3')
 
-        if streamnet == 'yes':
+        if streamnet == 'yes' and cache.stale('streamnet3d8', [dem3tif, dir3tau, acc3tif, net3tif, out3shp],
+                                              [strn_ord3d8, strn_tree3d8, strn_coord3d8, stren_net3d8, stren_w3d8],
+                                              tools=['mpiexec', 'streamnet']):
             # Streamnet fails if stren_net exists so remove first
-            if os.path.exists(stren_net3d8) and overwrite: 
+            if os.path.exists(stren_net3d8):
                 shutil.rmtree(stren_net3d8)
-            if not os.path.exists(stren_net3d8):
-                # PFU: input -fel = dem3tif for correct slope in output streamnet
-                subprocess.call(["mpiexec", "-n", nproc, "streamnet", "-fel", dem3tif, "-p", dir3tau, "-ad8", acc3tif, "-src", net3tif, "-ord",
-                             strn_ord3d8, "-tree", strn_tree3d8, "-coord", strn_coord3d8, "-net", stren_net3d8, "-w", stren_w3d8, "-o", out3shp])
+            # PFU: input -fel = dem3tif for correct slope in output streamnet
+            call_tool(["mpiexec", "-n", nproc, "streamnet", "-fel", dem3tif, "-p", dir3tau, "-ad8", acc3tif, "-src", net3tif, "-ord",
+                         strn_ord3d8, "-tree", strn_tree3d8, "-coord", strn_coord3d8, "-net", stren_net3d8, "-w", stren_w3d8, "-o", out3shp])
+            cache.done('streamnet3d8')
 
-        if not os.path.exists(dir3tau_maskd4) or overwrite:
+        if cache.stale('dir3tau_maskd4', [dir3tau_mask], [dir3tau_maskd4, net3tifd4]):
             print("creating D4 river network...")
             d82d4(dir3tau_mask, dir3tau_maskd4, net3tifd4)
+            cache.done('dir3tau_maskd4')
 
-        if not os.path.exists(out3shpd4) or overwrite:
+        if cache.stale('out3d4', [dir3tau_maskd4], [out3shpd4, out3tifd4], tools=['gdal_rasterize']):
             print("writing D4 outlets and inland depression in shapefile")
             write_outlets(out3shpd4, dir3tau_maskd4)
+            cache.done('out3d4')
 
-        if not os.path.exists(dir3taud4) or overwrite:
+        if cache.stale('dir3taud4', [dir3tau, dir3tau_maskd4], [dir3taud4]):
             print("create flow directions map D4...")
             create_dir_d4(dir3taud4, dir3tau, dir3tau_maskd4)
+            cache.done('dir3taud4')
 
-        if not os.path.exists(cat3tifd4) or overwrite:
+        if cache.stale('cat3d4', [dir3taud4, out3shpd4], [cat3tifd4], tools=['gagewatershed']):
             print("writing basins file D4...")
-            subprocess.call(["gagewatershed", "-p", dir3taud4,
+            call_tool(["gagewatershed", "-p", dir3taud4,
                          "-gw", cat3tifd4, "-o", out3shpd4])
+            cache.done('cat3d4')
 
-        if streamnet == 'yes':
+        if streamnet == 'yes' and cache.stale('streamnet3d4', [dem3tif, dir3tau_maskd4, acc3tif, net3tifd4, out3shpd4],
+                                              [strn_ord3d4, strn_tree3d4, strn_coord3d4, stren_net3d4, stren_w3d4],
+                                              tools=['mpiexec', 'streamnet']):
             # Streamnet fails if stren_net exists so remove first
-            if os.path.exists(stren_net3d4) and overwrite: 
+            if os.path.exists(stren_net3d4):
                 shutil.rmtree(stren_net3d4)
-            if not os.path.exists(stren_net3d4):
-                # PFU: input -fel = dem3tif for correct slope in output streamnet
-                subprocess.call(["mpiexec", "-n", nproc, "streamnet", "-fel", dem3tif, "-p", dir3tau_maskd4, "-ad8", acc3tif, "-src", net3tifd4,
-                             "-ord", strn_ord3d4, "-tree", strn_tree3d4, "-coord", strn_coord3d4, "-net", stren_net3d4, "-w", stren_w3d4, "-o", out3shpd4])
+            # PFU: input -fel = dem3tif for correct slope in output streamnet
+            call_tool(["mpiexec", "-n", nproc, "streamnet", "-fel", dem3tif, "-p", dir3tau_maskd4, "-ad8", acc3tif, "-src", net3tifd4,
+                         "-ord", strn_ord3d4, "-tree", strn_tree3d4, "-coord", strn_coord3d4, "-net", stren_net3d4, "-w", stren_w3d4, "-o", out3shpd4])
+            cache.done('streamnet3d4')
 
 
     ########################################################################################
@@ -304,79 +339,96 @@ def prepdata(argv):
         ymin = geo[1] + np.floor((ymin0 - geo[1])/geo[7])*geo[7]
         xmax = geo[2] + np.floor((xmax0 - geo[2])/geo[6])*geo[6]
         ymax = geo[3] + np.floor((ymax0 - geo[3])/geo[7])*geo[7]
-        if not os.path.exists(dir30tif) or overwrite:
-            subprocess.call(["gdalwarp", "-te", str(xmin), str(ymin),
+        if cache.stale('dir30', [_dir], [dir30tif], [xmin, ymin, xmax, ymax], tools=['gdalwarp']):
+            call_tool(["gdalwarp", "-te", str(xmin), str(ymin),
                          str(xmax), str(ymax), "-overwrite", _dir, dir30tif])
+            cache.done('dir30')
 
-        if not os.path.exists(_acc30tif) or overwrite:
-            subprocess.call(["gdalwarp", "-te", str(xmin), str(ymin), str(xmax),
+        if cache.stale('acc30', [_acc], [_acc30tif], [xmin, ymin, xmax, ymax], tools=['gdalwarp']):
+            call_tool(["gdalwarp", "-te", str(xmin), str(ymin), str(xmax),
                          str(ymax), "-overwrite", "-co", "BIGTIFF=YES", _acc, _acc30tif])
+            cache.done('acc30')
 
-        if not os.path.exists(dir30tau) or overwrite:
+        if cache.stale('dir30tau', [dir30tif], [dir30tau]):
             print("converting directions into TAUDEM directions...")
             directions_tau(dir30tif, dir30tau)
+            cache.done('dir30tau')
 
-        if not os.path.exists(are30tif) or overwrite:
+        if cache.stale('are30', [dir30tau], [are30tif]):
             print("calculating area in extent...")
             calculate_area(dir30tau, are30tif)
+            cache.done('are30')
 
-        if not acc_area and (not os.path.exists(acc30tiff) or overwrite):
+        if not acc_area and cache.stale('acc30area', [_acc30tif, are30tif], [acc30tif]):
             print("getting flow accumulation in km2...")
             multiply_rasters(_acc30tif, are30tif, acc30tif)
+            cache.done('acc30area')
 
-        if not os.path.exists(net30tif) or overwrite:
+        if cache.stale('net30', [acc30tif], [net30tif], [thresh]):
             print("thresholding accumulation to get river network...")
             rasterthreshold(acc30tif, thresh, 'Int16', net30tif)
+            cache.done('net30')
 
-        if not os.path.exists(dir30tau_mask) or overwrite:
+        if cache.stale('dir30tau_mask', [dir30tau, net30tif], [dir30tau_mask]):
             print("masking directions based on river network...")
             rastermask(dir30tau, net30tif, "Int16", dir30tau_mask)
+            cache.done('dir30tau_mask')
 
-        if not os.path.exists(out30shp) or overwrite:
+        if cache.stale('out30', [dir30tau_mask], [out30shp, out30tif], tools=['gdal_rasterize']):
             print("writing outlets and inland depressions in shapefile...")
             write_outlets(out30shp, dir30tau_mask)
+            cache.done('out30')
 
-        if not os.path.exists(cat30tif) or overwrite:
+        if cache.stale('cat30', [dir30tau, out30shp], [cat30tif], tools=['gagewatershed']):
             print("writing basins file...")
-            subprocess.call(["gagewatershed", "-p", dir30tau,
+            call_tool(["gagewatershed", "-p", dir30tau,
                          "-gw", cat30tif, "-o", out30shp])
+            cache.done('cat30')
 
-        if streamnet == 'yes':
+        if streamnet == 'yes' and cache.stale('streamnet30d8', [net30tif, dir30tau, acc30tif, out30shp],
+                                              [strn_ord30d8, strn_tree30d8, strn_coord30d8, stren_net30d8, stren_w30d8],
+                                              tools=['mpiexec', 'streamnet']):
             # Streamnet fails if stren_net exists so remove first
-            if os.path.exists(stren_net30d8) and overwrite: 
+            if os.path.exists(stren_net30d8):
                 shutil.rmtree(stren_net30d8)
-            if not os.path.exists(stren_net30d8):
-                # PFU: input -fel should be dem for correct slope in output stremnet
-                # BUT we dont have a dem file at 30s
-                subprocess.call(["mpiexec", "-n", nproc, "streamnet", "-fel", net30tif, "-p", dir30tau, "-ad8", acc30tif, "-src", net30tif, "-ord",
-                             strn_ord30d8, "-tree", strn_tree30d8, "-coord", strn_coord30d8, "-net", stren_net30d8, "-w", stren_w30d8, "-o", out30shp])
+            # PFU: input -fel should be dem for correct slope in output stremnet
+            # BUT we dont have a dem file at 30s
+            call_tool(["mpiexec", "-n", nproc, "streamnet", "-fel", net30tif, "-p", dir30tau, "-ad8", acc30tif, "-src", net30tif, "-ord",
+                         strn_ord30d8, "-tree", strn_tree30d8, "-coord", strn_coord30d8, "-net", stren_net30d8, "-w", stren_w30d8, "-o", out30shp])
+            cache.done('streamnet30d8')
 
-        if not os.path.exists(dir30tau_maskd4) or overwrite:
+        if cache.stale('dir30tau_maskd4', [dir30tau_mask], [dir30tau_maskd4, net30tifd4]):
             print("creating D4 river network...")
             d82d4(dir30tau_mask, dir30tau_maskd4, net30tifd4)
+            cache.done('dir30tau_maskd4')
 
-        if not os.path.exists(out30shpd4) or overwrite:
+        if cache.stale('out30d4', [dir30tau_maskd4], [out30shpd4, out30tifd4], tools=['gdal_rasterize']):
             print("writing D4 outlets and inland depression in shapefile...")
             write_outlets(out30shpd4, dir30tau_maskd4)
+            cache.done('out30d4')
 
-        if not os.path.exists(dir30taud4) or overwrite:
+        if cache.stale('dir30taud4', [dir30tau, dir30tau_maskd4], [dir30taud4]):
             print("create flow directions map D4...")
             create_dir_d4(dir30taud4, dir30tau, dir30tau_maskd4)
+            cache.done('dir30taud4')
 
-        if not os.path.exists(cat30tifd4) or overwrite:
+        if cache.stale('cat30d4', [dir30taud4, out30shpd4], [cat30tifd4], tools=['gagewatershed']):
             print("writing basins file D4...")
-            subprocess.call(["gagewatershed", "-p", dir30taud4,
+            call_tool(["gagewatershed", "-p", dir30taud4,
                          "-gw", cat30tifd4, "-o", out30shpd4])
+            cache.done('cat30d4')
 
-        if streamnet == 'yes':
+        if streamnet == 'yes' and cache.stale('streamnet30d4', [net30tifd4, dir30tau_maskd4, acc30tif, out30shpd4],
+                                              [strn_ord30d4, strn_tree30d4, strn_coord30d4, stren_net30d4, stren_w30d4],
+                                              tools=['mpiexec', 'streamnet']):
             # Streamnet fails if stren_net exists so remove first
-            if os.path.exists(stren_net30d4) and overwrite: 
+            if os.path.exists(stren_net30d4):
                 shutil.rmtree(stren_net30d4)
-            if not os.path.exists(stren_net30d4):
-                # PFU: input -fel should be dem for correct slope in output stremnet
-                # BUT we dont have a dem file at 30s
-                subprocess.call(["mpiexec", "-n", nproc, "streamnet", "-fel", net30tifd4, "-p", dir30tau_maskd4, "-ad8", acc30tif, "-src", net30tifd4,
-                             "-ord", strn_ord30d4, "-tree", strn_tree30d4, "-coord", strn_coord30d4, "-net", stren_net30d4, "-w", stren_w30d4, "-o", out30shpd4])
+            # PFU: input -fel should be dem for correct slope in output stremnet
+            # BUT we dont have a dem file at 30s
+            call_tool(["mpiexec", "-n", nproc, "streamnet", "-fel", net30tifd4, "-p", dir30tau_maskd4, "-ad8", acc30tif, "-src", net30tifd4,
+                         "-ord", strn_ord30d4, "-tree", strn_tree30d4, "-coord", strn_coord30d4, "-net", stren_net30d4, "-w", stren_w30d4, "-o", out30shpd4])
+            cache.done('streamnet30d4')
 
 
 def directions_tau(inputrast, outputrast):
@@ -510,17 +562,9 @@ def write_outlets(outshp, dirtif_mask):
             x.append(geo[8][col])
             y.append(geo[9][row])
 
-    # Initiate shapefile
-    w = shapefile.Writer(shapefile.POINT)
-    w.field('x')
-    w.field('y')
-    w.field('id')
-
     # Write coordinate points in shapefile
-    for i in range(len(x)):
-        w.point(x[i], y[i])
-        w.record(x[i], y[i], i)
-    w.save(outshp)
+    shapefile.write_points(outshp, x, y, misc_utils.point_fields([]) + [('id', 'N', 10, 0)],
+                           [x, y, np.arange(len(x))])
     fname = os.path.dirname(outshp)+'/' + \
         os.path.basename(outshp).split('.')[0] + '.prj'
     prj = open(fname, "w")
@@ -536,7 +580,7 @@ def write_outlets(outshp, dirtif_mask):
         os.path.basename(outshp).split('.')[0] + '.shp'
     name2 = os.path.dirname(outshp)+'/' + \
         os.path.basename(outshp).split('.')[0] + '.tif'
-    subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-ot", typ, "-of", fmt, "-tr", str(geo[6]), str(geo[7]),
+    call_tool(["gdal_rasterize", "-a_nodata", str(nodata), "-ot", typ, "-of", fmt, "-tr", str(geo[6]), str(geo[7]),
                      "-burn", "1", "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
 
 
@@ -634,5 +678,17 @@ def multiply_rasters(rast1, rast2, out):
     gdalutils.write_raster(res.filled(), out, geo1, "Float32", -9999)
 
 
+def call_tool(cmd):
+    """
+    Run an external tool (gdalwarp, TauDEM, ...), exit if it fails so
+    its step is not recorded as done in the build cache
+    """
+
+    code = subprocess.call(cmd)
+    if code != 0:
+        sys.exit('ERROR ' + cmd[0] + ' failed with exit code ' + str(code) +
+                 ': ' + ' '.join(cmd))
+
+
 if __name__ == '__main__':
     prepdata(sys.argv[1:])
@@ -10,8 +10,10 @@ import getopt
 import configparser
 import numpy as np
 import multiprocessing as mp
-import gdalutils
-from osgeo import osr
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
+osr = lazy_import('osgeo.osr')
+gdal = lazy_import('osgeo.gdal')
 
 
 def rasterresample_shell(argv):
@@ -38,13 +40,35 @@ Content in config.txt
 ---------------------
 [rasterresample]
 nproc    = Number of cores to use
-outlier  = Outlier detection yes/no
-method   = Reduction method mean, min, meanmin
+outlier  = Outlier detection yes/no, comma separated list e.g. yes,no
+method   = Reduction method mean, min, meanmin, comma separated list
+           e.g. mean,min,meanmin
 hrnodata = High resolution NODATA value
-thresh   = Searching windows threshold
+thresh   = Searching windows threshold for the finest target grid, scaled
+           by resolution for coarser grids
 demf     = High resolution DEM
-netf     = Target mask file path
-output   = Output file, GeoTIFF output
+netf     = Target mask file path, comma separated list for several grids
+output   = Output file, GeoTIFF output, one per netf
+factors  = (Optional) comma separated integer aggregation factors of the
+           finest netf grid e.g. 2,4, written as output_x2.tif, output_x4.tif
+engine   = (Optional) window (default) or warp, warp uses GDAL warp kernel
+           (average, min) for outlier = no in-process
+warpmem  = (Optional) GDAL warp memory in MB, default 512
+nthreads = (Optional) GDAL warp threads, default nproc
+compare  = (Optional) yes/no, with engine = warp also run the window method
+           and report differences
+multiband = (Optional) yes/no, when several methods or outlier options are
+           given write a multi-band GeoTIFF (yes, default) or one file per
+           combination named as output_method[_outlier].tif (no)
+
+Every window in the high resolution DEM is read once, all combinations of
+method and outlier are calculated from the same window. Target grids nested
+in a finer one (integer resolution ratio and aligned corners) are derived
+from the finer block statistics (sum, count, min) instead of reading the
+high resolution DEM again, except for outlier = yes which is not
+decomposable in blocks. This needs windows tiling the high resolution DEM,
+thresh close to half the finest target resolution and grids aligned to the
+DEM pixels, otherwise every grid is read from the DEM.
 '''
 
     try:
@@ -56,7 +80,9 @@ output   = Output file, GeoTIFF output
         print(myhelp)
         sys.exit(0)
 
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'multiband': 'yes', 'factors': '',
+                                           'engine': 'window', 'warpmem': '512',
+                                           'nthreads': '', 'compare': 'no'})
     config.read(inifile)
 
     method = str(config.get('rasterresample', 'method'))
@@ -68,22 +94,194 @@ output   = Output file, GeoTIFF output
     thresh = np.float64(config.get('rasterresample', 'thresh'))
     nproc = np.float64(config.get('rasterresample', 'nproc')
                        )  # number of cpus to use
+    multiband = str(config.get('rasterresample', 'multiband'))
+    factors = str(config.get('rasterresample', 'factors'))
+    engine = str(config.get('rasterresample', 'engine'))
+    warpmem = int(config.get('rasterresample', 'warpmem'))
+    nthreads = str(config.get('rasterresample', 'nthreads'))
+    nthreads = int(nproc) if nthreads == '' else int(nthreads)
+    compare = str(config.get('rasterresample', 'compare'))
 
-    rasterresample(method,demf,netf,output,outlier,hrnodata,thresh,nproc)
+    rasterresample(method,demf,netf,output,outlier,hrnodata,thresh,nproc,multiband,factors,
+                   engine,warpmem,nthreads,compare)
 
-def rasterresample(method,demf,netf,output,outlier,hrnodata,thresh,nproc):
+def rasterresample(method,demf,netf,output,outlier,hrnodata,thresh,nproc,multiband='yes',factors='',
+                   engine='window',warpmem=512,nthreads=None,compare='no'):
 
     print("    running rasterresample.py...")
 
     fname1 = demf
-    fname2 = output
 
-    # coordinates for bank elevations are based in river network mask
-    net = gdalutils.get_data(netf)
-    geo = gdalutils.get_geo(netf)
+    if engine not in ('window', 'warp'):
+        sys.exit('ERROR engine not recognised')
+    if nthreads is None:
+        nthreads = int(nproc)
+
+    # Several methods and outlier options can be requested in a single run
+    methods = split_list(method)
+    outliers = split_list(outlier)
+    for m in methods:
+        if m not in ('mean', 'min', 'meanmin'):
+            sys.exit('ERROR method not specified')
+
+    # Several target grids can be requested in a single run, one output
+    # file per target mask plus one per aggregation factor
+    netfs = split_list(netf)
+    outputs = split_list(output)
+    if len(netfs) != len(outputs):
+        sys.exit('ERROR number of netf and output files should be equal')
+
+    levels = [{'geo': gdalutils.get_geo(f), 'output': o}
+              for f, o in zip(netfs, outputs)]
+    levels.sort(key=lambda l: abs(l['geo'][6]))
+    finest = levels[0]
+    root = os.path.splitext(finest['output'])[0]
+    for k in split_list(factors):
+        levels.append({'geo': aggregate_geo(finest['geo'], int(k)),
+                       'output': root + '_x' + str(int(k)) + '.tif'})
+    levels.sort(key=lambda l: abs(l['geo'][6]))
+
+    # Levels are processed from finer to coarser, a level nested in an
+    # already processed level is derived from its block statistics
+    # instead of reading the high resolution DEM again
+    hrgeo = gdalutils.get_geo(fname1)
+    done = []
+    for level in levels:
+
+        geo = level['geo']
+
+        # thresh refers to the finest grid, scale it for coarser grids
+        scale = abs(geo[6]/finest['geo'][6])
+
+        if engine == 'warp':
+            stats = calc_resampling_engine(fname1, hrnodata, geo, thresh*scale,
+                                           outliers, nproc, warpmem, nthreads,
+                                           compare, methods, level['output'])
+            # Averages of averages are not exact, warped levels are
+            # not used to derive coarser levels
+            write_stats(stats, geo, methods, outliers, level['output'],
+                        hrnodata, multiband)
+            continue
+
+        # Block statistics are only exact for windows tiling the DEM
+        level['tiled'] = window_tiles(geo, thresh*scale, hrgeo)
+        parent = None
+        if level['tiled']:
+            parent, k, r0, c0 = find_parent(geo, [l for l in done if l['tiled']])
+
+        if parent is None:
+            stats = calc_resampling_grid(fname1, hrnodata, geo, thresh*scale,
+                                         outliers, nproc)
+        else:
+            print("    aggregating " + level['output'] + " from " +
+                  parent['output'] + " by a factor of " + str(k))
+            stats = aggregate_stats(parent['stats'], parent['geo'], geo,
+                                    k, r0, c0)
+
+            # Outlier detection is not decomposable in blocks, outlier
+            # options are calculated from the high resolution DEM
+            iout = [j for j, o in enumerate(outliers) if o == 'yes']
+            if iout:
+                stats[iout] = calc_resampling_grid(
+                    fname1, hrnodata, geo, thresh*scale, ['yes']*len(iout), nproc)
+
+        level['stats'] = stats
+        done.append(level)
+
+        write_stats(stats, geo, methods, outliers, level['output'],
+                    hrnodata, multiband)
+
+
+def calc_resampling_engine(fname1, hrnodata, geo, thresh, outliers, nproc,
+                           warpmem, nthreads, compare, methods, fname):
+    """
+    Window statistics for a target grid by using GDAL warp kernel for
+    outlier = no, outlier = yes is always calculated with windows
+    """
+
+    stats = np.ones([len(outliers), 3, int(geo[4])*int(geo[5])])*np.nan
+
+    ino = [j for j, o in enumerate(outliers) if o != 'yes']
+    iout = [j for j, o in enumerate(outliers) if o == 'yes']
+
+    if ino:
+        print("    warping " + fname + " with GDAL...")
+        wstats = calc_resampling_warp(fname1, hrnodata, geo, warpmem, nthreads)
+        stats[ino] = wstats
+
+        if compare == 'yes':
+            cstats = calc_resampling_grid(fname1, hrnodata, geo, thresh,
+                                          ['no'], nproc)[0]
+            compare_stats(wstats, cstats, methods, fname)
+
+    if iout:
+        stats[iout] = calc_resampling_grid(fname1, hrnodata, geo, thresh,
+                                           ['yes']*len(iout), nproc)
+
+    return stats
+
+
+def calc_resampling_warp(fname1, hrnodata, geo, warpmem, nthreads):
+    """
+    Mean and min of the high resolution DEM on a target grid by using
+    GDAL multithreaded warp kernel (average and min resampling). Returns
+    statistics as (mean, count, min) with count 1 for valid pixels so
+    they can be reduced as window statistics
+    """
+
+    xres = abs(geo[6])
+    yres = abs(geo[7])
+
+    # Target extent from pixel centres
+    bounds = [geo[8][0] - xres/2., geo[9][-1] - yres/2.,
+              geo[8][-1] + xres/2., geo[9][0] + yres/2.]
+
+    res = []
+    for alg in ('average', 'min'):
+        ds = gdal.Warp('', fname1, format='MEM', outputBounds=bounds,
+                       xRes=xres, yRes=yres, resampleAlg=alg,
+                       srcNodata=hrnodata, dstNodata=np.nan,
+                       outputType=gdal.GDT_Float64, multithread=True,
+                       warpMemoryLimit=warpmem,
+                       warpOptions=['NUM_THREADS=' + str(nthreads)])
+        res.append(ds.GetRasterBand(1).ReadAsArray().ravel())
+        ds = None
+
+    mean, mins = res
+    count = np.where(np.isnan(mean), 0, 1)
+
+    return np.stack([mean, count, mins])
+
+
+def compare_stats(wstats, cstats, methods, fname):
+    """
+    Report differences between warp and window engines for every method
+    """
+
+    print("    engine comparison for " + fname + " (warp - window)")
+    for m in methods:
+        a = reduce_stats(wstats, m)
+        b = reduce_stats(cstats, m)
+        both = np.isfinite(a) & np.isfinite(b)
+        only = np.isfinite(a) ^ np.isfinite(b)
+        if both.any():
+            diff = a[both] - b[both]
+            print("      %-8s pixels %d, max abs %.4f, mean abs %.4f, "
+                  "rmse %.4f, bias %.4f, valid in one only %d" % (
+                      m, both.sum(), np.abs(diff).max(), np.abs(diff).mean(),
+                      np.sqrt(np.mean(diff**2)), diff.mean(), only.sum()))
+        else:
+            print("      %-8s no pixels valid in both engines" % m)
+
+
+def calc_resampling_grid(fname1, hrnodata, geo, thresh, outliers, nproc):
+    """
+    Window statistics for every pixel in a target grid, returns an array
+    with shape (len(outliers), 3, pixels)
+    """
 
     # consider all pixels in net30 including river network pixels
-    iy, ix = np.where(net > -1)
+    iy, ix = np.indices((int(geo[5]), int(geo[4]))).reshape(2, -1)
     x = geo[8][ix]
     y = geo[9][iy]
 
@@ -97,7 +295,7 @@ def rasterresample(method,demf,netf,output,outlier,hrnodata,thresh,nproc):
     # Setup a list of processes that we want to run
     processes = []
     processes = [mp.Process(target=calc_resampling_mp, args=(
-        i, queue, fname1, hrnodata, split_x[i], split_y[i], thresh, outlier, method)) for i in range(len(split_x))]
+        i, queue, fname1, hrnodata, split_x[i], split_y[i], thresh, outliers)) for i in range(len(split_x))]
 
     # Run processes
     for p in processes:
@@ -107,22 +305,155 @@ def rasterresample(method,demf,netf,output,outlier,hrnodata,thresh,nproc):
     results = [queue.get() for p in processes]
 
     # Retrieve results in a particular order
-    results.sort()
+    results.sort(key=lambda r: r[0])
     results = [r[1] for r in results]
 
-    # Stack results horizontally
-    elev = np.hstack(results).reshape(net.shape)
+    # Stack results horizontally, stats has shape (outliers, 3, pixels)
+    return np.concatenate(results, axis=-1)
 
-    # Replace NaN by hrnodata
-    elev[np.isnan(elev)] = hrnodata
+
+def write_stats(stats, geo, methods, outliers, fname, hrnodata, multiband):
+    """
+    Derive every method from window statistics and write them in a
+    single or multi-band GeoTIFF
+    """
+
+    shape = (int(geo[5]), int(geo[4]))
+
+    bands = []
+    names = []
+    for m in methods:
+        for j, o in enumerate(outliers):
+            elev = reduce_stats(stats[j], m).reshape(shape)
+
+            # Replace NaN by hrnodata
+            elev[np.isnan(elev)] = hrnodata
+
+            bands.append(elev)
+            names.append(m + '_outlier' if o == 'yes' else m)
 
     # elev = calc_resampling(fname1,hrnodata,x,y,ix,iy,thresh,outlier,method)
-    gdalutils.write_raster(elev, fname2, geo, "Float32", hrnodata)
+    if len(bands) == 1:
+        gdalutils.write_raster(bands[0], fname, geo, "Float32", hrnodata)
+    elif multiband == 'yes':
+        write_raster_bands(bands, names, fname, geo, "Float32", hrnodata)
+    else:
+        root = os.path.splitext(fname)[0]
+        for elev, name in zip(bands, names):
+            gdalutils.write_raster(elev, root + '_' + name + '.tif', geo,
+                                   "Float32", hrnodata)
+
+
+def aggregate_geo(geo, k):
+    """
+    Geo information of a grid k times coarser than geo sharing its
+    upper left corner, incomplete blocks at the right and bottom are dropped
+    """
+
+    nx = int(geo[4])//k
+    ny = int(geo[5])//k
+    xres = geo[6]*k
+    yres = geo[7]*k
+
+    # Pixel centres of the coarse grid from the corner of the fine grid
+    x0 = geo[8][0] - geo[6]/2.
+    y0 = geo[9][0] - geo[7]/2.
+    x = x0 + xres/2. + np.arange(nx)*xres
+    y = y0 + yres/2. + np.arange(ny)*yres
 
+    # Extent keeps the same convention as the fine grid (edges or centres)
+    fx = (geo[8][0] - geo[0])/geo[6]
+    fy = (geo[9][0] - geo[3])/geo[7]
+    xmin = x[0] - fx*xres
+    xmax = x[-1] + fx*xres
+    ymax = y[0] - fy*yres
+    ymin = y[-1] + fy*yres
 
-def calc_resampling_mp(pos, queue, fname1, hrnodata, x, y, thresh, outlier, method):
+    return [xmin, ymin, xmax, ymax, nx, ny, xres, yres, x, y, geo[10], geo[11]]
 
-    elev = np.ones([len(x)])*hrnodata
+
+def window_tiles(geo, thresh, hrgeo):
+    """
+    True if windows of half size thresh around the pixels of geo select
+    the pixels of the high resolution grid hrgeo inside every pixel, every
+    high resolution pixel in one window only
+    """
+
+    for res, hres, edge, hedge in ((geo[6], hrgeo[6], geo[0], hrgeo[0]),
+                                   (geo[7], hrgeo[7], geo[3], hrgeo[3])):
+        # Pixel edges on high resolution pixel edges
+        n = abs(res/hres)
+        off = (edge - hedge)/abs(hres)
+        if abs(n - round(n)) > 1e-6 or abs(off - round(off)) > 1e-6:
+            return False
+        # High resolution pixel centres are half a pixel away from the
+        # edges, a window closer than that to the pixel selects the same
+        if abs(thresh - abs(res)/2.) >= abs(hres)/2.:
+            return False
+    return True
+
+
+def find_parent(geo, levels):
+    """
+    Find the coarsest level in which geo is nested, returns the level,
+    aggregation factor and row and column offsets in the parent grid
+    """
+
+    for parent in reversed(levels):
+        pgeo = parent['geo']
+        rx = geo[6]/pgeo[6]
+        ry = geo[7]/pgeo[7]
+        k = int(round(rx))
+        if k < 2 or abs(rx - k) > 1e-6 or abs(ry - k) > 1e-6:
+            continue
+
+        # Upper left corners should be aligned to the parent pixels
+        c0 = ((geo[8][0] - geo[6]/2.) - (pgeo[8][0] - pgeo[6]/2.))/pgeo[6]
+        r0 = ((geo[9][0] - geo[7]/2.) - (pgeo[9][0] - pgeo[7]/2.))/pgeo[7]
+        if abs(c0 - round(c0)) > 1e-6 or abs(r0 - round(r0)) > 1e-6:
+            continue
+        c0 = int(round(c0))
+        r0 = int(round(r0))
+
+        # and the grid should be inside the parent grid
+        if (c0 < 0 or r0 < 0 or c0 + int(geo[4])*k > int(pgeo[4]) or
+                r0 + int(geo[5])*k > int(pgeo[5])):
+            continue
+
+        return parent, k, r0, c0
+
+    return None, None, None, None
+
+
+def aggregate_stats(stats, pgeo, geo, k, r0, c0):
+    """
+    Aggregate window statistics (sum, count, min) in blocks of k x k pixels
+    """
+
+    nout = stats.shape[0]
+    ny = int(geo[5])
+    nx = int(geo[4])
+
+    blocks = stats.reshape(nout, 3, int(pgeo[5]), int(pgeo[4]))
+    blocks = blocks[:, :, r0:r0+ny*k, c0:c0+nx*k].reshape(nout, 3, ny, k, nx, k)
+
+    count = blocks[:, 1].sum(axis=(2, 4))
+    total = np.nansum(blocks[:, 0], axis=(2, 4))
+    mins = np.where(np.isnan(blocks[:, 2]), np.inf, blocks[:, 2]).min(axis=(2, 4))
+    total[count == 0] = np.nan
+    mins[count == 0] = np.nan
+
+    return np.stack([total, count, mins], axis=1).reshape(nout, 3, -1)
+
+
+def calc_resampling_mp(pos, queue, fname1, hrnodata, x, y, thresh, outliers):
+    """
+    Read every window once and calculate sum, count and min of valid
+    pixels for every outlier option, returns an array with shape
+    (len(outliers), 3, len(x))
+    """
+
+    stats = np.ones([len(outliers), 3, len(x)])*np.nan
 
     for i in range(len(x)):
 
@@ -135,26 +466,85 @@ def calc_resampling_mp(pos, queue, fname1, hrnodata, x, y, thresh, outlier, meth
 
         dem, dem_geo = gdalutils.clip_raster(fname1, xmin, ymin, xmax, ymax)
         ddem = np.ma.masked_values(dem, hrnodata)
-        shape = dem.shape
 
-        # Check for outliers
-        if outlier == "yes":
-            ddem = check_outlier(dem, ddem, hrnodata, 3.5)
+        for j, outlier in enumerate(outliers):
 
-        # Method to applied at every kernel
-        if method == "meanmin":
-            elev[i] = np.mean([ddem.mean(), ddem.min()])
+            # Check for outliers, check_outlier modifies dem so use a copy
+            if outlier == "yes":
+                stats[j, :, i] = block_stats(
+                    check_outlier(dem.copy(), ddem, hrnodata, 3.5))
+            else:
+                stats[j, :, i] = block_stats(ddem)
 
-        elif method == "mean":
-            elev[i] = ddem.mean()
+    queue.put((pos, stats))
 
-        elif method == "min":
-            elev[i] = ddem.min()
 
-        else:
-            sys.exit('ERROR method not specified')
+def block_stats(ddem):
+    """
+    Sum, count and min of a masked window, NaN when all pixels are masked
+    """
+
+    count = ddem.count()
+    if count == 0:
+        return np.nan, 0, np.nan
+    return ddem.sum(), count, ddem.min()
+
+
+def reduce_stats(stats, method):
+    """
+    Apply reduction method to an array of window statistics (sum, count, min)
+    """
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = stats[0]/stats[1]
+
+    if method == "meanmin":
+        return (mean + stats[2])/2.
+    elif method == "mean":
+        return mean
+    elif method == "min":
+        return stats[2].copy()
+    else:
+        sys.exit('ERROR method not specified')
+
+
+def split_list(value):
+    """
+    Split a comma separated config value in a list, lists are returned as they are
+    """
+
+    if isinstance(value, str):
+        return [i.strip() for i in value.split(',') if i.strip()]
+    return list(value)
+
+
+def write_raster_bands(bands, names, fname, geo, fmt, nodata):
+    """
+    Write a list of arrays in a multi-band GeoTIFF, band descriptions
+    are taken from names
+    """
 
-    queue.put((pos, elev))
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(fname, int(geo[4]), int(geo[5]), len(bands),
+                       gdal.GetDataTypeByName(fmt), ['COMPRESS=DEFLATE'])
+
+    # Pixel corner from pixel centre coordinates
+    ds.SetGeoTransform([geo[8][0] - geo[6]/2., geo[6], 0,
+                        geo[9][0] - geo[7]/2., 0, geo[7]])
+    if hasattr(geo[10], 'ExportToWkt'):
+        ds.SetProjection(geo[10].ExportToWkt())
+    else:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        ds.SetProjection(srs.ExportToWkt())
+
+    for i, (band, name) in enumerate(zip(bands, names)):
+        b = ds.GetRasterBand(i+1)
+        b.SetNoDataValue(nodata)
+        b.SetDescription(name)
+        b.WriteArray(band)
+    ds.FlushCache()
+    ds = None
 
 
 def calc_resampling(fname1, hrnodata, x, y, ix, iy, thresh, outlier, method):
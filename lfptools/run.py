@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import os
+import sys
+import time
+import getopt
+import fnmatch
+import subprocess
+import configparser
+from lfptools import buildcache
+
+# Stages the runner knows: module, shell function and keys naming the
+# outputs of the stage. Any other value in the section of a stage is a
+# candidate input, a stage depends on another one when one of its values
+# is an output of the other one (same path without extension, a file
+# derived from its name such as <output>_<name>.tif or dem_x2.tif, or a
+# path inside an output folder). Values are comma separated lists
+STAGES = {
+    'prepdata': ('prepdata', 'prepdata', ['out']),
+    'split': ('split', 'split', ['outdir']),
+    'buildindex': ('buildindex', 'buildindex_shell', ['output']),
+    'rasterresample': ('rasterresample', 'rasterresample_shell', ['output']),
+    'getwidths': ('getwidths', 'getwidths_shell', ['output']),
+    'getbankfullq': ('getbankfullq', 'getbankfullq_shell', ['output']),
+    'getbankelevs': ('getbankelevs', 'getbankelevs_shell', ['output']),
+    'samplepoints': ('samplepoints', 'samplepoints_shell', ['output']),
+    'fixelevs': ('fixelevs', 'fixelevs_shell', ['output']),
+    'getslopes': ('getslopes', 'getslopes_shell', ['output']),
+    'getdepths': ('getdepths', 'getdepths_shell', ['output']),
+    'getbedelevs': ('getbedelevs', 'getbedelevs_shell', ['output']),
+    'getinflows': ('getinflows', 'getinflows_shell', ['output']),
+    'getdischarge': ('getdischarge', 'getdischarge_shell', ['output']),
+    'getrunoff': ('getrunoff', 'getrunoff_shell', ['output']),
+    'buildmodel': ('buildmodel', 'buildmodel_shell',
+                   ['parlfp', 'bcilfp', 'bdylfp', 'evaplfp', 'gaugelfp',
+                    'stagelfp', 'dembnktif', 'dembnktif_1D']),
+}
+
+# External tools called by the stages
+TOOLS = ['gdal_rasterize', 'gdalwarp', 'gdal_calc.py', 'mpiexec', 'streamnet',
+         'gagewatershed']
+
+# Stages finished without errors
+OK = ('ok', 'cached')
+
+
+def run_shell(argv):
+
+    myhelp = '''
+LFPtools v0.1
+
+Name
+----
+run
+
+Description
+-----------
+Run several tools from a single config file. Every section named as a
+tool (e.g. [getwidths], [getbankelevs], [fixelevs]) is a stage, with the
+same content as the config file of the tool. The dependency graph is
+derived from the config: a stage depends on another one when one of its
+inputs is an output of the other one. Stages are run as soon as their
+inputs are ready, in parallel, without using more than `ncpu` cores (a
+stage uses as many cores as its `nproc`, 1 by default). A report with the
+duration of every stage and the critical path is printed at the end.
+
+Stages whose inputs (file digests), parameters and code did not change
+since their last run, with their outputs untouched, are not run again.
+prepdata and split also skip their own steps and basins that are up to
+date.
+
+Usage
+-----
+>> lfp-run -i config.txt
+
+Content in config.txt
+---------------------
+[run]
+ncpu   = (Optional) Cores available for all stages, default all cores
+stages = (Optional) Comma separated list of stages to run, default all
+logdir = (Optional) Folder to write the output of every stage in
+         <stage>.log, default printed on screen
+cache  = (Optional) Skip stages that are up to date [yes|no], default yes,
+         saved in <config>.lfpcache.json next to config.txt
+
+[getwidths]
+...
+
+[getdepths]
+...
+'''
+
+    try:
+        opts, args = getopt.getopt(argv, "i:")
+        for o, a in opts:
+            if o == "-i":
+                inifile = a
+    except:
+        print(myhelp)
+        sys.exit(0)
+
+    config = configparser.SafeConfigParser()
+    config.read(inifile)
+
+    ncpu = None
+    stages = None
+    logdir = ''
+    usecache = True
+    if config.has_section('run'):
+        if config.has_option('run', 'ncpu'):
+            ncpu = int(config.get('run', 'ncpu'))
+        if config.has_option('run', 'stages'):
+            stages = [i.strip() for i in config.get('run', 'stages').split(',')]
+        if config.has_option('run', 'logdir'):
+            logdir = str(config.get('run', 'logdir'))
+        if config.has_option('run', 'cache'):
+            usecache = config.get('run', 'cache').lower() == 'yes'
+
+    run(inifile, ncpu, stages, logdir, usecache)
+
+
+def run(inifile, ncpu=None, stages=None, logdir='', usecache=True):
+
+    print("    running run.py...")
+
+    config = configparser.SafeConfigParser()
+    config.read(inifile)
+
+    names = [name for name in config.sections() if name in STAGES]
+    if stages is not None:
+        for name in stages:
+            if name not in names:
+                sys.exit('ERROR stage not found in ' + inifile + ': ' + name)
+        names = [name for name in names if name in stages]
+    if len(names) == 0:
+        sys.exit('ERROR no stages found in ' + inifile)
+
+    deps = stage_graph(config, names)
+    topological_order(names, deps)
+
+    if ncpu is None:
+        ncpu = os.cpu_count() or 1
+    cost = {name: min(stage_cpu(config, name), ncpu) for name in names}
+
+    if logdir and not os.path.exists(logdir):
+        os.makedirs(logdir)
+
+    cache = buildcache.BuildCache(os.path.dirname(inifile) or '.', usecache,
+                                  name=os.path.splitext(os.path.basename(inifile))[0])
+
+    for name in names:
+        print("    " + name + " <- " + (", ".join(sorted(deps[name])) or "-"))
+
+    # Stages are started as soon as all their dependencies finished and
+    # there are enough free cores, in config order
+    pending = list(names)
+    running = {}
+    start = {}
+    duration = {}
+    status = {}
+    checked = set()
+    used = 0
+    t0 = time.time()
+    try:
+        while pending or running:
+            for name in list(pending):
+                failed = [d for d in deps[name] if status.get(d, 'ok') not in OK]
+                if failed:
+                    pending.remove(name)
+                    status[name] = 'skipped'
+                    print("    " + name + " skipped, " + failed[0] + " did not finish")
+            for name in list(pending):
+                ready = all(status.get(d) in OK for d in deps[name])
+                # Checked once, when all its inputs are ready
+                if ready and usecache and name not in checked:
+                    checked.add(name)
+                    if not stage_stale(cache, config, name):
+                        pending.remove(name)
+                        start[name] = time.time()
+                        duration[name] = 0
+                        status[name] = 'cached'
+                        print("    " + name + " is up to date")
+                        continue
+                if ready and used + cost[name] <= ncpu:
+                    pending.remove(name)
+                    running[name] = start_stage(inifile, name, logdir)
+                    start[name] = time.time()
+                    used += cost[name]
+                    print("    " + name + " started (" + str(cost[name]) + " cores)")
+            time.sleep(0.1)
+            for name, (proc, log) in list(running.items()):
+                if proc.poll() is None:
+                    continue
+                if log is not None:
+                    log.close()
+                del running[name]
+                used -= cost[name]
+                duration[name] = time.time() - start[name]
+                status[name] = 'ok' if proc.returncode == 0 else 'failed'
+                if status[name] == 'ok' and usecache:
+                    cache.done(name, [f for out in stage_outputs(config, name)
+                                      for f in buildcache.stage_files(out)])
+                print("    " + name + " " + status[name] + " in " +
+                      "%.1f" % duration[name] + " s")
+    except KeyboardInterrupt:
+        # Running stages are stopped and not recorded in the cache
+        stop_stages(running)
+        sys.exit('ERROR run interrupted, stopped stages: ' +
+                 (', '.join(sorted(running)) or '-'))
+    wall = time.time() - t0
+
+    report(names, deps, start, duration, status, t0, wall, ncpu)
+
+    if any(status[name] not in OK for name in names):
+        sys.exit('ERROR some stages failed')
+
+
+def stage_outputs(config, name):
+    """
+    Output paths of a stage as written in its section, comma separated
+    values are split
+    """
+
+    outputs = []
+    for key in STAGES[name][2]:
+        if config.has_option(name, key):
+            outputs += [i.strip() for i in config.get(name, key).split(',') if i.strip()]
+    return outputs
+
+
+def stage_stale(cache, config, name):
+    """
+    True if a stage has to run, its fingerprint is made of its parameters,
+    the files it reads, its code and the tools it calls
+    """
+
+    outputs = stage_outputs(config, name)
+    params = sorted(config.items(name))
+    inputs = []
+    for key, value in params:
+        if key in STAGES[name][2]:
+            continue
+        for i in value.split(','):
+            inputs += buildcache.input_files(i.strip())
+    return cache.stale(name, sorted(set(inputs)), outputs, params,
+                       buildcache.code_files(STAGES[name][0]), TOOLS)
+
+
+def stage_graph(config, names):
+    """
+    Dependencies of every stage, set of stages producing its inputs
+    """
+
+    outputs = {name: [os.path.normpath(i) for i in stage_outputs(config, name)]
+               for name in names}
+
+    deps = {}
+    for name in names:
+        keys = STAGES[name][2]
+        values = []
+        for key, value in config.items(name):
+            if key in keys:
+                continue
+            values += [os.path.normpath(i.strip()) for i in value.split(',') if i.strip()]
+        deps[name] = set()
+        for other in names:
+            if other == name:
+                continue
+            for out in outputs[other]:
+                stem = os.path.splitext(out)[0]
+                patterns = buildcache.output_patterns(out)
+                if any(os.path.splitext(v)[0] == stem or v.startswith(out + os.sep) or
+                       any(fnmatch.fnmatchcase(v, p) for p in patterns)
+                       for v in values):
+                    deps[name].add(other)
+    return deps
+
+
+def topological_order(names, deps):
+    """
+    Stages in an order where every stage follows its dependencies, exits
+    if there is a cycle
+    """
+
+    order = []
+    done = set()
+    while len(order) < len(names):
+        ready = [n for n in names if n not in done and deps[n] <= done]
+        if not ready:
+            sys.exit('ERROR cycle in stages: ' +
+                     ', '.join(n for n in names if n not in done))
+        order += ready
+        done.update(ready)
+    return order
+
+
+def stage_cpu(config, name):
+    """
+    Cores used by a stage, its nproc if any
+    """
+
+    if config.has_option(name, 'nproc'):
+        try:
+            return max(int(float(config.get(name, 'nproc'))), 1)
+        except ValueError:
+            pass
+    return 1
+
+
+def start_stage(inifile, name, logdir=''):
+    """
+    Start the shell of a stage in its own process
+    """
+
+    module, shell = STAGES[name][:2]
+    code = ("import sys; from lfptools." + module + " import " + shell +
+            "; " + shell + "(sys.argv[1:])")
+    log = None
+    if logdir:
+        log = open(os.path.join(logdir, name + '.log'), 'w')
+    proc = subprocess.Popen([sys.executable, '-c', code, '-i', inifile],
+                            stdout=log, stderr=subprocess.STDOUT if log else None)
+    return proc, log
+
+
+def stop_stages(running, wait=10):
+    """
+    Terminate the processes of running stages, killed if they do not exit
+    within wait seconds, and close their logs
+    """
+
+    for proc, log in running.values():
+        proc.terminate()
+    for proc, log in running.values():
+        try:
+            proc.wait(timeout=wait)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        if log is not None:
+            log.close()
+
+
+def critical_path(names, deps, duration):
+    """
+    Chain of dependent stages with the longest total duration
+    """
+
+    finish = {}
+    prev = {}
+    for name in topological_order(names, deps):
+        if name not in duration:
+            continue
+        before = [d for d in deps[name] if d in finish]
+        prev[name] = max(before, key=lambda d: finish[d]) if before else None
+        finish[name] = duration[name] + (finish[prev[name]] if prev[name] else 0)
+    if not finish:
+        return [], 0
+    name = max(finish, key=lambda n: finish[n])
+    total = finish[name]
+    path = []
+    while name is not None:
+        path.insert(0, name)
+        name = prev[name]
+    return path, total
+
+
+def report(names, deps, start, duration, status, t0, wall, ncpu):
+
+    print("    stage             start     time  status")
+    for name in names:
+        if name in duration:
+            print("    %-15s %7.1f  %7.1f  %s" % (name, start[name] - t0,
+                                                 duration[name], status[name]))
+        else:
+            print("    %-15s %7s  %7s  %s" % (name, '-', '-', status[name]))
+
+    path, total = critical_path(names, deps, duration)
+    serial = sum(duration.values())
+    print("    critical path: " +
+          " -> ".join(n + " (%.1f s)" % duration[n] for n in path))
+    print("    critical path %.1f s, wall time %.1f s, serial time %.1f s, ncpu %d"
+          % (total, wall, serial, ncpu))
+
+
+if __name__ == '__main__':
+    run_shell(sys.argv[1:])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import sys
+import getopt
+import subprocess
+import configparser
+import numpy as np
+from lfptools import misc_utils
+from lfptools import sampling
+from lfptools import stageio
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
+
+
+def samplepoints_shell(argv):
+
+    myhelp = '''
+LFPtools v0.1
+
+Name
+----
+samplepoints
+
+Description
+-----------
+Sample several rasters at every point in the `rec` file in a single
+traversal of the points, e.g. widths, bankfull discharge and bank
+elevations. Every attribute is defined by a source, a reducer and a
+searching threshold. Reducers available:
+
+nearest : nearest pixel larger than minval (as lfp-getwidths, lfp-getbankfullq)
+near    : nearest valid pixel (as lfp-getbankelevs method near)
+mean, min, meanmin : reduction of the window (as lfp-getbankelevs)
+
+Usage
+-----
+>> lfp-samplepoints -i config.txt
+
+Content in config.txt
+---------------------
+[samplepoints]
+output   = Shapefile output file path, one field per attribute
+recf     = `Rec` file path
+netf     = Target mask file path
+proj     = Output projection in Proj4 format
+fields   = Comma separated list of attributes e.g. width,bankfullq,elev
+hrnodata = (Optional) NODATA value for mean, min and meanmin
+outlier  = (Optional) Outlier detection yes/no for mean, min and meanmin
+nproc    = (Optional) Number of cores to use, default 1
+stage    = (Optional) Stage file format [npz|parquet|feather], writes
+           output.<format> to be read by downstream stages
+export   = (Optional) Comma separated exports [shp,tif|shp|none], default shp,tif
+
+# One line per attribute in fields, minval and fill are optional
+# name = source, reducer, thresh, minval, fill
+# fill enables gap filling per link with fill as default value
+width     = wth.tif, nearest, 0.02, 30, 30
+bankfullq = bfq.tif, nearest, 0.02, 0, 0
+elev      = dem.tif, near, 0.00416
+'''
+
+    try:
+        opts, args = getopt.getopt(argv, "i:")
+        for o, a in opts:
+            if o == "-i":
+                inifile = a
+    except:
+        print(myhelp)
+        sys.exit(0)
+
+    config = configparser.SafeConfigParser({'hrnodata': '-9999',
+                                            'outlier': 'no', 'nproc': '1',
+                                            'stage': '', 'export': 'shp,tif'})
+    config.read(inifile)
+
+    output = str(config.get('samplepoints', 'output'))
+    recf = str(config.get('samplepoints', 'recf'))
+    netf = str(config.get('samplepoints', 'netf'))
+    proj = str(config.get('samplepoints', 'proj'))
+    hrnodata = np.float64(config.get('samplepoints', 'hrnodata'))
+    outlier = str(config.get('samplepoints', 'outlier'))
+    fields = [i.strip() for i in config.get('samplepoints', 'fields').split(',')]
+
+    specs = [parse_spec(name, config.get('samplepoints', name))
+             for name in fields]
+
+    nproc = int(config.get('samplepoints', 'nproc'))
+    stage = str(config.get('samplepoints', 'stage'))
+    export = stageio.parse_export(config.get('samplepoints', 'export'))
+
+    samplepoints(output, recf, netf, proj, specs, hrnodata, outlier, nproc,
+                 stage, export)
+
+
+def parse_spec(name, value):
+    """
+    Read an attribute definition: source, reducer, thresh, minval, fill
+    """
+
+    vals = [i.strip() for i in value.split(',')]
+    if len(vals) < 3:
+        sys.exit('ERROR attribute ' + name + ' requires source, reducer and thresh')
+    spec = {'name': name, 'source': vals[0], 'reducer': vals[1],
+            'thresh': np.float64(vals[2])}
+    if len(vals) > 3 and vals[3] != '':
+        spec['minval'] = np.float64(vals[3])
+    if len(vals) > 4 and vals[4] != '':
+        spec['fill'] = np.float64(vals[4])
+    return spec
+
+
+def samplepoints(output, recf, netf, proj, specs, hrnodata=-9999, outlier='no', nproc=1,
+                 stage='', export=stageio.EXPORTS):
+
+    print("    running samplepoints.py...")
+
+    for spec in specs:
+        if spec['reducer'] not in sampling.REDUCERS:
+            sys.exit('ERROR reducer not recognised: ' + spec['reducer'])
+
+    # Reading XXX_rec.csv file
+    rec = stageio.read_rec(recf)
+
+    # Every window of every source is read through the same reader,
+    # one reader per process when running in parallel
+    res = sampling.run_points(sampling.sample_points,
+                              (rec['lon'].values, rec['lat'].values),
+                              nproc=nproc, groups=rec['link'].values,
+                              args=(specs,),
+                              kwargs={'hrnodata': hrnodata, 'outlier': outlier})
+
+    names = [spec['name'] for spec in specs]
+    for spec in specs:
+        rec[spec['name']] = res[spec['name']]
+
+        # Group river network per link
+        # If there are more NaN than real values, all values in link are
+        # equal to fill. Otherwise, interpolate real values to fill NaNs
+        if 'fill' in spec:
+            rec[spec['name']] = misc_utils.fill_links(
+                rec[spec['name']].values, rec['link'].values, spec['fill'])
+
+    # Writing stage file and .shp resulting file, one table with all
+    # attributes
+    frame = stageio.write_outputs(output, proj, rec.index, rec['lon'], rec['lat'],
+                                  [(name, rec[name]) for name in names], stage, export)
+
+    if output is not None and 'tif' in export:
+        geo = gdalutils.get_geo(netf)
+
+        fmt = "GTiff"
+        nodata = -9999
+        name1 = output+".shp"
+        for name in names:
+            name2 = output+"_"+name+".tif"
+            subprocess.call(["gdal_rasterize", "-a_nodata", str(nodata), "-of", fmt, "-ot", "Float32", "-co", "COMPRESS=DEFLATE", "-tr", str(geo[6]), str(geo[7]),
+                             "-a", name, "-a_srs", proj, "-te", str(geo[0]), str(geo[1]), str(geo[2]), str(geo[3]), name1, name2])
+
+    return frame
+
+
+if __name__ == '__main__':
+    samplepoints_shell(sys.argv[1:])
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import os
+import numpy as np
+import multiprocessing as mp
+from lfptools import misc_utils
+from lfptools import session
+from lfptools.rasterresample import check_outlier
+from lfptools.lazyimport import lazy_import
+haversine = lazy_import('gdalutils.extras.haversine')
+gdal = lazy_import('osgeo.gdal')
+ndimage = lazy_import('scipy.ndimage')
+spatial = lazy_import('scipy.spatial')
+
+
+class WindowReader(object):
+    """
+    Reads windows around points from several rasters keeping every
+    dataset open, so the GDAL block cache is reused between consecutive
+    points. Pixels are selected as in gdalutils.clip_raster, pixel centres
+    inside the window. Windows requested for the same source and
+    extent are read only once
+    """
+
+    def __init__(self):
+        self._datasets = {}
+        self._stats = {}
+        self._last = {}
+
+    def _open(self, fname):
+        # Keyed by absolute path, an lfp worker changes folder between jobs
+        fname = os.path.abspath(fname)
+        if fname not in self._datasets:
+            self._stats[fname] = session.file_stat(fname)
+            ds = gdal.Open(fname)
+            gt = ds.GetGeoTransform()
+            band = ds.GetRasterBand(1)
+            self._datasets[fname] = (ds, band, gt, ds.RasterXSize,
+                                     ds.RasterYSize, band.GetNoDataValue())
+        return self._datasets[fname]
+
+    def read(self, fname, xmin, ymin, xmax, ymax):
+        """
+        Returns data and geo in the same format as gdalutils.clip_raster
+        """
+
+        fname = os.path.abspath(fname)
+        key = (xmin, ymin, xmax, ymax)
+        last = self._last.get(fname)
+        if last is not None and last[0] == key:
+            return last[1]
+
+        ds, band, gt, nx, ny, nodata = self._open(fname)
+
+        # First and last pixel with centre inside the window
+        c = (np.array([xmin, xmax]) - gt[0])/gt[1] - 0.5
+        r = (np.array([ymax, ymin]) - gt[3])/gt[5] - 0.5
+        c0 = max(int(np.ceil(c[0])), 0)
+        c1 = min(int(np.floor(c[1])), nx-1)
+        r0 = max(int(np.ceil(r[0])), 0)
+        r1 = min(int(np.floor(r[1])), ny-1)
+
+        x = gt[0] + gt[1]*(np.arange(c0, c1+1) + 0.5)
+        y = gt[3] + gt[5]*(np.arange(r0, r1+1) + 0.5)
+
+        if x.size > 0 and y.size > 0:
+            dat = band.ReadAsArray(c0, r0, x.size, y.size)
+        else:
+            dat = np.empty((y.size, x.size))
+
+        xres = gt[1]
+        yres = gt[5]
+        geo = [x.min() - xres/2. if x.size else xmin,
+               y.min() + yres/2. if y.size else ymin,
+               x.max() + xres/2. if x.size else xmax,
+               y.max() - yres/2. if y.size else ymax,
+               x.size, y.size, xres, yres, x, y, None, nodata]
+
+        self._last[fname] = (key, (dat, geo))
+        return dat, geo
+
+    def window(self, fname, x, y, thresh):
+        """
+        Window of size 2*thresh centred in x, y
+        """
+
+        return self.read(fname, x - thresh, y - thresh, x + thresh, y + thresh)
+
+    def resolution(self, fname):
+        """
+        Largest pixel size of the raster
+        """
+
+        gt = self._open(fname)[2]
+        return max(abs(gt[1]), abs(gt[5]))
+
+    def refresh(self):
+        """
+        Close datasets modified on disk since they were opened, keep the
+        others open
+        """
+
+        for fname in list(self._datasets):
+            if session.file_stat(fname) != self._stats[fname]:
+                del self._datasets[fname]
+        self._last = {}
+
+    def close(self):
+        self._datasets = {}
+        self._stats = {}
+        self._last = {}
+
+
+def reduce_nearest(dat, geo, x, y, minval=0, **kwargs):
+    """
+    Value of the nearest pixel larger than minval, Euclidean distance.
+    NaN if there are no valid pixels in the window
+    """
+
+    return _nearest(dat, geo, x, y, minval)[0]
+
+
+def _nearest(dat, geo, x, y, minval):
+    iy, ix = np.where(dat > minval)
+    xdat = geo[8][ix]
+    ydat = geo[9][iy]
+
+    try:
+        dis, ind = misc_utils.near_euc(xdat, ydat, (x, y))
+        return dat[iy[ind], ix[ind]], dis
+    except ValueError:
+        return np.nan, np.inf
+
+
+def search_nearest(reader, fname, x, y, thresh, minval=0, start=1.5, factor=2.):
+    """
+    Same result as reduce_nearest on a window of size thresh, but a small
+    window of start pixels is read first and it grows by factor until a
+    valid pixel is found. A pixel closer than the half size of the window
+    is the nearest one of any larger window since every pixel closer to
+    the point is inside the window too
+    """
+
+    half = start*reader.resolution(fname)
+    while half < thresh:
+        dat, geo = reader.window(fname, x, y, half)
+        val, dis = _nearest(dat, geo, x, y, minval)
+        if dis < half:
+            return val
+        half *= factor
+
+    dat, geo = reader.window(fname, x, y, thresh)
+    return _nearest(dat, geo, x, y, minval)[0]
+
+
+def reduce_near(dat, geo, x, y, **kwargs):
+    """
+    Value of the nearest valid pixel, Haversine distance
+    """
+
+    nodata = geo[11]
+    iy, ix = np.where(dat > nodata)
+    if iy.size == 0:
+        return np.nan
+    arr = haversine.haversine_array(np.float32(geo[9][iy]), np.float32(
+        geo[8][ix]), np.float32(y), np.float32(x))
+    ind = np.argmin(np.array(arr))
+    return dat[iy[ind], ix[ind]]
+
+
+def reduce_elev(dat, geo, x, y, method='mean', hrnodata=-9999, outlier='no',
+                **kwargs):
+    """
+    Mean, min or meanmin of the window with optional outlier detection
+    """
+
+    ddem = np.ma.masked_where(dat == hrnodata, dat)
+
+    if outlier == 'yes':
+        ddem = check_outlier(dat.copy(), ddem, hrnodata, 3.5)
+
+    if ddem.count() == 0:
+        return np.nan
+    if method == 'meanmin':
+        return np.mean([ddem.mean(), ddem.min()])
+    elif method == 'mean':
+        return ddem.mean()
+    elif method == 'min':
+        return ddem.min()
+
+
+def nearest_edt(dat, geo, x, y, thresh, minval=0):
+    """
+    Value of the nearest pixel larger than minval for many points at once,
+    same result as reduce_nearest on a window of size thresh. A distance
+    transform of the invalid pixels gives the nearest valid pixel of every
+    cell, the closest of the ones of the cell a point falls in and its
+    neighbours bounds the distance to search. The nearest pixel is then
+    found by nearest_radius in a window of that size (thresh at most)
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    valid = dat > minval
+    if not valid.any():
+        return np.ones(x.size)*np.nan
+
+    ind = ndimage.distance_transform_edt(~valid, sampling=(abs(geo[7]), abs(geo[6])),
+                                 return_distances=False, return_indices=True)
+
+    col = np.floor((x - geo[0])/geo[6]).astype(np.int64)
+    row = np.floor((y - geo[3])/geo[7]).astype(np.int64)
+    inside = (col >= 0) & (col < dat.shape[1]) & (row >= 0) & (row < dat.shape[0])
+    col = col[inside]
+    row = row[inside]
+
+    # Nearest pixels of the cell and its neighbours are candidates, the
+    # closest one is not always the nearest to the point but no pixel
+    # nearer than it can be missed by a window of its distance
+    best = np.ones(col.size)*np.inf
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            r = np.clip(row + dr, 0, dat.shape[0] - 1)
+            c = np.clip(col + dc, 0, dat.shape[1] - 1)
+            dis = ((geo[8][ind[1][r, c]] - x[inside])**2 +
+                   (geo[9][ind[0][r, c]] - y[inside])**2)
+            best = np.minimum(best, dis)
+
+    # Points outside the raster search the whole window
+    radius = np.ones(x.size)*thresh
+    radius[inside] = np.minimum(np.sqrt(best)*(1 + 1e-9), thresh)
+
+    iy, ix = np.where(valid)
+    return nearest_radius(geo[8][ix], geo[9][iy], dat[iy, ix], x, y, radius)
+
+
+def nearest_radius(xdat, ydat, vals, x, y, r, minval=None):
+    """
+    Value of the nearest pixel (Euclidean distance) among the pixels inside
+    a window of half size r around every point, r can be different for
+    every point. All points are answered together by queries on an index
+    of the pixels. If minval is given (one per point) pixels not larger
+    than it are discarded. NaN where no pixel is left
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    out = np.ones(x.size)*np.nan
+    if len(vals) == 0 or x.size == 0:
+        return out
+
+    tree = spatial.cKDTree(np.column_stack((xdat, ydat)))
+    pts = np.column_stack((x, y))
+    radius = np.ones(x.size)*r
+    if minval is not None:
+        minval = np.ones(x.size)*minval
+
+    # Windows are shrunk to the distance of the nearest valid pixel, so
+    # the query below only lists the pixels around it and not every pixel
+    # of the window. The k nearest pixels are checked, k growing for the
+    # points whose nearest pixels are all discarded by minval
+    n = len(vals)
+    empty = np.zeros(x.size, dtype=bool)
+    todo = np.arange(x.size)
+    k = 1
+    while todo.size > 0 and k <= 512:
+        k = min(k, n)
+        reach = radius[todo]*np.sqrt(2)*(1 + 1e-9)
+        dis, ind = tree.query(pts[todo], k=k, distance_upper_bound=reach.max())
+        dis = dis.reshape(todo.size, k)
+        ind = ind.reshape(todo.size, k)
+        found = (ind < n) & (dis <= reach[:, None])
+        ok = found.copy()
+        if minval is not None:
+            ok[found] = vals[ind[found]] > np.broadcast_to(minval[todo][:, None], ind.shape)[found]
+        hit = ok.any(axis=1)
+        d = dis[np.arange(todo.size), ok.argmax(axis=1)]
+        radius[todo[hit]] = np.minimum(d[hit]*(1 + 1e-9), radius[todo[hit]])
+        # Fewer than k pixels in reach, none of them valid
+        empty[todo[~hit & ~found.all(axis=1)]] = True
+        todo = todo[~hit & found.all(axis=1)]
+        if k == n:
+            empty[todo] = True
+            break
+        k *= 8
+
+    use = np.flatnonzero(~empty)
+    if use.size == 0:
+        return out
+    lists = tree.query_ball_point(pts[use], radius[use], p=np.inf,
+                                 return_sorted=True)
+
+    lens = np.array([len(i) for i in lists], dtype=np.int64)
+    if lens.sum() == 0:
+        return out
+    idx = np.concatenate(lists).astype(np.int64)
+    pid = np.repeat(use, lens)
+
+    if minval is not None:
+        keep = vals[idx] > minval[pid]
+        idx = idx[keep]
+        pid = pid[keep]
+        if idx.size == 0:
+            return out
+
+    # First pixel of every point once sorted by distance, ties are
+    # solved by pixel order as in near_euc
+    dis = (xdat[idx] - x[pid])**2 + (ydat[idx] - y[pid])**2
+    order = np.lexsort((idx, dis, pid))
+    pid = pid[order]
+    first = np.concatenate(([True], pid[1:] != pid[:-1]))
+    out[pid[first]] = vals[idx[order][first]]
+    return out
+
+
+REDUCERS = {
+    'nearest': reduce_nearest,
+    'near': reduce_near,
+    'mean': lambda *a, **k: reduce_elev(*a, method='mean', **k),
+    'min': lambda *a, **k: reduce_elev(*a, method='min', **k),
+    'meanmin': lambda *a, **k: reduce_elev(*a, method='meanmin', **k),
+}
+
+
+def sample_points(reader, x, y, specs, **kwargs):
+    """
+    Sample all specs at every point in a single traversal of the points.
+    specs is a list of dictionaries with keys name, source, reducer,
+    thresh and optionally minval. Returns a dictionary of arrays keyed by name
+    """
+
+    out = {}
+    for spec in specs:
+        if spec['reducer'] not in REDUCERS:
+            raise ValueError('reducer not recognised: ' + spec['reducer'])
+        out[spec['name']] = np.ones(len(x))*np.nan
+
+    for i in range(len(x)):
+        for spec in specs:
+            opts = dict(kwargs)
+            if 'minval' in spec:
+                opts['minval'] = spec['minval']
+            if spec['reducer'] == 'nearest':
+                out[spec['name']][i] = search_nearest(
+                    reader, spec['source'], x[i], y[i], spec['thresh'],
+                    opts.get('minval', 0))
+                continue
+            dat, geo = reader.window(spec['source'], x[i], y[i], spec['thresh'])
+            out[spec['name']][i] = REDUCERS[spec['reducer']](
+                dat, geo, x[i], y[i], **opts)
+
+    return out
+
+
+def partition_points(n, nchunks, groups=None, x=None, y=None, tile=None):
+    """
+    Split point positions 0..n-1 in spatially compact chunks. Points
+    sharing a group (e.g. link number) are kept in the same chunk and
+    consecutive groups are packed until every chunk has about n/nchunks
+    points. If tile is given points are grouped by tiles of that size
+    (same units as x and y) instead. Returns a list of index arrays
+    """
+
+    if tile is not None:
+        ix = np.floor(np.asarray(x)/tile).astype(np.int64)
+        iy = np.floor(np.asarray(y)/tile).astype(np.int64)
+        order = np.lexsort((ix, iy))
+        keys = np.stack([iy[order], ix[order]])
+        brk = np.flatnonzero(np.any(keys[:, 1:] != keys[:, :-1], axis=0)) + 1
+    elif groups is not None:
+        # rec files store every link contiguously, keep the rec order
+        order = np.arange(n)
+        groups = np.asarray(groups)
+        brk = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+    else:
+        return [i for i in np.array_split(np.arange(n), nchunks) if i.size > 0]
+
+    size = max(int(np.ceil(n/float(nchunks))), 1)
+    starts = np.concatenate([[0], brk])
+    ends = np.concatenate([brk, [n]])
+
+    chunks = []
+    current = []
+    count = 0
+    for a, b in zip(starts, ends):
+        current.append(order[a:b])
+        count += b - a
+        if count >= size:
+            chunks.append(np.concatenate(current))
+            current = []
+            count = 0
+    if current:
+        chunks.append(np.concatenate(current))
+
+    return chunks
+
+
+_reader = None
+
+
+def _init_worker():
+    global _reader
+    _reader = WindowReader()
+
+
+def _run_chunk(job):
+    func, idx, arrays, args, kwargs = job
+    return idx, func(_reader, *arrays, *args, **kwargs)
+
+
+def run_points(func, arrays, nproc=1, groups=None, tile=None, args=(),
+               kwargs=None, chunks_per_proc=4):
+    """
+    Run func(reader, *arrays, *args, **kwargs) over chunks of points on a
+    process pool. arrays are per point arrays (e.g. x, y) split in chunks,
+    every worker keeps its own WindowReader so datasets are opened once
+    per worker. func returns an array or a dictionary of arrays with one
+    value per point, results are reassembled in the original point order
+    """
+
+    kwargs = {} if kwargs is None else kwargs
+    arrays = [np.asarray(a) for a in arrays]
+    n = len(arrays[0])
+    nproc = max(int(nproc), 1)
+
+    if nproc == 1 or n == 0:
+        # In an lfp worker session the reader and its datasets are kept
+        reader = session.cached('window_reader', WindowReader)
+        res = func(reader, *arrays, *args, **kwargs)
+        if not session.active():
+            reader.close()
+        return res
+
+    chunks = partition_points(n, nproc*chunks_per_proc, groups=groups,
+                              x=arrays[0], y=arrays[1], tile=tile)
+    jobs = [(func, idx, [a[idx] for a in arrays], args, kwargs)
+            for idx in chunks]
+
+    pool = mp.Pool(nproc, initializer=_init_worker)
+    try:
+        results = pool.map(_run_chunk, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Reassemble in the original order
+    if isinstance(results[0][1], dict):
+        out = {k: np.ones(n)*np.nan for k in results[0][1]}
+        for idx, res in results:
+            for k in out:
+                out[k][idx] = res[k]
+    else:
+        out = np.ones(n)*np.nan
+        for idx, res in results:
+            out[idx] = res
+
+    return out
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import os
+
+# Datasets kept open between the jobs run by an lfp worker (see
+# lfptools.cli). Outside a worker session nothing is kept and every call
+# opens its datasets as usual. Objects are dropped when the file they were
+# opened from changes on disk
+
+_active = False
+_cache = {}
+
+
+def start():
+    """
+    Start a session, datasets opened through cached() are kept
+    """
+
+    global _active
+    _active = True
+
+
+def active():
+
+    return _active
+
+
+def cached(key, opener, fname=None):
+    """
+    Result of opener(), kept between calls with the same key while a
+    session is active and fname (if given) is not modified
+    """
+
+    if not _active:
+        return opener()
+    stat = file_stat(fname)
+    hit = _cache.get(key)
+    if hit is not None and hit[1] == stat:
+        return hit[0]
+    obj = opener()
+    _cache[key] = (obj, stat)
+    return obj
+
+
+def refresh():
+    """
+    Called between jobs: objects opened from modified files are dropped,
+    objects with a refresh method (e.g. sampling.WindowReader) refresh
+    their own datasets
+    """
+
+    for key, (obj, stat) in list(_cache.items()):
+        if stat is not None and file_stat(stat[0]) != stat:
+            del _cache[key]
+        elif hasattr(obj, 'refresh'):
+            obj.refresh()
+
+
+def file_stat(fname):
+    """
+    Absolute path, size and modification time of fname, None if not given
+    """
+
+    if fname is None:
+        return None
+    fname = os.path.abspath(fname)
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return (fname, None, None)
+    return (fname, st.st_size, st.st_mtime_ns)
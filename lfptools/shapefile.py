@@ -20,6 +20,8 @@ import tempfile
 import itertools
 from datetime import date
 
+import numpy as np
+
 #
 # Constants for shape types
 NULL = 0
@@ -506,7 +508,7 @@ class Reader:
                 value = value.replace(b('*'), b(''))  # QGIS NULL is all '*' chars
                 if value == b(''):
                     value = None
-                elif deci:
+                elif deci or typ == "F":
                     try:
                         value = float(value)
                     except ValueError:
@@ -601,6 +603,70 @@ class Reader:
         for shape, record in izip(self.iterShapes(), self.iterRecords()):
             yield _ShapeRecord(shape=shape, record=record)
 
+    def numpyPoints(self):
+        """Returns x and y of all shapes of a POINT shapefile as numpy
+        arrays. The .shp file is memory-mapped through a structured dtype,
+        no _Shape object is built per point."""
+        shp = self.__getFileObj(self.shp)
+        if self.shapeType != POINT:
+            raise ShapefileException("numpyPoints supports POINT shapefiles only.")
+        dtype = np.dtype([("num", ">i4"), ("len", ">i4"), ("type", "<i4"),
+                          ("x", "<f8"), ("y", "<f8")])
+        shp.seek(0, 2)
+        size = shp.tell() - 100
+        if size % dtype.itemsize:
+            raise ShapefileException("numpyPoints requires point records of fixed size (null shapes found?).")
+        recs = _numpyFile(shp, dtype, 100, size // dtype.itemsize)
+        if ((recs["len"] != 10) | (recs["type"] != POINT)).any():
+            raise ShapefileException("numpyPoints requires point records of fixed size (null shapes found?).")
+        return np.array(recs["x"], dtype=np.float64), np.array(recs["y"], dtype=np.float64)
+
+    def numpyRecords(self, names=None):
+        """Returns the dbf records as a numpy structured array with one
+        column per field in names (all fields by default). The .dbf file
+        is memory-mapped and decoded column by column: N and F fields are
+        returned as float64 (NaN where missing), any other field as
+        stripped strings. Deleted records are skipped."""
+        dbf = self.__getFileObj(self.dbf)
+        if self.numRecords is None:
+            self.__dbfHeader()
+        fields = self.fields[1:]
+        if names is None:
+            names = [field[0] for field in fields]
+        fieldNames = [field[0] for field in fields]
+        for name in names:
+            if name not in fieldNames:
+                raise ShapefileException("Field %s not found in dbf file." % name)
+        dtype = np.dtype([("DeletionFlag", "S1")] +
+                         [("f%d" % i, "V%d" % field[2]) for i, field in enumerate(fields)])
+        if dtype.itemsize != self.__recStruct.size:
+            raise ShapefileException("Shapefile dbf record length does not match its fields.")
+        recs = _numpyFile(dbf, dtype, self.__dbfHeaderLength(), self.numRecords)
+        keep = recs["DeletionFlag"] == b(" ")
+        columns = []
+        for name in names:
+            i = fieldNames.index(name)
+            name, typ, size, deci = fields[i]
+            raw = np.array(recs["f%d" % i][keep]).view(np.uint8).reshape(-1, size)
+            text = raw.view("S%d" % size).ravel()
+            if typ in ("N", "F"):
+                # QGIS NULL is all '*' chars, blank or nul fields are missing too
+                missing = (raw == ord("*")).any(axis=1) | \
+                    ((raw == 32) | (raw == 0)).all(axis=1)
+                text = text.copy()
+                text[missing] = b("nan")
+                try:
+                    value = text.astype(np.float64)
+                except ValueError:
+                    raise ShapefileException("Field %s has values not parseable as numbers." % name)
+            else:
+                value = np.char.strip(np.char.decode(text, "latin-1"))
+            columns.append((name, value))
+        out = np.empty(int(keep.sum()), dtype=[(name, value.dtype) for name, value in columns])
+        for name, value in columns:
+            out[name] = value
+        return out
+
 
 class Writer:
     """Provides write support for ESRI Shapefiles."""
@@ -934,6 +1000,9 @@ class Writer:
                     # numeric or float: number stored as a string, right justified, and padded with blanks to the width of the field.
                     if value in MISSING:
                         value = str("*"*size) # QGIS NULL
+                    elif int(dec) > 0:
+                        # fixed number of decimals
+                        value = ("%.*f" % (int(dec), float(value))).rjust(size)
                     else:
                         value = str(value).rjust(size)
                 elif fieldType == "D":
@@ -1235,6 +1304,193 @@ class Editor(Writer):
         fieldName = fieldName.upper()
         fieldName.replace(' ', '_')
 
+def _numpyFile(f, dtype, offset, count):
+    """Maps count items of dtype from offset of a file object. Files on
+    disk are memory-mapped, other file-like objects are read."""
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    try:
+        f.fileno()
+        return np.memmap(f, dtype=dtype, mode="r", offset=offset, shape=(count,))
+    except (AttributeError, IOError, ValueError):
+        f.seek(offset)
+        return np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype, count=count)
+
+
+def _dbfColumn(values, fieldType, size, decimal=0):
+    """Formats a column of values as a (records, size) array of bytes the
+    same way Writer.__dbfRecords formats every value."""
+    values = np.asarray(values)
+    n = len(values)
+    missing = np.zeros(n, dtype=bool)
+    if values.dtype.kind in ("S", "U", "O"):
+        missing = np.array([v in MISSING for v in values], dtype=bool)
+    if fieldType in ("N", "F") and int(decimal) > 0:
+        # Fixed number of decimals, F values too large for the field are
+        # written in exponent notation
+        def fmt(v):
+            text = "%.*f" % (int(decimal), v)
+            if fieldType == "F" and len(text) > size:
+                text = "%.*e" % (max(size - 8, 0), v)
+            return b(text)
+        text = np.array([b("*") if m else fmt(float(v))
+                         for v, m in zip(values.tolist(), missing)] or [b("")])
+    elif values.dtype.kind in ("S", "U", "O"):
+        text = np.array([b(str(v)) for v in values] or [b("")])
+    else:
+        # Numbers are formatted as str() does, shortest representation
+        text = values.astype("S32")
+    width = text.dtype.itemsize
+    raw = text.view(np.uint8).reshape(-1, width)[:n]
+    length = (raw != 0).sum(axis=1)
+    if width < size:
+        raw = np.concatenate((raw, np.zeros((n, size - width), dtype=np.uint8)), axis=1)
+    if fieldType in ("N", "F"):
+        if (length[~missing] > size).any():
+            raise ShapefileException(
+                "Shapefile Writer unable to pack incorrect sized value"
+                " into field of size %d." % size)
+        # Right justified, padded with blanks
+        col = np.arange(size)[None, :] - (size - length)[:, None]
+        out = np.take_along_axis(raw, np.clip(col, 0, size - 1), axis=1)
+        out[col < 0] = 32
+        out[missing] = ord("*")
+        return out
+    # Left justified, truncated and padded with blanks
+    raw = raw[:, :size].copy()
+    raw[np.arange(size)[None, :] >= length[:, None]] = 32
+    return raw
+
+
+class PointWriter:
+    """Writes a POINT shapefile as a stream. Records are appended to the
+    open .shp, .shx and .dbf files as they are written and the headers
+    (bounding box, number of records and file lengths) are patched on
+    close, so memory does not grow with the number of points. fields is
+    a list of field names or (name, fieldType, size, decimal) tuples as
+    taken by Writer.field, only C, N and F fields are supported. Files
+    are the same as written by Writer point by point.
+
+        with PointWriter("points", ["x", "y", ("width", "F", 20, 10)]) as w:
+            for x, y, width in chunks:
+                w.write(x, y, x, y, width)
+    """
+    def __init__(self, target, fields):
+        target = os.path.splitext(target)[0]
+        pth = os.path.split(target)[0]
+        if pth and not os.path.exists(pth):
+            os.makedirs(pth)
+        fields = [(f,) if is_string(f) else tuple(f) for f in fields]
+        fields = [f + ("C", "50", 0)[len(f) - 1:] for f in fields]
+        for field in fields:
+            if field[1].upper() not in ("C", "N", "F"):
+                raise ShapefileException("PointWriter supports C, N and F fields only.")
+        self.fields = fields
+        self.target = target
+        self.numRecords = 0
+        self._bbox = None
+        self.recordLength = sum([int(field[2]) for field in fields]) + 1
+        self.shp = open(target + ".shp", "wb")
+        self.shx = open(target + ".shx", "wb")
+        self.dbf = open(target + ".dbf", "wb")
+        self.__shapefileHeader(self.shp)
+        self.__shapefileHeader(self.shx)
+        self.__dbfHeader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __shapefileHeader(self, f, length=50, bbox=(0, 0, 0, 0)):
+        """Writes a .shp or .shx header, length in 16-bit words."""
+        f.seek(0)
+        f.write(pack(">6i", 9994,0,0,0,0,0))
+        f.write(pack(">i", length))
+        f.write(pack("<2i", 1000, POINT))
+        f.write(pack("<4d", *bbox))
+        f.write(pack("<4d", 0, 0, 0, 0))
+
+    def __dbfHeader(self):
+        """Writes the .dbf header and field descriptors."""
+        f = self.dbf
+        f.seek(0)
+        year, month, day = time.localtime()[:3]
+        year -= 1900
+        f.write(pack('<BBBBLHH20x', 3, year, month, day, self.numRecords,
+                     len(self.fields) * 32 + 33, self.recordLength))
+        for name, fieldType, size, decimal in self.fields:
+            name = b(name).replace(b(' '), b('_'))
+            name = name.ljust(11).replace(b(' '), b('\x00'))
+            f.write(pack('<11sc4xBB14x', name, b(fieldType), int(size), int(decimal)))
+        f.write(b('\r'))
+
+    def write(self, x, y, *columns):
+        """Appends points with coordinates x and y, scalars or arrays, and
+        one value or array of values per field."""
+        x = np.atleast_1d(np.asarray(x, dtype="<f8"))
+        y = np.atleast_1d(np.asarray(y, dtype="<f8"))
+        n = x.size
+        if len(columns) != len(self.fields):
+            raise ShapefileException("One column of values is required per field.")
+        if n == 0:
+            return
+        # Geometry records: header (record number, content length) and point
+        num = self.numRecords + np.arange(1, n + 1)
+        rec = np.zeros(n, dtype=[("num", ">i4"), ("len", ">i4"), ("type", "<i4"),
+                                 ("x", "<f8"), ("y", "<f8")])
+        rec["num"] = num
+        rec["len"] = 10
+        rec["type"] = POINT
+        rec["x"] = x
+        rec["y"] = y
+        shx = np.zeros(n, dtype=[("off", ">i4"), ("len", ">i4")])
+        shx["off"] = (100 + 28 * (num - 1)) // 2
+        shx["len"] = 10
+        # Attribute records: deletion flag and fixed width fields
+        table = np.empty((n, self.recordLength), dtype=np.uint8)
+        table[:, 0] = 32
+        start = 1
+        for (name, fieldType, size, decimal), values in zip(self.fields, columns):
+            size = int(size)
+            values = np.atleast_1d(np.asarray(values))
+            table[:, start:start + size] = _dbfColumn(values, fieldType.upper(), size, decimal)
+            start += size
+        rec.tofile(self.shp)
+        shx.tofile(self.shx)
+        table.tofile(self.dbf)
+        bbox = [x.min(), y.min(), x.max(), y.max()]
+        if self._bbox is not None:
+            bbox = [min(bbox[0], self._bbox[0]), min(bbox[1], self._bbox[1]),
+                    max(bbox[2], self._bbox[2]), max(bbox[3], self._bbox[3])]
+        self._bbox = bbox
+        self.numRecords += n
+
+    def close(self):
+        """Patches the headers and closes the files."""
+        if self.shp is None:
+            return
+        n = self.numRecords
+        bbox = self._bbox or [0] * 4
+        self.__shapefileHeader(self.shp, (100 + 28 * n) // 2, bbox)
+        self.__shapefileHeader(self.shx, (100 + 8 * n) // 2, bbox)
+        self.__dbfHeader()
+        for f in (self.shp, self.shx, self.dbf):
+            f.close()
+        self.shp = self.shx = self.dbf = None
+
+
+def write_points(target, x, y, fields, columns):
+    """Writes a POINT shapefile from arrays in one go. x and y are arrays
+    of coordinates, fields a list of field names or (name, fieldType,
+    size, decimal) tuples as taken by Writer.field and columns a list of
+    arrays with the values of every field. Only C, N and F fields are
+    supported, see PointWriter."""
+    with PointWriter(target, fields) as w:
+        w.write(x, y, *columns)
+
+
 # Begin Testing
 def test(**kwargs):
     import doctest
@@ -10,9 +10,11 @@ import getopt
 import configparser
 import numpy as np
 import pandas as pd
-import gdalutils
 import subprocess
 from lfptools import misc_utils
+from lfptools import buildcache
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
 
 
 def split(argv):
@@ -59,6 +61,8 @@ def split(argv):
     tretxt : Tree file from TAUDEM
     cootxt : Coord file from TAUDEM
     outdir : Out path
+    cache : Split only basins whose inputs or code changed since the last
+            run <yes/no>, default yes
 
 
     Outputs (If running at 30s):
@@ -77,7 +81,7 @@ def split(argv):
     for o, a in opts:
         if o == "-i":
             inifile = a
-    config = configparser.SafeConfigParser()
+    config = configparser.SafeConfigParser({'cache': 'yes'})
     config.read(inifile)
 
     basnum = str(config.get('split', 'basnum'))
@@ -92,9 +96,18 @@ def split(argv):
     tretxt = str(config.get('split', 'tretxt'))
     cootxt = str(config.get('split', 'cootxt'))
     outdir = str(config.get('split', 'outdir'))
+    usecache = config.get('split', 'cache').lower() == 'yes'
 
     print("    running split.py...")
 
+    # A basin is split again only if its inputs, split code or GDAL
+    # utilities changed, or if any of its files is missing or modified
+    create_out_folder(outdir)
+    cache = buildcache.BuildCache(outdir, usecache, False,
+                                  buildcache.code_files('split'))
+    inputs = [cattif, demtif, acctif, nettif, wthtif, dirtif, aretif, ordtif,
+              tretxt, cootxt]
+
     # Clip input maps per catchment
     if basnum == "all":
         # Loading data
@@ -103,15 +116,34 @@ def split(argv):
         # Loop over all catchment numbers
         # Catchments should be numbered and > 0
         for nc in np.unique(catarr[catarr > 0]):
-            basinsplit(nc, outdir, cattif, demtif, acctif, nettif,
-                       wthtif, dirtif, aretif, ordtif, tretxt, cootxt)
+            cached_basinsplit(cache, inputs, nc, outdir, cattif, demtif, acctif, nettif,
+                              wthtif, dirtif, aretif, ordtif, tretxt, cootxt)
     else:
         # Process a single catchments
         b = basnum.split(',')
         for nc in b:
             print('processing basin number: ' + nc)
-            basinsplit(int(nc), outdir, cattif, demtif, acctif, nettif,
-                       wthtif, dirtif, aretif, ordtif, tretxt, cootxt)
+            cached_basinsplit(cache, inputs, int(nc), outdir, cattif, demtif, acctif, nettif,
+                              wthtif, dirtif, aretif, ordtif, tretxt, cootxt)
+
+
+def cached_basinsplit(cache, inputs, ncatch, outdir, *args):
+    """
+    Run basinsplit if the basin is stale in cache. Basins too small to be
+    processed are recorded with no files
+    """
+
+    ncatchstr = "%03d" % ncatch
+    folder = outdir + "/" + ncatchstr
+    outputs = [folder + "/" + ncatchstr + "_" + i for i in
+               ['tre.csv', 'coo.csv', 'rec.csv', 'dem.tif', 'acc.tif', 'net.tif',
+                'wth.tif', 'dir.tif', 'ord.tif']]
+    step = 'basin' + ncatchstr
+    if cache.stale(step, inputs, outputs, [ncatch], tools=['gdal_calc.py']):
+        basinsplit(ncatch, outdir, *args)
+        cache.done(step, [i for i in outputs if os.path.exists(i)])
+    else:
+        print('basin number ' + ncatchstr + ' is up to date')
 
 
 def basinsplit(ncatch, outdir, cattif, demtif, acctif, nettif, wthtif, dirtif, aretif, ordtif, tretxt, cootxt):
@@ -130,13 +162,13 @@ def basinsplit(ncatch, outdir, cattif, demtif, acctif, nettif, wthtif, dirtif, a
     acctmp = 'acc_tmp.tif'
     ordtmp = 'ord_tmp.tif'
     cmd = ['gdal_calc.py','--calc','where(B=='+str(ncatch)+',A,0)','--format','GTiff','--type','Int16','--NoDataValue','-9999','-B',cattif,'--B_band','1','-A',nettif,'--A_band','1','--co','COMPRESS=DEFLATE','--outfile',nettmp]
-    subprocess.call(cmd)
+    subprocess.check_call(cmd)
     cmd = ['gdal_calc.py','--calc','where(B=='+str(ncatch)+',A,0)','--format','GTiff','--type','Int16','--NoDataValue','-9999','-B',cattif,'--B_band','1','-A',dirtif,'--A_band','1','--co','COMPRESS=DEFLATE','--outfile',dirtmp]
-    subprocess.call(cmd)
+    subprocess.check_call(cmd)
     cmd = ['gdal_calc.py','--calc','where(B=='+str(ncatch)+',A,0)','--format','GTiff','--type','Float32','--NoDataValue','-9999','-B',cattif,'--B_band','1','-A',acctif,'--A_band','1','--co','COMPRESS=DEFLATE','--outfile',acctmp]
-    subprocess.call(cmd)
+    subprocess.check_call(cmd)
     cmd = ['gdal_calc.py','--calc','where(B=='+str(ncatch)+',A,0)','--format','GTiff','--type','Int16','--NoDataValue','-9999','-B',cattif,'--B_band','1','-A',ordtif,'--A_band','1','--co','COMPRESS=DEFLATE','--outfile',ordtmp]
-    subprocess.call(cmd)
+    subprocess.check_call(cmd)
     print('separated basin for nettif, dirtif, acctif, ordtif')
 
     catgeo = gdalutils.get_geo(cattif)
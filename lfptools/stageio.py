@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# inst: university of bristol
+# auth: jeison sosa
+# mail: j.sosa@bristol.ac.uk / sosa.jeison@gmail.com
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+from lfptools import shapefile
+from lfptools import misc_utils
+from lfptools.lazyimport import lazy_import
+osr = lazy_import('osgeo.osr')
+
+# Columnar files to hand point data between stages. A stage file holds the
+# index of every point in the `rec` file, lon, lat and one column per
+# attribute with their own dtype. Downstream stages read it with no parsing
+# and align it to the `rec` file by index, with no coordinate matching.
+# Formats available: npz (numpy), parquet and feather (require pyarrow)
+#
+# In memory the same table is a stage frame: a DataFrame indexed by `rec`
+# index with columns lon, lat and attributes, as returned by read_stage and
+# by every point stage. Stage frames are accepted wherever a stage file is
+
+FORMATS = ('npz', 'parquet', 'feather')
+EXPORTS = ('shp', 'tif')
+
+
+def is_stage(fname):
+    """
+    True if fname is a stage frame or a stage file, judged by its extension
+    """
+
+    if isinstance(fname, pd.DataFrame):
+        return True
+    return os.path.splitext(fname)[1][1:] in FORMATS
+
+
+def read_rec(recf):
+    """
+    Read the `rec` file, a DataFrame is taken as the rec table (copied)
+    """
+
+    if isinstance(recf, pd.DataFrame):
+        return recf.copy()
+    return pd.read_csv(recf)
+
+
+def stage_frame(index, lon, lat, columns):
+    """
+    Stage frame from the `rec` index (None or -1 where unknown), lon, lat
+    and a list of (name, values) pairs
+    """
+
+    lon = np.asarray(lon, dtype=np.float64)
+    if index is None:
+        index = -np.ones(lon.size, dtype=np.int64)
+    df = pd.DataFrame({'lon': lon, 'lat': np.asarray(lat, dtype=np.float64)},
+                      index=pd.Index(np.asarray(index, dtype=np.int64), name='index'))
+    for name, values in columns:
+        df[name] = np.asarray(values)
+    return df
+
+
+def write_stage(output, fmt, index, lon, lat, columns):
+    """
+    Write a stage file output.fmt, columns is a list of (name, values)
+    pairs. Returns the file path
+    """
+
+    if fmt not in FORMATS:
+        sys.exit('ERROR stage format not recognised: ' + fmt)
+
+    fname = output + '.' + fmt
+    names = [name for name, values in columns]
+    if fmt == 'npz':
+        arrays = {name: np.asarray(values) for name, values in columns}
+        np.savez(fname, index=np.asarray(index, dtype=np.int64),
+                 lon=np.asarray(lon, dtype=np.float64),
+                 lat=np.asarray(lat, dtype=np.float64),
+                 columns=np.array(names), **arrays)
+    else:
+        df = pd.DataFrame({'index': np.asarray(index, dtype=np.int64),
+                           'lon': np.asarray(lon, dtype=np.float64),
+                           'lat': np.asarray(lat, dtype=np.float64)})
+        for name, values in columns:
+            df[name] = np.asarray(values)
+        try:
+            if fmt == 'parquet':
+                df.to_parquet(fname, index=False)
+            else:
+                df.to_feather(fname)
+        except ImportError:
+            sys.exit('ERROR ' + fmt + ' stage files require pyarrow, use npz instead')
+    return fname
+
+
+def read_stage(fname):
+    """
+    Read a stage file as a stage frame, a DataFrame indexed by `rec` index
+    with columns lon, lat and attributes. Stage frames are returned as
+    they are
+    """
+
+    if isinstance(fname, pd.DataFrame):
+        return fname
+    fmt = os.path.splitext(fname)[1][1:]
+    if fmt == 'npz':
+        with np.load(fname) as data:
+            names = ['lon', 'lat'] + [str(i) for i in data['columns']]
+            df = pd.DataFrame({name: data[name] for name in names},
+                              index=pd.Index(data['index'], name='index'),
+                              columns=names)
+    elif fmt == 'parquet':
+        df = pd.read_parquet(fname).set_index('index')
+    elif fmt == 'feather':
+        df = pd.read_feather(fname).set_index('index')
+    else:
+        sys.exit('ERROR stage format not recognised: ' + fname)
+    return df
+
+
+def read_values(fname):
+    """
+    Read x, y and values of the first attribute of a stage file, a stage
+    frame or a point shapefile, with the `rec` index of the points (None
+    for shapefiles and for stages without index)
+    """
+
+    if is_stage(fname):
+        df = read_stage(fname)
+        index = df.index.values
+        if (index < 0).any():
+            index = None
+        return df['lon'].values, df['lat'].values, df.iloc[:, 2].values, index
+    dat = misc_utils.read_points(fname)
+    return dat[:, 0], dat[:, 1], dat[:, 2], None
+
+
+def stage_raster(fname, geo, name=None, nodata=-9999):
+    """
+    Burn an attribute of a stage file or frame (the first one by default) in the
+    grid geo (gdalutils.get_geo format), as gdal_rasterize does with
+    points the cell containing every point takes its value
+    """
+
+    df = read_stage(fname)
+    if name is None:
+        name = df.columns[2]
+    vals = df[name].values
+    keys = misc_utils.grid_keys(df['lon'].values, df['lat'].values, geo)
+    valid = (keys >= 0) & np.isfinite(vals)
+    dat = np.ones((int(geo[5]), int(geo[4])), dtype=np.float32)*nodata
+    dat.flat[keys[valid]] = vals[valid]
+    return dat
+
+
+def write_outputs(output, proj, index, lon, lat, columns, stage='', export=EXPORTS):
+    """
+    Write the outputs of a stage: a stage file if stage is a format and
+    a shapefile with its .prj if shp or tif (rasterized from the
+    shapefile) are in export. Nothing is written if output is None.
+    Returns the stage frame
+    """
+
+    frame = stage_frame(index, lon, lat, columns)
+    if output is None:
+        return frame
+
+    if stage:
+        write_stage(output, stage, index, lon, lat, columns)
+
+    if 'shp' in export or 'tif' in export:
+        names = [name for name, values in columns]
+        shapefile.write_points("%s.shp" % output, lon, lat,
+                               misc_utils.point_fields(names),
+                               [lon, lat] + [values for name, values in columns])
+
+        # write .prj file
+        prj = open("%s.prj" % output, "w")
+        srs = osr.SpatialReference()
+        srs.ImportFromProj4(proj)
+        prj.write(srs.ExportToWkt())
+        prj.close()
+
+    return frame
+
+
+def parse_export(value):
+    """
+    Read a comma separated list of exports, `none` for no export
+    """
+
+    export = [i.strip() for i in value.split(',') if i.strip() not in ('', 'none')]
+    for i in export:
+        if i not in EXPORTS:
+            sys.exit('ERROR export not recognised: ' + i)
+    return export
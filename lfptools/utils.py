@@ -10,8 +10,9 @@ from glob import glob
 import zipfile
 import numpy as np
 import pandas as pd
-import gdalutils
-from osgeo import osr
+from lfptools.lazyimport import lazy_import
+gdalutils = lazy_import('gdalutils')
+osr = lazy_import('osgeo.osr')
 
 
 def _secs_to_time(df, date1):
@@ -15,7 +15,12 @@ binaries = ['bin/lfp-fixelevs',
             'bin/lfp-getinflows',
             'bin/lfp-getdischarge',
             'bin/lfp-getrunoff',
-            'bin/lfp-buildmodel'
+            'bin/lfp-buildmodel',
+            'bin/lfp-samplepoints',
+            'bin/lfp-buildindex',
+            'bin/lfp-run',
+            'bin/lfp-batch',
+            'bin/lfp'
             ]
 
 ext_modules = [